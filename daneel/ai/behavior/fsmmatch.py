@@ -1,5 +1,4 @@
 from enum import Enum
-import time
 import math
 import os
 
@@ -25,18 +24,19 @@ class FSMMatch(Behavior):
         self.shutdown_button_press_time = 0
 
     def loop(self):
-        time_now = time.time()
+        time_now = self.robot.clock.time()
         if self.shutdown_button_press_time == 0 and self.robot.io.button1_state == self.robot.io.ButtonState.PRESSED:
-            self.shutdown_button_press_time = time.time()
+            self.shutdown_button_press_time = self.robot.clock.time()
         elif self.shutdown_button_press_time != 0 and self.robot.io.button1_state == self.robot.io.ButtonState.RELEASED:
             self.shutdown_button_press_time = 0
-        elif self.shutdown_button_press_time != 0 and time.time() - self.shutdown_button_press_time >= 5:
+        elif self.shutdown_button_press_time != 0 and self.robot.clock.time() - self.shutdown_button_press_time >= 5:
             self.robot.locomotion.stop()
             for i in range(3):
                 self.robot.io.set_led_color(self.robot.io.LedColor.RED)
-                time.sleep(0.5)  # Oh my god ! A "sleep" ! Don't worry baby, we are going to shut down any way.
+                # Oh my god ! A "sleep" ! Don't worry baby, we are going to shut down any way.
+                self.robot.clock.sleep(0.5)
                 self.robot.io.set_led_color(self.robot.io.LedColor.BLACK)
-                time.sleep(0.5)
+                self.robot.clock.sleep(0.5)
             os.system("sudo shutdown -h now")
             exit(0)
         if self.start_time is not None and time_now - self.start_time >= END_MATCH_TIME and self.state.__class__ != StateEnd:
@@ -54,7 +54,7 @@ class FSMMatch(Behavior):
     def start_match(self):
         if __debug__:
             print("[FSMMatch] Match Started")
-        self.start_time = time.time()
+        self.start_time = self.robot.clock.time()
 
 
 class FSMState:
@@ -74,19 +74,20 @@ class StatePreStartChecks(FSMState):
         super().__init__(behavior)
         self.robot.io.change_sensor_read_state(self.robot.io.SensorId.BATTERY_POWER, self.robot.io.SensorState.PERIODIC)
         self.robot.io.change_sensor_read_state(self.robot.io.SensorId.BATTERY_SIGNAL, self.robot.io.SensorState.PERIODIC)
-        self.enter_time = time.time()
+        self.enter_time = self.robot.clock.time()
         self.robot.locomotion.set_direct_speed(0, 0, 0)
 
     def test(self):
         if self.robot.io.battery_power_voltage is not None and self.robot.io.battery_signal_voltage is not None:
-            if (time.time() - self.enter_time) % 13 < 5:
-                if self.robot.io.battery_signal_voltage <= WARNING_VOLTAGE_THRESHOLD and (time.time() - self.enter_time) % 2 < 1:
+            elapsed_time = self.robot.clock.time() - self.enter_time
+            if elapsed_time % 13 < 5:
+                if self.robot.io.battery_signal_voltage <= WARNING_VOLTAGE_THRESHOLD and elapsed_time % 2 < 1:
                     self.robot.io.set_led_color(self.robot.io.LedColor.RED)
                 else:
                     self.robot.io.set_led_color(self.robot.io.LedColor.CYAN)
                 self.robot.io.score_display_number(round(self.robot.io.battery_signal_voltage * 100), with_two_points=True)
-            elif (time.time() - self.enter_time) % 13 < 10:
-                if self.robot.io.battery_power_voltage <= WARNING_VOLTAGE_THRESHOLD and (time.time() - self.enter_time) % 2 < 1:
+            elif elapsed_time % 13 < 10:
+                if self.robot.io.battery_power_voltage <= WARNING_VOLTAGE_THRESHOLD and elapsed_time % 2 < 1:
                     self.robot.io.set_led_color(self.robot.io.LedColor.RED)
                 else:
                     self.robot.io.set_led_color(self.robot.io.LedColor.PURPLE)
@@ -189,16 +190,16 @@ class StateWaterCollectorGreen(FSMState):
 
     def test(self):
         if self.time == 0 and self.robot.locomotion.is_trajectory_finished():
-            self.time = time.time()
+            self.time = self.robot.clock.time()
             self.behavior.score += 10
             self.robot.io.score_display_number(self.behavior.score)
-        if self.time != 0 and (time.time() - self.time) % 4 <= 1:
+        if self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 1:
             self.robot.locomotion.set_direct_speed(-30, 0, 0)
-        elif self.time != 0 and (time.time() - self.time) % 4 <= 2:
+        elif self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 2:
             self.robot.locomotion.set_direct_speed(0, -30, 0)
-        elif self.time != 0 and (time.time() - self.time) % 4 <= 3:
+        elif self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 3:
             self.robot.locomotion.set_direct_speed(30, 0, 0)
-        elif self.time != 0 and (time.time() - self.time) % 4 <= 4:
+        elif self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 4:
             self.robot.locomotion.set_direct_speed(0, 30, 0)
         if self.robot.io.ball_count_green != self.old_count:
             self.behavior.score += 5 * (self.robot.io.ball_count_green - self.old_count)
@@ -206,9 +207,9 @@ class StateWaterCollectorGreen(FSMState):
             print("[FSMMatch] Ball passed : {}".format(self.robot.io.ball_count_green))
             self.old_count = self.robot.io.ball_count_green
         if self.stop_time == 0 and self.robot.io.ball_count_green >= 8:
-            self.stop_time = time.time()
-        if (self.stop_time != 0 and time.time() - self.stop_time > 2) \
-                or (self.time != 0 and time.time() - self.time >= 20):
+            self.stop_time = self.robot.clock.time()
+        if (self.stop_time != 0 and self.robot.clock.time() - self.stop_time > 2) \
+                or (self.time != 0 and self.robot.clock.time() - self.time >= 20):
             return StateSwitchTrajectory
 
     def deinit(self):
@@ -235,16 +236,16 @@ class StateWaterCollectorOrange(FSMState):
 
     def test(self):
         if self.time == 0 and self.robot.locomotion.is_trajectory_finished():
-            self.time = time.time()
+            self.time = self.robot.clock.time()
             self.behavior.score += 10
             self.robot.io.score_display_number(self.behavior.score)
-        if self.time != 0 and (time.time() - self.time) % 4 <= 1:
+        if self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 1:
             self.robot.locomotion.set_direct_speed(30, 0, 0)
-        elif self.time != 0 and (time.time() - self.time) % 4 <= 2:
+        elif self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 2:
             self.robot.locomotion.set_direct_speed(0, 30, 0)
-        elif self.time != 0 and (time.time() - self.time) % 4 <= 3:
+        elif self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 3:
             self.robot.locomotion.set_direct_speed(-30, 0, 0)
-        elif self.time != 0 and (time.time() - self.time) % 4 <= 4:
+        elif self.time != 0 and (self.robot.clock.time() - self.time) % 4 <= 4:
             self.robot.locomotion.set_direct_speed(0, -30, 0)
         if self.robot.io.ball_count_orange != self.old_count:
             self.behavior.score += 5 * (self.robot.io.ball_count_orange - self.old_count)
@@ -252,9 +253,9 @@ class StateWaterCollectorOrange(FSMState):
             print("[FSMMatch] Ball passed : {}".format(self.robot.io.ball_count_orange))
             self.old_count = self.robot.io.ball_count_orange
         if self.stop_time == 0 and self.robot.io.ball_count_orange >= 8:
-            self.stop_time = time.time()
-        if (self.stop_time != 0 and time.time() - self.stop_time > 2) \
-                or (self.time != 0 and time.time() - self.time >= 20):
+            self.stop_time = self.robot.clock.time()
+        if (self.stop_time != 0 and self.robot.clock.time() - self.stop_time > 2) \
+                or (self.time != 0 and self.robot.clock.time() - self.time >= 20):
             return StateSwitchTrajectory
 
     def deinit(self):
@@ -294,14 +295,14 @@ class StateSwitchTrajectory(FSMState):
 class StateRepositioningXPreSwitch(FSMState):
     def __init__(self, behavior):
         super().__init__(behavior)
-        self.repos_start_time = time.time()
+        self.repos_start_time = self.robot.clock.time()
         if self.behavior.color == Color.GREEN:
             self.robot.locomotion.start_repositionning(30, 0, 0, (1130, None), -math.pi / 2)
         else:
             self.robot.locomotion.start_repositionning(-30, 0, 0, (1870, None), -math.pi / 2)
 
     def test(self):
-        if self.robot.locomotion.is_repositioning_ended or time.time() - self.repos_start_time >= 15:
+        if self.robot.locomotion.is_repositioning_ended or self.robot.clock.time() - self.repos_start_time >= 15:
             if self.behavior.color == Color.GREEN:
                 self.robot.locomotion.go_to_orient(1130, 1960, -math.pi / 2)
             else:
@@ -337,7 +338,7 @@ class StateRepositioningYPostSwitch(FSMState):
 
     def test(self):
         if self.repos_start_time == 0 and self.robot.locomotion.is_trajectory_finished():
-            self.repos_start_time = time.time()
+            self.repos_start_time = self.robot.clock.time()
             print("Start repositionning")
             if self.behavior.color == Color.GREEN:
                 self.robot.locomotion.start_repositionning(0, -30, 0, (None, 1650), math.pi)
@@ -345,7 +346,7 @@ class StateRepositioningYPostSwitch(FSMState):
                 self.robot.locomotion.start_repositionning(0, -30, 0, (None, 1650), 0.)
 
         if self.repos_start_time != 0 and (self.robot.locomotion.is_repositioning_ended
-                                           or time.time() - self.repos_start_time >= 15):
+                                           or self.robot.clock.time() - self.repos_start_time >= 15):
             return StateBeeTrajectory
 
     def deinit(self):
@@ -373,14 +374,14 @@ class StateBeeTrajectory(FSMState):
 class StateRepositioningPreBee(FSMState):
     def __init__(self, behavior):
         super().__init__(behavior)
-        self.repos_start_time = time.time()
+        self.repos_start_time = self.robot.clock.time()
         if self.behavior.color == Color.GREEN:
             self.robot.locomotion.start_repositionning(-30, 0, 0, (610, None), math.pi/2)
         else:
             self.robot.locomotion.start_repositionning(30, 0, 0, (2390, None), math.pi/2)
 
     def test(self):
-        if self.robot.locomotion.is_repositioning_ended or time.time() - self.repos_start_time >= 15:
+        if self.robot.locomotion.is_repositioning_ended or self.robot.clock.time() - self.repos_start_time >= 15:
             return StateBeeTrajectory2
 
     def deinit(self):
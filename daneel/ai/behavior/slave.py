@@ -2,7 +2,6 @@ import math
 
 import ivy_robot
 from behavior import Behavior
-import time
 
 DIRECT_SPEED_COMMAND_LINEAR_VALUE = 100.0  # mm/s
 DIRECT_SPEED_COMMAND_ROTATION_VALUE = 1.0  # rad/s
@@ -36,7 +35,7 @@ class Slave(Behavior):
             else:
                 self.robot.io.score_display_fat()
                 self.robot.io.set_led_color(self.robot.io.LedColor.BLACK)
-            self._voltage_toggle_time = time.time()
+            self._voltage_toggle_time = self.robot.clock.time()
 
     def go_to_orient(self, agent, *arg):
         x, y, theta = arg[0].split(",")
@@ -0,0 +1,3 @@
+"""
+Benchmarks of the ai code. Run them from the ai directory, eg. : python3 -m benchmarks.codec_benchmark
+"""
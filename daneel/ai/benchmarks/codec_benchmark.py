@@ -0,0 +1,89 @@
+"""
+Compares the encode / decode throughput of the bitstring message definitions with the struct codec
+(communication/codec.py) on the frames of the control loop.
+
+Usage (from the ai directory) : python3 -m benchmarks.codec_benchmark [-n NUMBER]
+"""
+
+import argparse
+import timeit
+
+from communication.message_definition import *
+from communication.codec import pack_down, pack_speed_command, pack_message_down, pack_up, unpack_up, \
+    unpack_up_event
+
+
+def bitstring_speed_command():
+    msg = sMessageDown()
+    msg.down_id = 42
+    msg.type = eTypeDown.SPEED_COMMAND
+    msg.data = sSpeedCommand()
+    msg.data.vx = 123.4
+    msg.data.vy = -56.7
+    msg.data.vtheta = 0.35
+    return msg.serialize().tobytes()
+
+
+def bitstring_odometry_ack():
+    ack = sMessageDown()
+    ack.down_id = 42
+    ack.type = eTypeDown.ACK_ODOM_REPORT
+    ack.data = sAckOdomReport()
+    ack.data.ack_up_id = 12
+    ack.data.ack_odom_report_id = 200
+    return ack.serialize().tobytes()
+
+
+def bitstring_decode(packed):
+    msg = sMessageUp()
+    msg.deserialize(packed)
+    return msg
+
+
+def main():
+    parser = argparse.ArgumentParser("Codec benchmark")
+    parser.add_argument('-n', '--number', type=int, default=20000, help="Number of frames per measure")
+    args = parser.parse_args()
+
+    buffer = bytearray(DOWN_MESSAGE_SIZE)
+    odom_report = bytearray(UP_MESSAGE_SIZE)
+    pack_up(odom_report, 0, 7, eTypeUp.ODOM_REPORT.value, 3, 4, 32778, 32700, 32900)
+    odom_report = bytes(odom_report)
+
+    # Both paths must produce the same frames before comparing them.
+    pack_speed_command(buffer, 0, 42, 123.4, -56.7, 0.35)
+    assert bytes(buffer) == bitstring_speed_command()
+    pack_down(buffer, 0, 42, eTypeDown.ACK_ODOM_REPORT.value, 12, 200)
+    assert bytes(buffer) == bitstring_odometry_ack()
+    assert unpack_up(odom_report).data.dtheta == bitstring_decode(odom_report).data.dtheta
+    assert unpack_up_event(odom_report).dtheta == bitstring_decode(odom_report).data.dtheta
+
+    msg = sMessageDown()
+    msg.down_id = 42
+    msg.type = eTypeDown.SPEED_COMMAND
+    msg.data = sSpeedCommand()
+    msg.data.vx = 123.4
+    msg.data.vy = -56.7
+    msg.data.vtheta = 0.35
+
+    cases = [
+        ("speed command encode", bitstring_speed_command,
+         lambda: pack_speed_command(buffer, 0, 42, 123.4, -56.7, 0.35)),
+        ("sMessageDown encode", lambda: msg.serialize().tobytes(),
+         lambda: pack_message_down(buffer, 0, msg)),
+        ("odometry ack encode", bitstring_odometry_ack,
+         lambda: pack_down(buffer, 0, 42, eTypeDown.ACK_ODOM_REPORT.value, 12, 200)),
+        ("odometry report decode", lambda: bitstring_decode(odom_report),
+         lambda: unpack_up(odom_report)),
+        ("odometry report event", lambda: bitstring_decode(odom_report).data.dtheta,
+         lambda: unpack_up_event(odom_report).dtheta),
+    ]
+    print("{:<24}{:>16}{:>16}{:>10}".format("frame", "bitstring (/s)", "struct (/s)", "speedup"))
+    for name, legacy, codec in cases:
+        legacy_rate = args.number / min(timeit.repeat(legacy, number=args.number, repeat=3))
+        codec_rate = args.number / min(timeit.repeat(codec, number=args.number, repeat=3))
+        print("{:<24}{:>16.0f}{:>16.0f}{:>9.1f}x".format(name, legacy_rate, codec_rate, codec_rate / legacy_rate))
+
+
+if __name__ == '__main__':
+    main()
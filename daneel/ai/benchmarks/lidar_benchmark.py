@@ -0,0 +1,195 @@
+"""
+Compares the CPU time per revolution of the lidar readers on recorded byte streams: the byte by byte reader of the
+previous driver (one read and one sleep per byte while looking for a packet, lists and LidarPoint objects per packet)
+and drivers.neato_xv11_lidar.PacketStream (chunks, bytearray.find, NumPy decoding).
+
+A stream is a recording of the lidar (see robot.py --lidar_record) or a raw dump of its serial (eg.
+cat /dev/ttyUSB0 > lidar.bin), or a synthetic one with corrupted packets and garbage when no file is given. The
+streams are read from memory: the flushInput of the previous reader (which dropped data on the robot) does nothing
+here, both readers see all the bytes.
+
+Usage (from the ai directory) : python3 -m benchmarks.lidar_benchmark [-f FILE]... [-r REVOLUTIONS] [-c CHUNK]
+"""
+
+import argparse
+import random
+import time
+
+from drivers.neato_xv11_lidar import LidarPoint, PacketStream, checksum, read_recording, PACKET_SIZE, START_BYTE, \
+    FIRST_INDEX, PACKETS_PER_REVOLUTION, PACKETS_PER_READ, AZIMUT_COUNT, RECORDING_MAGIC
+
+
+class EndOfStream(BaseException):
+    """
+    Stops the readers, which print and ignore the Exceptions.
+    """
+
+
+class ReplaySerial:
+    """
+    The part of serial.Serial used by the readers, reading a stream from memory.
+    """
+    def __init__(self, data, chunk_size):
+        self._data = data
+        self._position = 0
+        self._chunk_size = chunk_size
+
+    @property
+    def in_waiting(self):
+        return min(self._chunk_size, len(self._data) - self._position)
+
+    def read(self, size=1):
+        if self._position >= len(self._data):
+            raise EndOfStream()
+        data = self._data[self._position:self._position + size]
+        self._position += size
+        return data
+
+    def flushInput(self):
+        pass
+
+
+def legacy_read(lidar_serial, lidar_points):
+    """
+    The reader of the previous driver (read_v_2_4), writing in lidar_points instead of the global list.
+    """
+    init_level = 0
+    index = 0
+    cycle = 0
+    while True:
+        try:
+            time.sleep(0.00001)
+            if init_level == 0:
+                b = lidar_serial.read(1)
+                if b == bytes([0xFA]):
+                    init_level = 1
+                else:
+                    init_level = 0
+            elif init_level == 1:
+                b = lidar_serial.read(1)
+                if bytes([0xA0]) <= b <= bytes([0xF9]):
+                    index = int.from_bytes(b, byteorder='big') - 0xA0
+                    init_level = 2
+                elif b != bytes([0xFA]):
+                    init_level = 0
+            elif init_level == 2:
+                b_speed = [b for b in lidar_serial.read(2)]
+                b_data0 = [b for b in lidar_serial.read(4)]
+                b_data1 = [b for b in lidar_serial.read(4)]
+                b_data2 = [b for b in lidar_serial.read(4)]
+                b_data3 = [b for b in lidar_serial.read(4)]
+                all_data = [0xFA, index + 0xA0] + b_speed + b_data0 + b_data1 + b_data2 + b_data3
+                b_checksum = [b for b in lidar_serial.read(2)]
+                incoming_checksum = int(b_checksum[0]) + (int(b_checksum[1]) << 8)
+                if checksum(all_data) == incoming_checksum:
+                    lidar_points[index * 4 + 0] = legacy_point(index * 4 + 0, b_data0)
+                    lidar_points[index * 4 + 1] = legacy_point(index * 4 + 1, b_data1)
+                    lidar_points[index * 4 + 2] = legacy_point(index * 4 + 2, b_data2)
+                    lidar_points[index * 4 + 3] = legacy_point(index * 4 + 3, b_data3)
+                    if index == int(359 / 4):
+                        cycle = (cycle + 1) % 2
+                        if cycle == 0:
+                            lidar_serial.flushInput()
+                init_level = 0
+            else:
+                init_level = 0
+        except Exception as err:
+            print(err)
+
+
+def legacy_point(angle, data):
+    x = data[0]
+    x1 = data[1]
+    x2 = data[2]
+    x3 = data[3]
+    dist_mm = x | ((x1 & 0x3f) << 8)
+    quality = x2 | (x3 << 8)
+    return LidarPoint(angle, dist_mm, quality, not (x1 & 0x80), bool(x1 & 0x40), 0)
+
+
+def synthetic_stream(revolutions, seed=0, corruption=0.02, garbage=0.02):
+    """
+    :param corruption: Probability for a packet to have a bit flipped.
+    :param garbage: Probability to insert random bytes after a packet.
+    :return: The bytes of the lidar for revolutions revolutions.
+    :rtype: bytes
+    """
+    rng = random.Random(seed)
+    impairments = random.Random(seed + 1)  # the same points whatever the impairments
+    stream = bytearray()
+    for _ in range(revolutions):
+        for index in range(PACKETS_PER_REVOLUTION):
+            packet = [START_BYTE, FIRST_INDEX + index, 0x2C, 0x4B]  # 300 rpm
+            for _ in range(4):
+                distance, quality = rng.randrange(150, 4000), rng.randrange(2000)
+                flags = 0x80 if rng.random() < 0.05 else (0x40 if rng.random() < 0.02 else 0)
+                packet += [distance & 0xFF, distance >> 8 | flags, quality & 0xFF, quality >> 8]
+            value = checksum(packet)
+            packet += [value & 0xFF, value >> 8]
+            if impairments.random() < corruption:
+                packet[impairments.randrange(4, PACKET_SIZE)] ^= 1 << impairments.randrange(8)
+            stream += bytes(packet)
+            if impairments.random() < garbage:
+                stream += bytes(impairments.randrange(256) for _ in range(impairments.randrange(1, PACKET_SIZE)))
+    return bytes(stream)
+
+
+def run_legacy(stream, chunk_size):
+    lidar_points = [None] * AZIMUT_COUNT
+    start = time.process_time()
+    try:
+        legacy_read(ReplaySerial(stream, chunk_size), lidar_points)
+    except EndOfStream:
+        pass
+    return time.process_time() - start, lidar_points
+
+
+def run_packet_stream(stream, chunk_size):
+    packet_stream = PacketStream()
+    serial = ReplaySerial(stream, chunk_size)
+    start = time.process_time()
+    try:
+        while True:
+            packet_stream.feed(serial.read(max(PACKETS_PER_READ * PACKET_SIZE, serial.in_waiting)))
+    except EndOfStream:
+        pass
+    return time.process_time() - start, packet_stream.pending.points(), packet_stream
+
+
+def main():
+    parser = argparse.ArgumentParser("Lidar reader benchmark")
+    parser.add_argument('-f', '--file', type=str, action='append',
+                        help="Recording of the lidar or raw dump of its serial (can be repeated, default : a synthetic "
+                             "stream).")
+    parser.add_argument('-r', '--revolutions', type=int, default=50, help="Revolutions of the synthetic stream.")
+    parser.add_argument('-c', '--chunk', type=int, default=PACKETS_PER_READ * PACKET_SIZE,
+                        help="Bytes waiting on the serial at each read.")
+    args = parser.parse_args()
+
+    streams = []
+    for path in args.file or []:
+        with open(path, 'rb') as f:
+            stream = f.read()
+        if stream.startswith(RECORDING_MAGIC):
+            stream = b''.join(data for _, data in read_recording(path)[1])
+        streams.append((path, stream))
+    if not streams:
+        streams.append(("synthetic", synthetic_stream(args.revolutions)))
+
+    print("{:<20}{:>10}{:>10}{:>10}{:>18}{:>18}{:>10}".format(
+        "stream", "bytes", "packets", "dropped", "legacy (ms/rev)", "stream (ms/rev)", "speedup"))
+    for name, stream in streams:
+        legacy_time, legacy_points = run_legacy(stream, args.chunk)
+        stream_time, stream_points, packet_stream = run_packet_stream(stream, args.chunk)
+        same = all((a is None) == (b is None) and (a is None or (a.distance, a.quality, a.valid, a.warning) ==
+                                                   (b.distance, b.quality, b.valid, b.warning))
+                   for a, b in zip(legacy_points, stream_points))
+        revolutions = max(packet_stream.valid_packets / PACKETS_PER_REVOLUTION, 1)
+        print("{:<20}{:>10}{:>10}{:>10}{:>18.3f}{:>18.3f}{:>9.1f}x{}".format(
+            name[-20:], len(stream), packet_stream.valid_packets, packet_stream.dropped_bytes,
+            1000 * legacy_time / revolutions, 1000 * stream_time / revolutions, legacy_time / max(stream_time, 1e-9),
+            "" if same else "  (different last points !)"))
+
+
+if __name__ == '__main__':
+    main()
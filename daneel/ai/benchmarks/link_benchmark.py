@@ -0,0 +1,328 @@
+"""
+Throughput and robustness of the serial link : drives a Communication against a scripted Teensy (an emulator of
+communication/teensy_emulator.py, whose up stream is completed by a script once the raspi has reset it) on a pty,
+and measures:
+
+* speed_commands : speed commands acknowledged per second, with a new async command on every loop,
+* odom_ingestion : ODOM_REPORT handled (callback called) per second, the peer sending as fast as the pty takes them,
+* ack_rtt : round trip time of the blocking sends,
+* recovery : time until a message is decoded again after garbage or lost bytes in the up stream.
+
+With --compare, every scenario runs on both transports (serial read by check_message, or by the reader thread).
+The link uses the protocol given by --protocol (negotiated by the RESET, the scripts follow it), and acknowledges
+the up messages one by one or, with --cumulative_acks, all the messages read together with a single frame.
+The codecs are compared by benchmarks/codec_benchmark.py. The results can be appended to a JSON lines file, with
+the current commit, and compared with a previous run of this file (eg. of the other protocol).
+
+Usage (from the ai directory) : python3 -m benchmarks.link_benchmark [-d DURATION] [--compare] [-p PROTOCOL]
+[--cumulative_acks] [-o FILE] [-b FILE]
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import select
+import subprocess
+import time
+
+from communication import Communication
+from communication.codec import UP_PACKERS
+from communication.message_definition import eTypeUp, eTypeDown, eProtocolVersion, UP_MESSAGE_SIZE, \
+    COBS_UP_MESSAGE_MAX_SIZE, LINEAR_ODOM_TO_MSG_ADDER
+from communication.teensy_emulator import TeensyEmulator, open_pty
+
+SCENARIOS = ('speed_commands', 'odom_ingestion', 'ack_rtt', 'recovery')
+TRANSPORTS = {'check_message': False, 'reader_thread': True}  # name : reader_thread
+PEER_PERIOD = 0.001  # s, maximum time between two loops of the peer
+PEER_BUFFER = 64 * UP_MESSAGE_SIZE  # bytes, the script adds frames while less than this is waiting to be written
+RECOVERY_FRAME_PERIOD = 0.001  # s, period of the frames sent by the recovery script
+INJECTION_PERIOD = 0.05  # s, period of the impairments injected by the recovery script
+ACK_RTT_SENDS = 1000  # blocking sends timed by ack_rtt (at most, in the duration)
+
+
+class FloodScript:
+    """
+    Fills the up stream with odometry reports.
+    """
+    def __init__(self, pipe, protocol):
+        self._report_id = 0
+        self._up_id = 0
+        self._pack = UP_PACKERS[protocol]
+        self._frame = bytearray(max(UP_MESSAGE_SIZE, COBS_UP_MESSAGE_MAX_SIZE))
+
+    def __call__(self, pending, now):
+        while len(pending) < PEER_BUFFER:
+            previous, self._report_id = self._report_id, (self._report_id + 1) % 256
+            size = self._pack(self._frame, 0, self._up_id, eTypeUp.ODOM_REPORT.value, previous, self._report_id,
+                              LINEAR_ODOM_TO_MSG_ADDER + 1, LINEAR_ODOM_TO_MSG_ADDER, 32768)
+            self._up_id = (self._up_id + 1) % 256
+            pending.extend(self._frame[:size])
+
+
+class RecoveryScript:
+    """
+    Sends a SENSOR_VALUE every RECOVERY_FRAME_PERIOD, and every INJECTION_PERIOD either garbage (1 to 2 frames of
+    random bytes) or a frame missing some bytes, alternately. The sensor id of the frames is the number of impairments
+    injected so far, sent with the time of each injection in the pipe.
+    """
+    def __init__(self, pipe, protocol):
+        self._pipe = pipe
+        self._random = random.Random(0)
+        self._phase = 0
+        self._up_id = 0
+        self._sequence = 0
+        self._next_frame = self._next_injection = time.monotonic() + INJECTION_PERIOD
+        self._pack = UP_PACKERS[protocol]
+        self._frame = bytearray(max(UP_MESSAGE_SIZE, COBS_UP_MESSAGE_MAX_SIZE))
+
+    def __call__(self, pending, now):
+        while self._next_frame <= now:
+            if self._next_injection <= self._next_frame:
+                if self._phase % 2 == 0:
+                    pending.extend(self._random.getrandbits(8) for _ in range(
+                        self._random.randint(1, 2 * UP_MESSAGE_SIZE)))
+                else:
+                    size = self._pack_frame()
+                    dropped = self._random.randint(1, size - 1)
+                    pending.extend(self._frame[dropped:size])
+                self._phase = (self._phase + 1) % 256
+                self._pipe.send((self._phase, now))
+                self._next_injection += INJECTION_PERIOD
+            size = self._pack_frame()
+            pending.extend(self._frame[:size])
+            self._next_frame += RECOVERY_FRAME_PERIOD
+
+    def _pack_frame(self):
+        size = self._pack(self._frame, 0, self._up_id, eTypeUp.SENSOR_VALUE.value, self._phase,
+                          self._sequence % 65536)
+        self._up_id = (self._up_id + 1) % 256
+        self._sequence += 1
+        return size
+
+
+SCRIPTS = {'odom_ingestion': FloodScript, 'recovery': RecoveryScript}
+
+
+def serve_peer(master_fd, scenario, pipe):
+    """
+    Runs a Teensy emulator on the master side of a pty, with the script of the scenario (if any) started once the
+    emulator has been reset (in the protocol negotiated by the RESET), until the pty is closed.
+    """
+    os.set_blocking(master_fd, False)
+    pending = bytearray()
+    emulator = TeensyEmulator(pending.extend)
+    emulator.reset(time.monotonic())
+    script = None
+    checked = 0
+    while True:
+        readable, _, _ = select.select([master_fd], [master_fd] if pending else [], [], PEER_PERIOD)
+        now = time.monotonic()
+        if readable:
+            try:
+                data = os.read(master_fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            emulator.receive(data, now)
+        emulator.update(now)
+        if script is None and scenario in SCRIPTS:
+            if any(msg_type == eTypeDown.RESET for _, msg_type, _ in emulator.received[checked:]):
+                script = SCRIPTS[scenario](pipe, emulator.protocol)
+            checked = len(emulator.received)
+        if script is not None and len(pending) < PEER_BUFFER:
+            script(pending, now)
+        if pending:
+            try:
+                del pending[:os.write(master_fd, pending)]
+            except BlockingIOError:
+                pass
+
+
+def start_peer(scenario):
+    """
+    :return: The peer process, the path of the serial to open and the receiving end of the pipe of the script.
+    :rtype: (multiprocessing.Process, str, multiprocessing.connection.Connection)
+    """
+    master_fd, slave_fd, slave_path = open_pty()
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=serve_peer, args=(master_fd, scenario, sender),
+                                                          daemon=True)
+    process.start()
+    os.close(master_fd)
+    os.close(slave_fd)  # the peer keeps its copy, so that the pty is not hung up
+    return process, slave_path, receiver
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+def measure_speed_commands(comm, duration, pipe):
+    loops = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        comm.send_speed_command_async(loops % 200, 0, 0)
+        comm.check_message()
+        loops += 1
+    speed = comm.link_metrics()['down'][eTypeDown.SPEED_COMMAND.name]
+    return {'acked_per_s': speed['acknowledged'] / duration, 'loops_per_s': loops / duration,
+            'superseded': speed['superseded'], 'retries': speed['retries'],
+            'rtt_p50_ms': _ms(speed['rtt']['p50']), 'rtt_p99_ms': _ms(speed['rtt']['p99'])}
+
+
+def measure_odom_ingestion(comm, duration, pipe):
+    count = [0]
+
+    def on_report(*args):
+        count[0] += 1
+    comm.register_callback(eTypeUp.ODOM_REPORT, on_report)
+    comm.check_message()
+    count[0] = 0
+    rx_bytes, tx_bytes, acks_sent = comm.metrics.rx_bytes, comm.metrics.tx_bytes, comm.metrics.acks_sent
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        comm.check_message()
+    elapsed = time.monotonic() - start
+    return {'reports_per_s': count[0] / elapsed, 'rx_bytes_per_s': (comm.metrics.rx_bytes - rx_bytes) / elapsed,
+            'acks_per_s': (comm.metrics.acks_sent - acks_sent) / elapsed,
+            'tx_bytes_per_s': (comm.metrics.tx_bytes - tx_bytes) / elapsed}
+
+
+def measure_ack_rtt(comm, duration, pipe):
+    rtts = []
+    start = time.monotonic()
+    while len(rtts) < ACK_RTT_SENDS and time.monotonic() - start < duration:
+        send_start = time.perf_counter()
+        comm.send_actuator_command(0, len(rtts) % 1024)
+        rtts.append(time.perf_counter() - send_start)
+    rtts.sort()
+    return {'sends_per_s': len(rtts) / (time.monotonic() - start), 'p50_ms': _ms(percentile(rtts, 50)),
+            'p90_ms': _ms(percentile(rtts, 90)), 'p99_ms': _ms(percentile(rtts, 99)), 'max_ms': _ms(rtts[-1])}
+
+
+def measure_recovery(comm, duration, pipe):
+    first_seen = {}  # phase : time of its first message
+    sequences = []
+
+    def on_sensor_value(sensor_id, sensor_value):
+        sequences.append(sensor_value)
+        if sensor_id not in first_seen:
+            first_seen[sensor_id] = time.monotonic()
+    comm.register_callback(eTypeUp.SENSOR_VALUE, on_sensor_value)
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        comm.check_message()
+    injections = []
+    while pipe.poll():
+        injections.append(pipe.recv())
+    recoveries = sorted(first_seen[phase] - injection_time for phase, injection_time in injections[:-1]
+                        if phase in first_seen)
+    lost = (max(sequences) - min(sequences) + 1 - len(set(sequences))) if sequences else 0
+    return {'injections': len(injections) - 1, 'recovered': len(recoveries),
+            'p50_ms': _ms(percentile(recoveries, 50)), 'max_ms': _ms(recoveries[-1] if recoveries else None),
+            'frames_lost': lost, 'desyncs': comm.metrics.desync_count}
+
+
+MEASURES = {'speed_commands': measure_speed_commands, 'odom_ingestion': measure_odom_ingestion,
+            'ack_rtt': measure_ack_rtt, 'recovery': measure_recovery}
+
+
+def run_scenario(scenario, reader_thread, duration, protocol=eProtocolVersion.COBS_CRC16, cumulative_acks=False):
+    process, path, pipe = start_peer(scenario)
+    try:
+        comm = Communication(path, reader_thread=reader_thread, protocol=protocol, cumulative_acks=cumulative_acks)
+        try:
+            return MEASURES[scenario](comm, duration, pipe)
+        finally:
+            comm.close()
+    finally:
+        process.terminate()
+        process.join()
+
+
+def current_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode().strip() + ('+dirty' if dirty.strip() else '')
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    return "{:.3f}".format(value) if isinstance(value, float) and abs(value) < 10 else "{:.0f}".format(value)
+
+
+def main():
+    parser = argparse.ArgumentParser("Serial link benchmark")
+    parser.add_argument('-d', '--duration', type=float, default=3., help="Duration of each scenario (s).")
+    parser.add_argument('-s', '--scenario', type=str, action='append', choices=SCENARIOS,
+                        help="Scenario to run (can be repeated, default : all).")
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help="Run on both transports (check_message and reader thread).")
+    parser.add_argument('--reader_thread', action='store_true', default=False,
+                        help="Use the reader thread transport (without --compare).")
+    parser.add_argument('-p', '--protocol', type=str, default=eProtocolVersion.COBS_CRC16.name,
+                        choices=[p.name for p in eProtocolVersion], help="Protocol requested to the Teensy.")
+    parser.add_argument('--cumulative_acks', action='store_true', default=False,
+                        help="Acknowledge the up messages read together with a single frame.")
+    parser.add_argument('-o', '--output', type=str, default=None, help="JSON lines file to append the results to.")
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+                        help="JSON lines file of previous results : compares with its last run.")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or SCENARIOS
+    protocol = eProtocolVersion[args.protocol]
+    if args.compare:
+        transports = list(TRANSPORTS)
+    else:
+        transports = ['reader_thread' if args.reader_thread else 'check_message']
+    results = {}
+    for transport in transports:
+        for scenario in scenarios:
+            results.setdefault(transport, {})[scenario] = run_scenario(scenario, TRANSPORTS[transport],
+                                                                       args.duration, protocol, args.cumulative_acks)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+        if runs:
+            baseline = runs[-1]['results']
+            print("Baseline : commit {} of {}, protocol {}, cumulative acks {}".format(
+                runs[-1]['commit'], runs[-1]['date'], runs[-1].get('protocol'), runs[-1].get('cumulative_acks')))
+    for transport, transport_results in results.items():
+        print("\n{} (transport : {}, protocol : {}, cumulative acks : {})".format(
+            "-" * 60, transport, protocol.name, args.cumulative_acks))
+        for scenario, measures in transport_results.items():
+            print(scenario)
+            for name, value in measures.items():
+                line = "    {:<16}{:>12}".format(name, _format(value))
+                reference = baseline.get(transport, {}).get(scenario, {}).get(name)
+                if reference is not None and value is not None:
+                    line += "{:>12}  ({:+.1%})".format(_format(reference), (value - reference) / reference
+                                                        if reference else 0)
+                print(line)
+
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'commit': current_commit(), 'date': datetime.datetime.now().isoformat(),
+                                'duration': args.duration, 'protocol': protocol.name,
+                                'cumulative_acks': args.cumulative_acks, 'results': results}) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Time source of the ai. Every module asks the robot clock for the time instead of calling time.time() and
+time.sleep(), so that a match can be run on a virtual time (see simulation.py).
+"""
+
+import time
+
+
+class Clock:
+    """
+    Wall clock (the default, used on the robot).
+    """
+    def time(self):
+        """
+        :return: The current time in seconds.
+        :rtype: float
+        """
+        return time.time()
+
+    def monotonic(self):
+        """
+        :return: The time in seconds of a clock which cannot go backwards, from an undefined origin.
+        :rtype: float
+        """
+        return time.monotonic()
+
+    def sleep(self, duration):
+        """
+        :param duration: Time to wait in seconds.
+        :type duration: float
+        """
+        time.sleep(duration)
+
+
+class SimulatedClock(Clock):
+    """
+    Virtual time, only advanced by sleep() : waiting costs nothing, so a simulation runs as fast as the CPU allows,
+    and two runs with the same inputs give the same result.
+    """
+    def __init__(self, start_time=0.):
+        """
+        :param start_time: The initial time in seconds.
+        :type start_time: float
+        """
+        self._now = start_time
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def sleep(self, duration):
+        if duration > 0:
+            self._now += duration
@@ -3,22 +3,35 @@ Created on 29 July 2012
 @author: Guilhem Buisan
 """
 
+import json
 import threading
 import serial
-import time
 from collections import deque
+from clock import Clock
 from communication.message_definition import *
+from communication.codec import pack_down, message_down_fields, speed_command_fields, DOWN_PACKERS
+from communication.coalescer import SpeedCommandCoalescer, SPEED_COMMAND_KEEP_ALIVE_PERIOD
+from communication.send_window import SendWindow, SendHandle, MessageIdCounter, Priority, SEND_WINDOW_SIZE
+from communication.serial_reader import SerialReader, UpFrameScanner
+from communication.events import UpEvent
+from communication.link_metrics import LinkMetrics
 
 SERIAL_BAUDRATE = 115200
 SERIAL_PATH = "/dev/ttyAMA0"
-SERIAL_SEND_TIMEOUT = 500  # ms
+SERIAL_SEND_TIMEOUT = 500  # ms, time before a non acknowledged message is sent again
+SERIAL_POLL_PERIOD = 0.0005  # s, period at which a blocking send reads the serial while waiting for its ack
+SPEED_COMMAND_MAX_RETRIES = 3  # a speed command is sent on each locomotion loop, no need to insist
+RECENT_IDS_COUNT = 128  # an ACK_DOWN for an id older than the last RECENT_IDS_COUNT taken is considered as garbage
+STOP_SPEED_FIELDS = speed_command_fields(0, 0, 0)  # a speed command with these fields is sent as Priority.SAFETY_STOP
 
 
 class Communication:
     """
     Class handling communication between ai and the Teensy.
     """
-    def __init__(self, serial_path=SERIAL_PATH, baudrate=SERIAL_BAUDRATE):
+    def __init__(self, serial_path=SERIAL_PATH, baudrate=SERIAL_BAUDRATE, send_window_size=SEND_WINDOW_SIZE,
+                 reader_thread=False, speed_keep_alive_period=SPEED_COMMAND_KEEP_ALIVE_PERIOD, clock=None,
+                 serial_port=None, trace_path=None, protocol=eProtocolVersion.LEGACY, cumulative_acks=False):
         """
         ctor of the communication class
 
@@ -26,17 +39,71 @@ class Communication:
         :type serial_path: str
         :param baudrate: The baudrate of UART (must the same as the one on the other board)
         :type baudrate: int
+        :param send_window_size: Maximum number of down messages waiting for their acknowledgement at the same time
+            (1 for stop-and-wait).
+        :type send_window_size: int
+        :param reader_thread: If True, the serial is read by a dedicated thread (acknowledgements and
+            retransmissions are handled there, check_message only calls the callbacks). Otherwise it is read by
+            check_message and the blocking sends.
+        :type reader_thread: bool
+        :param speed_keep_alive_period: Maximum time (in seconds) between two speed commands sent by
+            send_speed_command_async, when the command does not change.
+        :type speed_keep_alive_period: float
+        :param clock: The time source of the retransmissions and waits (default : wall clock).
+        :type clock: Clock
+        :param serial_port: An already opened serial (eg. teensy_emulator.EmulatedSerial), used instead of opening
+            serial_path.
+        :type serial_port: serial.Serial
+        :param trace_path: If given, the frames sent and received are recorded in this file (see start_trace).
+        :type trace_path: str
+        :param protocol: The protocol requested to the Teensy on each reset_soft_teensy. The legacy firmware does not
+            answer the request, and the link stays in eProtocolVersion.LEGACY. The current firmware (base/code) does
+            not support COBS_CRC16 : requesting it is only for the emulator (see teensy_emulator) and the firmwares
+            supporting it.
+        :type protocol: eProtocolVersion
+        :param cumulative_acks: If True, the up messages processed together (read by one check_message or blocking
+            send poll, or by one read of the reader thread) are acknowledged by a single frame : an ACK_ODOM_REPORT
+            with the id of the last one and the last odometry report id, or an ACK_UP if there is no odometry report.
+            Otherwise each up message is acknowledged by its own frame.
+        :type cumulative_acks: bool
         """
-        self._serial_port = serial.Serial(serial_path, baudrate)
-        self._current_msg_id = 0  # type: int
-        self._mailbox = deque()
+        self.clock = Clock() if clock is None else clock
+        self._serial_port = serial.Serial(serial_path, baudrate) if serial_port is None else serial_port
+        self._msg_ids = MessageIdCounter()
+        self._mailbox = deque()  # up messages waiting for their callbacks (appended by the reader thread if any)
         self.mock_communication = False  # Set to True if Serial is not plugged to the Teensy
-        self._callbacks = {msg_type: [] for msg_type in eTypeUp}
-        self._serial_lock = threading.Lock()
+        # Dispatch table indexed by the eTypeUp value: (callbacks taking the arguments, callbacks taking the event)
+        self._callbacks = tuple(([], []) for _ in range(len(eTypeUp)))
+        self._serial_lock = threading.Lock()  # held while reading / writing the serial and updating the send window
+        self.requested_protocol = protocol
+        self.cumulative_acks = cumulative_acks
+        self.protocol = eProtocolVersion.LEGACY  # protocol of the link, negotiated by reset_soft_teensy
+        self._pack_down = pack_down
+        self._ack_buffer = bytearray(max(DOWN_MESSAGE_SIZE, COBS_DOWN_MESSAGE_MAX_SIZE))  # reused for every ack frame
+        self._ack_view = memoryview(self._ack_buffer)
+        self.metrics = LinkMetrics(baudrate, self.clock.time())
+        self._recorder = None  # type: communication.wire_trace.TraceRecorder
+        self._send_window = SendWindow(self._msg_ids, self._write, send_window_size,
+                                       SERIAL_SEND_TIMEOUT / 1000, self.metrics)
+        self._speed_coalescer = SpeedCommandCoalescer(speed_keep_alive_period)
+        # Synchronisation changes seen by the scanner (maybe from the reader thread, without the serial lock), given
+        # to the metrics with the next messages
+        self._sync_changes = deque()
+        self._received_bytes = 0  # bytes received by the scanner already counted in the metrics
+        self._scanner = UpFrameScanner(is_expected_ack=self._is_recent_id, on_sync_change=self._on_sync_change)
+        self._reader = None  # type: SerialReader
+        if reader_thread:
+            self._reader = SerialReader(self._serial_port, self._on_reader_messages, self._is_recent_id,
+                                        self._on_sync_change)
+            self._scanner = self._reader.scanner
+        if trace_path is not None:
+            self.start_trace(trace_path)
+        if self._reader is not None:
+            self._reader.start()
         self.reset_soft_teensy()
         self.eTypeUp = eTypeUp  # For exposure purposes
 
-    def register_callback(self, message_type, callback):
+    def register_callback(self, message_type, callback, event=False):
         """
         Use this function to register a function which will be called when a certain message type will
         be received from the Teensy.
@@ -51,14 +118,19 @@ class Communication:
         SENSOR_VALUE (sensor_id, sensor_value) -> void
         ============ =============
 
+        With event=True, the callback is called with the event only (see communication.events, eg.
+        OdomReportEvent), whose fields are converted when read.
+
         :param message_type: The type of the message, which, when received, will trigger the callback.
         :type message_type: eTypeUp
         :param callback: Function which will be called.
         :type callback: function
+        :param event: If True, the callback takes the event instead of the arguments above.
+        :type event: bool
         """
-        if message_type not in self._callbacks:
+        if not isinstance(message_type, eTypeUp) or message_type == eTypeUp.ACK_DOWN:
             return
-        self._callbacks[message_type].append(callback)
+        self._callbacks[message_type.value][1 if event else 0].append(callback)
 
     def send_speed_command(self, vx, vy, vtheta, max_retries=1000):
         """
@@ -85,6 +157,33 @@ class Communication:
         msg.data.vtheta = vtheta
         return self.send_message(msg, max_retries)
 
+    def send_speed_command_async(self, vx, vy, vtheta, max_retries=SPEED_COMMAND_MAX_RETRIES):
+        """
+        Non blocking version of send_speed_command (see send_message_async), meant to be called on each loop.
+        The command is only sent if its value over the wire changed, if the previous one failed or every
+        speed_keep_alive_period. A speed command still waiting in the send window is superseded by the newer one.
+        A null speed (a stop) is sent with Priority.SAFETY_STOP, the others with Priority.MOTION.
+
+        :param vx: speed along the table x axis.
+        :type vx: float
+        :param vy: speed along the table y axis.
+        :type vy: float
+        :param vtheta: rotation speed (direct with z ascending)
+        :type vtheta: float
+        :param max_retries: number of times to retry if the sending fails (default = SPEED_COMMAND_MAX_RETRIES)
+        :type max_retries: int
+        :return: The completion handle of the command (of the last command sent if this one is not sent)
+        :rtype: SendHandle
+        """
+        fields = speed_command_fields(vx, vy, vtheta)
+        now = self.clock.time()
+        if not self._speed_coalescer.needs_sending(fields, now):
+            return self._speed_coalescer.handle
+        priority = Priority.SAFETY_STOP if fields == STOP_SPEED_FIELDS else Priority.MOTION
+        handle = self._submit(eTypeDown.SPEED_COMMAND, fields, max_retries, priority)
+        self._speed_coalescer.sent(fields, handle, now)
+        return handle
+
     def send_hmi_command(self, red_led_cmd, green_led_cmd, blue_led_cmd, max_retries=1000):
         """
         /!\\ Blocking command (try to send the message until it has been received or max_retries)
@@ -101,14 +200,24 @@ class Communication:
         :return: 0 if message has been sent, -1 if max retries has been reached
         :rtype: int
         """
+        return self.send_hmi_command_async(red_led_cmd, green_led_cmd, blue_led_cmd, max_retries).wait()
+
+    def send_hmi_command_async(self, red_led_cmd, green_led_cmd, blue_led_cmd, max_retries=1000):
+        """
+        Non blocking version of send_hmi_command (see send_message_async). The command is sent with Priority.HMI, and
+        superseded by a newer one if it has not been acknowledged yet.
+
+        :return: The completion handle of the command
+        :rtype: SendHandle
+        """
         msg = sMessageDown()
         msg.type = eTypeDown.HMI_COMMAND
         msg.data = sHMICommand()
         msg.data.hmi_command = (red_led_cmd & 0b11100000) | (green_led_cmd >> 3 & 0b00011100) | (blue_led_cmd >> 6
                                                                                                  & 0b00000011)
-        return self.send_message(msg, max_retries)
+        return self.send_message_async(msg, max_retries)
 
-    def send_actuator_command(self, actuator_id, actuator_value, max_retries=1000):
+    def send_actuator_command(self, actuator_id, actuator_value, max_retries=1000, priority=Priority.ACTUATOR):
         """
         Send an actuator command to the Teensy.
 
@@ -119,15 +228,32 @@ class Communication:
         :type actuator_value: int
         :param max_retries: number of times to retry if the sending fails (default = 1000)
         :type max_retries: int
+        :param priority: The priority class of the command (eg. Priority.HMI for the score display)
+        :type priority: Priority
         :return: 0 if the message is sent, -1 if max_retries has been reached
         :rtype: int
         """
+        return self.send_actuator_command_async(actuator_id, actuator_value, max_retries, priority).wait()
+
+    def send_actuator_command_async(self, actuator_id, actuator_value, max_retries=1000, priority=Priority.ACTUATOR,
+                                    supersedable=False):
+        """
+        Non blocking version of send_actuator_command (see send_message_async).
+
+        :param supersedable: If True, the command is superseded by a newer supersedable command of the same actuator
+            if it has not been acknowledged yet (eg. the score display, whose last value is the only one which counts).
+        :type supersedable: bool
+
+        :return: The completion handle of the command
+        :rtype: SendHandle
+        """
         msg = sMessageDown()
         msg.type = eTypeDown.ACTUATOR_COMMAND
         msg.data = sActuatorCommand()
         msg.data.actuator_id = actuator_id
         msg.data.actuator_command = actuator_value
-        return self.send_message(msg, max_retries)
+        supersede_key = (eTypeDown.ACTUATOR_COMMAND.value, actuator_id) if supersedable else None
+        return self._submit(msg.type, message_down_fields(msg), max_retries, priority, supersede_key)
 
     def send_sensor_command(self, sensor_id, command_state, max_retries=1000):
         """
@@ -155,6 +281,10 @@ class Communication:
         """
         Send a reset order to the Teensy. This message will be accepted by the Teensy whatever the id (so even
         after a desynchronisation between Teensy and ai, eg. when the ai reboots and not the Teensy)
+        The RESET is sent in the legacy protocol and requests requested_protocol : a Teensy supporting it switches to
+        it after the acknowledgement of the RESET (see UpFrameScanner.negotiating), the legacy firmware ignores it.
+        A Teensy using the COBS protocol still recognises a legacy RESET (its zero padding never appears in a COBS
+        stream).
 
         :param max_retries: number of times to retry if the sending fails (default = 1000)
         :type max_retries: int
@@ -164,15 +294,33 @@ class Communication:
         if self.mock_communication:
             print("[Communication] Warning : Teensy communication mocked !")
             return 0
+        if self._recorder is not None:
+            self._recorder.record_reset()
         msg = sMessageDown()
         msg.type = eTypeDown.RESET
+        msg.data = sReset()
+        msg.data.protocol_version = self.requested_protocol.value
         for i in range(100):
-             self._serial_port.read_all()
-             time.sleep(0.01)
+            if self._reader is None:
+                self._serial_port.read_all()
+            self.clock.sleep(0.01)
+        if self._reader is None:
+            self._scanner.clear()
+        else:
+            self._reader.flush()
+        with self._serial_lock:
+            self._set_protocol(eProtocolVersion.LEGACY)
+        self._scanner.negotiating = True
         ret = self.send_message(msg, max_retries)
+        self._scanner.negotiating = False
         if ret == 0:
-            self._current_msg_id = 0
-            self._mailbox = deque()
+            print("[Comm] Teensy reset, protocol {}".format(self.protocol.name))
+            # The ids are not restarted : the Teensy accepts any id after a reset, and the messages received while
+            # waiting for the reset have already been acknowledged with the current ids.
+            with self._serial_lock:
+                self._send_window.reset(self.clock.time())
+            self._speed_coalescer.reset()
+            self._mailbox.clear()
         return ret
 
     def send_theta_repositioning(self, theta, max_retries=1000):
@@ -192,109 +340,236 @@ class Communication:
         msg.data.theta_repositioning = theta
         return self.send_message(msg, max_retries)
 
-    def send_message(self, msg, max_retries=1000):
+    def send_message(self, msg, max_retries=1000, priority=None):
         """
-        Send message via Serial (defined during the instantiation of the class)
+        Send message via Serial (defined during the instantiation of the class) and wait for its acknowledgement.
 
         :param msg: the message to send
         :type msg: sMessageDown
         :param max_retries: the maximum number of resend (on timeout = SERIAL_SEND_TIMEOUT or on NON_ACK) before failing
         :type max_retries: int
+        :param priority: see send_message_async
+        :type priority: Priority
         :return: 0 if the message is sent, -1 if max_retries has been reached
         :rtype: int
         """
+        return self.send_message_async(msg, max_retries, priority).wait()
+
+    def send_message_async(self, msg, max_retries=1000, priority=None):
+        """
+        Give a message to the send window without waiting for its acknowledgement. Up to send_window_size messages
+        are in flight at the same time, the others are queued. The acknowledgements are matched by id when the
+        serial is read (check_message or any blocking send) and the non acknowledged messages are sent again every
+        SERIAL_SEND_TIMEOUT ms. The queued messages are sent by priority class, and the less urgent classes cannot
+        fill the whole window (see send_window.Priority) : a stop is never delayed by the leds or the score display.
+
+        :param msg: the message to send
+        :type msg: sMessageDown
+        :param max_retries: the maximum number of sendings before failing
+        :type max_retries: int
+        :param priority: The priority class of the message (default : send_window.DEFAULT_PRIORITIES of its type).
+        :type priority: Priority
+        :return: The completion handle of the message (handle.result is 0 once acknowledged, -1 on failure)
+        :rtype: SendHandle
+        """
+        return self._submit(msg.type, message_down_fields(msg), max_retries, priority)
+
+    def _submit(self, msg_type, fields, max_retries, priority=None, supersede_key=None):
         if self.mock_communication:
             max_retries = 0
 
-        self._serial_lock.acquire()
-        msg.down_id = self._current_msg_id
-        self._current_msg_id = (self._current_msg_id + 1) % 256
-        serialized = msg.serialize().tobytes()
-        for i in range(max_retries):
-            # print(serialized)
-            self._serial_port.write(serialized)
-            time_sent = int(round(time.time() * 1000))
-            while self._serial_port.in_waiting < UP_MESSAGE_SIZE:
-                if int(round(time.time() * 1000)) - time_sent > SERIAL_SEND_TIMEOUT:
-                    break  # waiting for ack
-            if self._serial_port.in_waiting >= UP_MESSAGE_SIZE:
-                packed = self._serial_port.read(UP_MESSAGE_SIZE)
-                up_msg = sMessageUp()
-                try:
-                    up_msg.deserialize(packed)
-                except DeserializationException as e:
-                    print("[Comm] Message synchronisation lost : Trying to re synchronise")
-                    while not self._serial_port.in_waiting:
-                        time.sleep(0.1)
-                    self._serial_port.read(1)  # Read one byte and retry. Until synchro is ok.
-                    continue
+        handle = SendHandle(msg_type, self._wait_acknowledgement if self._reader is None else None)
+        with self._serial_lock:
+            self._send_window.submit(handle, msg_type.value, fields, max_retries, self.clock.time(), priority,
+                                     supersede_key)
+        return handle
+
+    def _wait_acknowledgement(self, handle, timeout=None):
+        start_time = self.clock.time()
+        while not handle.done:
+            self._read_serial()
+            if handle.done or (timeout is not None and self.clock.time() - start_time >= timeout):
+                break
+            self.clock.sleep(SERIAL_POLL_PERIOD)
+
+    def _read_serial(self):
+        """
+        Reads all the bytes waiting on the serial and processes the complete messages (see _process_up_messages).
+        """
+        with self._serial_lock:
+            waiting = self._serial_port.in_waiting
+            if waiting:
+                self._scanner.read_from(self._serial_port, waiting)
+            self._process_up_messages(self._scanner.frames())
 
+    def _is_recent_id(self, down_id):
+        return (self._msg_ids.next_id - 1 - down_id) % 256 < RECENT_IDS_COUNT
+
+    def _on_reader_messages(self, messages):
+        with self._serial_lock:
+            self._process_up_messages(messages)
+
+    def _process_up_messages(self, messages):
+        """
+        Acknowledgements are given to the send window, the other messages are acknowledged (all at once with
+        cumulative_acks) and stored in the mailbox. Then retransmits the messages whose acknowledgement timed out.
+        The serial lock must be held.
+
+        :param messages: The messages received.
+        :type messages: list[UpEvent]
+        """
+        now = self.clock.time()
+        metrics = self.metrics
+        if self._scanner.received_bytes != self._received_bytes:
+            metrics.read(self._scanner.received_bytes - self._received_bytes, now)
+            self._received_bytes = self._scanner.received_bytes
+        while self._sync_changes:
+            metrics.sync_changed(*self._sync_changes.popleft())
+        last_up_msg = last_odom_report = None
+        for up_msg in messages:
+            metrics.up_message(up_msg.type)
+            if up_msg.type == eTypeUp.ACK_DOWN:
+                if up_msg.protocol_version is not None:
+                    self._set_protocol(up_msg.protocol_version)
+                self._send_window.acknowledge(up_msg.ack_down_id, now)
+                continue
+            if not self.cumulative_acks:
                 self._handle_acknowledgement(up_msg)
-                if up_msg.type == eTypeUp.ACK_DOWN:
-                    self._serial_lock.release()
-                    return 0  # success
-                else:
-                    self._mailbox.append(up_msg)  # if it is not an ACK or a NONACK, store it to deliver later
-        self._serial_lock.release()
-        return -1  # failure
+            else:
+                last_up_msg = up_msg
+                if up_msg.type == eTypeUp.ODOM_REPORT:
+                    last_odom_report = up_msg
+            self._mailbox.append(up_msg)  # if it is not an ACK, store it to deliver later
+        if last_up_msg is not None:
+            self._send_cumulative_acknowledgment(last_up_msg, last_odom_report)
+        self._send_window.service(now)
+
+    def start_trace(self, path):
+        """
+        Records every frame sent and every byte received from now on in a trace file (see communication.wire_trace,
+        which also replays them).
+
+        :param path: The trace file, overwritten if it exists.
+        :type path: str
+        """
+        from communication.wire_trace import TraceRecorder  # not at the top : runnable with python3 -m
+        self.stop_trace()
+        self._recorder = TraceRecorder(path, self.clock.monotonic)
+        self._scanner.on_receive = self._recorder.record_up
+
+    def stop_trace(self):
+        """
+        Stops the recording started by start_trace, and closes the trace file.
+        """
+        if self._recorder is not None:
+            self._scanner.on_receive = None
+            self._recorder.close()
+            self._recorder = None
+
+    def close(self):
+        """
+        Stops the reader thread and the trace recording, and closes the serial.
+        """
+        if self._reader is not None:
+            self._reader.stop()
+            self._reader.join()
+        self.stop_trace()
+        self._serial_port.close()
+
+    def _write(self, frame):
+        if self._recorder is not None:
+            self._recorder.record_down(frame)  # before the answer of the Teensy is recorded by the reader thread
+        self._serial_port.write(frame)
+
+    def _set_protocol(self, protocol):
+        """
+        Packs the next down frames in protocol (the scanner switches by itself). The serial lock must be held.
+        """
+        self.protocol = protocol
+        self._pack_down = self._send_window.pack = DOWN_PACKERS[protocol]
+
+    def _on_sync_change(self, synchronised, dropped_bytes):
+        self._sync_changes.append((synchronised, dropped_bytes, self.clock.time()))
 
     def _send_acknowledgment(self, id_to_acknowledge):
-        ack = sMessageDown()
-        ack.down_id = self._current_msg_id
-        self._current_msg_id = (self._current_msg_id + 1) % 256
-        ack.type = eTypeDown.ACK_UP
-        ack.data = sAckUp()
-        ack.data.ack_up_id = id_to_acknowledge
-        serialized = ack.serialize().tobytes()
-        self._serial_port.write(serialized)
+        size = self._pack_down(self._ack_buffer, 0, self._msg_ids.take(), eTypeDown.ACK_UP.value, id_to_acknowledge)
+        self._write(self._ack_view[:size])
+        self.metrics.acknowledgement_sent(eTypeDown.ACK_UP.value, size, self.clock.time())
 
     def _send_odometry_report_acknowledgment(self, msg_id, odom_id):
-        ack = sMessageDown()
-        ack.down_id = self._current_msg_id
-        self._current_msg_id = (self._current_msg_id + 1) % 256
-        ack.type = eTypeDown.ACK_ODOM_REPORT
-        ack.data = sAckOdomReport()
-        ack.data.ack_up_id = msg_id
-        ack.data.ack_odom_report_id = odom_id
-        serialized = ack.serialize().tobytes()
-        self._serial_port.write(serialized)
+        size = self._pack_down(self._ack_buffer, 0, self._msg_ids.take(), eTypeDown.ACK_ODOM_REPORT.value, msg_id,
+                               odom_id)
+        self._write(self._ack_view[:size])
+        self.metrics.acknowledgement_sent(eTypeDown.ACK_ODOM_REPORT.value, size, self.clock.time())
+
+    def _send_cumulative_acknowledgment(self, last_msg, last_odom_report):
+        """
+        Acknowledges last_msg and all the up messages received before it. The Teensy does not send its up messages
+        again, so the ones missing before last_msg are lost anyway. The odometry reports are cumulated by the Teensy
+        until acknowledged : acknowledging the last one is enough.
+
+        :param last_msg: The last up message received (other than ACK_DOWN).
+        :type last_msg: UpEvent
+        :param last_odom_report: The last odometry report received since the previous acknowledgement, if any.
+        :type last_odom_report: communication.events.OdomReportEvent
+        """
+        if last_odom_report is None:
+            self._send_acknowledgment(last_msg.up_id)
+        else:
+            self._send_odometry_report_acknowledgment(last_msg.up_id, last_odom_report.new_report_id)
 
     def _handle_acknowledgement(self, msg):
         if msg.type == eTypeUp.ACK_DOWN:
             return
         elif msg.type == eTypeUp.ODOM_REPORT:
-            self._send_odometry_report_acknowledgment(msg.up_id, msg.data.new_report_id)
+            self._send_odometry_report_acknowledgment(msg.up_id, msg.new_report_id)
         else:
             self._send_acknowledgment(msg.up_id)
 
-    def check_message(self, max_read=1):
+    def link_metrics(self):
+        """
+        :return: The metrics of the serial link (see LinkMetrics.snapshot), json serializable.
+        :rtype: dict
+        """
+        with self._serial_lock:
+            return self.metrics.snapshot(self.clock.time())
+
+    def dump_metrics(self, path=None):
+        """
+        Prints a summary of the metrics of the serial link, or writes all of them in a json file.
+
+        :param path: The json file to write, None to print the summary.
+        :type path: str
+        """
+        if path is None:
+            with self._serial_lock:
+                print(self.metrics.report(self.clock.time()))
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.link_metrics(), f, indent=2)
+
+    def reset_metrics(self):
+        with self._serial_lock:
+            self.metrics.reset(self.clock.time())
+
+    def check_message(self, max_read=None):
         """
-        Check if there is any incoming message on the Serial (defined during the instantiation of the class)
-        and returns the oldest message.
+        Check if there is any incoming message on the Serial (defined during the instantiation of the class),
+        process the acknowledgements of the messages in flight and handle the messages received, oldest first.
+        With the reader thread, the serial has already been read and only the callbacks are called.
 
-        :return: The oldest message non read
-        :rtype: sMessageUp
+        :param max_read: The maximum number of messages handled (callbacks called) by this call
+            (None : all the messages received so far).
+        :type max_read: int
         """
         if self.mock_communication:
             return
 
-        self._serial_lock.acquire()
-        for i in range(max_read):
-            if self._serial_port.in_waiting >= UP_MESSAGE_SIZE:
-                try:
-                    packed = self._serial_port.read(UP_MESSAGE_SIZE)
-                    up_msg = sMessageUp()
-                    up_msg.deserialize(packed)
-                except DeserializationException as e:
-                    print("[Comm] Message synchronisation lost : Trying to re synchronise")
-                    while not self._serial_port.in_waiting:
-                        time.sleep(0.1)
-                    self._serial_port.read(1)  # Read one byte and retry. Until synchro is ok.
-                    continue
-                self._handle_acknowledgement(up_msg)
-                self._mailbox.append(up_msg)
-        self._serial_lock.release()
+        if self._reader is None:
+            self._read_serial()
 
+        if max_read is None:
+            max_read = len(self._mailbox)
         for i in range(max_read):
             if len(self._mailbox) > 0:
                 msg = self._mailbox.popleft()
@@ -306,25 +581,13 @@ class Communication:
 
         :param message: The message to be handled (containing the type and the arguments to be passed
             to the callback.
-        :type message: sMessageUp
-        """
-        if message.type == eTypeUp.SENSOR_VALUE:
-            for cb in self._callbacks[eTypeUp.SENSOR_VALUE]:
-                cb(message.data.sensor_id, message.data.sensor_value)
-        elif message.type == eTypeUp.HMI_STATE:
-            cord_state = bool(message.data.hmi_state & (1 << 7))
-            button1_state = bool(message.data.hmi_state & (1 << 6))
-            button2_state = bool(message.data.hmi_state & (1 << 5))
-            red_led_state = 255 if bool(message.data.hmi_state & (1 << 4)) else 0
-            green_led_state = 255 if bool(message.data.hmi_state & (1 << 3)) else 0
-            blue_led_state = 255 if bool(message.data.hmi_state & (1 << 2)) else 0
-            for cb in self._callbacks[eTypeUp.HMI_STATE]:
-                cb(cord_state, button1_state, button2_state, red_led_state, green_led_state, blue_led_state)
-        elif message.type == eTypeUp.ODOM_REPORT:
-
-            for cb in self._callbacks[eTypeUp.ODOM_REPORT]:
-                cb(message.data.previous_report_id, message.data.new_report_id, message.data.dx, message.data.dy,
-                   message.data.dtheta)
-        elif message.type == eTypeUp.ACK_DOWN:
-            pass
+        :type message: UpEvent
+        """
+        callbacks, event_callbacks = self._callbacks[message.type_value]
+        if callbacks:
+            args = message.args()
+            for cb in callbacks:
+                cb(*args)
+        for cb in event_callbacks:
+            cb(message)
 
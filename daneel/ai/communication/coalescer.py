@@ -0,0 +1,51 @@
+"""
+Latest-wins coalescing of the speed commands sent on each locomotion loop.
+"""
+
+from communication.send_window import SendHandle
+
+SPEED_COMMAND_KEEP_ALIVE_PERIOD = 0.2  # s, must stay well under base/code/params.h:TIME_SPEED_FAILSAFE (1 s)
+
+
+class SpeedCommandCoalescer:
+    """
+    Decides whether a speed command must be sent: only when its value, as sent over the wire, differs from the last
+    command sent, when the last command failed, or every keep_alive_period to keep the Teensy failsafe quiet.
+    (A newer speed command also supersedes the older one still waiting in the send window.)
+    """
+    def __init__(self, keep_alive_period=SPEED_COMMAND_KEEP_ALIVE_PERIOD):
+        """
+        :param keep_alive_period: Maximum time (in seconds) between two speed commands sent.
+        :type keep_alive_period: float
+        """
+        self.keep_alive_period = keep_alive_period
+        self.handle = None  # type: SendHandle  # handle of the last command sent
+        self.skipped_count = 0  # number of commands not sent because unchanged
+        self._fields = None  # wire value of the last command sent
+        self._send_time = 0
+
+    def needs_sending(self, fields, now):
+        """
+        :param fields: The wire value of the new command (see codec.speed_command_fields).
+        :type fields: tuple
+        :param now: current time in seconds
+        :type now: float
+        :rtype: bool
+        """
+        if fields != self._fields or now - self._send_time >= self.keep_alive_period or self.handle is None \
+                or self.handle.result == SendHandle.FAILED:
+            return True
+        self.skipped_count += 1
+        return False
+
+    def sent(self, fields, handle, now):
+        self._fields = fields
+        self.handle = handle
+        self._send_time = now
+
+    def reset(self):
+        """
+        Forces the next command to be sent (eg. after a reset of the Teensy).
+        """
+        self.handle = None
+        self._fields = None
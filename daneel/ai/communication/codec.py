@@ -0,0 +1,383 @@
+"""
+Precompiled struct based codec for the Teensy wire protocol.
+
+The layouts mirror the packed structures of base/code/communication/Communication.h (little endian, header of
+3 bytes: id, type, checksum, then the payload, zero padded up to the frame size). Every frame layout is compiled
+once in a struct.Struct, and frames are packed into / unpacked from caller provided buffers, so that the hot path
+(speed commands and acknowledgements) does not allocate intermediate bit streams.
+
+The *_cobs functions implement eProtocolVersion.COBS_CRC16 : the same header without the checksum and the payload
+without padding, followed by a CRC-16, COBS encoded and delimited.
+"""
+
+import struct
+
+from communication.message_definition import eTypeUp, eTypeDown, eProtocolVersion, sMessageUp, sAckDown, \
+    sOdomReport, sHMIState, sSensorValue, DeserializationException, UP_MESSAGE_SIZE, UP_HEADER_SIZE, \
+    DOWN_MESSAGE_SIZE, COBS_HEADER_SIZE, CRC_SIZE, COBS_DELIMITER, LINEAR_SPEED_TO_MSG_ADDER, \
+    ANGULAR_SPEED_TO_MSG_FACTOR, ANGULAR_SPEED_TO_MSG_ADDER, cobs_encode, cobs_decode, crc16
+from communication.events import EVENT_CLASSES
+
+DOWN_HEADER_SIZE = 3  # size of the header (all except the data) of a down message
+
+HEADER_STRUCT = struct.Struct('<BBB')  # id, type, checksum (same for up and down messages)
+
+# Payload layouts, indexed by message type value (Communication.h:uMessageUpData and uMessageDownData).
+UP_PAYLOAD_FORMATS = {
+    eTypeUp.ACK_DOWN: 'B',  # sAckDown
+    eTypeUp.ODOM_REPORT: 'BBHHH',  # sOdomReportMsg
+    eTypeUp.HMI_STATE: 'B',  # sHMIStateMsg
+    eTypeUp.SENSOR_VALUE: 'BH',  # sSensorValueMsg
+}
+
+DOWN_PAYLOAD_FORMATS = {
+    eTypeDown.ACK_UP: 'B',  # sAckUp
+    eTypeDown.ACK_ODOM_REPORT: 'BB',  # sAckOdomReport
+    eTypeDown.SPEED_COMMAND: 'HHH',  # sSpeedCmd
+    eTypeDown.ACTUATOR_COMMAND: 'BH',  # sActuatorCmd
+    eTypeDown.HMI_COMMAND: 'B',  # sHMICmd
+    eTypeDown.RESET: 'B',  # sReset (ignored by the legacy firmware, zero in its padding for LEGACY)
+    eTypeDown.THETA_REPOSITIONING: 'H',  # sThetaRepositioning
+    eTypeDown.SENSOR_COMMAND: 'BB',  # sSensorCmd
+}
+
+# Attributes of the message_definition payload classes, in wire order.
+UP_PAYLOAD_FIELDS = {
+    eTypeUp.ACK_DOWN: (sAckDown, ('ack_down_id',)),
+    eTypeUp.ODOM_REPORT: (sOdomReport, ('previous_report_id', 'new_report_id', '_dx', '_dy', '_dtheta')),
+    eTypeUp.HMI_STATE: (sHMIState, ('hmi_state',)),
+    eTypeUp.SENSOR_VALUE: (sSensorValue, ('sensor_id', 'sensor_value')),
+}
+
+DOWN_PAYLOAD_FIELDS = {
+    eTypeDown.ACK_UP: ('ack_up_id',),
+    eTypeDown.ACK_ODOM_REPORT: ('ack_up_id', 'ack_odom_report_id'),
+    eTypeDown.SPEED_COMMAND: ('_vx', '_vy', '_vtheta'),
+    eTypeDown.ACTUATOR_COMMAND: ('actuator_id', 'actuator_command'),
+    eTypeDown.HMI_COMMAND: ('hmi_command',),
+    eTypeDown.RESET: ('protocol_version',),
+    eTypeDown.THETA_REPOSITIONING: ('_theta_repositioning',),
+    eTypeDown.SENSOR_COMMAND: ('sensor_id', 'sensor_state'),
+}
+
+
+def _compile_frames(payload_formats, frame_size):
+    """
+    Compiles, for each message type, the struct of the whole frame (header + payload + zero padding).
+
+    :return: tuple of (frame struct, payload struct) indexed by the message type value.
+    :rtype: tuple[(struct.Struct, struct.Struct)]
+    """
+    structs = [None] * len(payload_formats)
+    for msg_type, payload_format in payload_formats.items():
+        payload = struct.Struct('<' + payload_format)
+        pad = 'x' * (frame_size - HEADER_STRUCT.size - payload.size)
+        structs[msg_type.value] = (struct.Struct('<BBB' + payload_format + pad), payload)
+    return tuple(structs)
+
+
+def _compile_cobs_frames(payload_formats):
+    """
+    Compiles, for each message type, the struct of the frame before its CRC (header without checksum + payload).
+
+    :return: tuple of the frame structs indexed by the message type value.
+    :rtype: tuple[struct.Struct]
+    """
+    structs = [None] * len(payload_formats)
+    for msg_type, payload_format in payload_formats.items():
+        structs[msg_type.value] = struct.Struct('<BB' + payload_format)
+    return tuple(structs)
+
+
+UP_FRAME_STRUCTS = _compile_frames(UP_PAYLOAD_FORMATS, UP_MESSAGE_SIZE)
+DOWN_FRAME_STRUCTS = _compile_frames(DOWN_PAYLOAD_FORMATS, DOWN_MESSAGE_SIZE)
+UP_COBS_STRUCTS = _compile_cobs_frames(UP_PAYLOAD_FORMATS)
+DOWN_COBS_STRUCTS = _compile_cobs_frames(DOWN_PAYLOAD_FORMATS)
+NEGOTIATION_STRUCT = struct.Struct('<BH')  # protocol version and PROTOCOL_ACK_MAGIC, after the id of an ACK_DOWN
+
+_UP_TYPES = tuple(sorted(eTypeUp, key=lambda t: t.value))
+_UP_PAYLOADS = tuple(UP_PAYLOAD_FIELDS[t] for t in _UP_TYPES)
+_UP_EVENT_DECODERS = tuple((EVENT_CLASSES[t.value], UP_FRAME_STRUCTS[t.value][1].unpack_from) for t in _UP_TYPES)
+_DOWN_FIELDS = tuple(DOWN_PAYLOAD_FIELDS[t] for t in sorted(eTypeDown, key=lambda t: t.value))
+_UP_COBS_SIZES = tuple(s.size + CRC_SIZE for s in UP_COBS_STRUCTS)  # decoded frame size, by type value
+_DOWN_COBS_SIZES = tuple(s.size + CRC_SIZE for s in DOWN_COBS_STRUCTS)
+
+_SPEED_COMMAND = eTypeDown.SPEED_COMMAND.value
+_SPEED_COMMAND_FRAME = DOWN_FRAME_STRUCTS[_SPEED_COMMAND][0]
+
+
+def xor_checksum(value):
+    """
+    XOR of all the bytes of a little endian integer of at most 8 bytes (the payload of a frame read
+    with int.from_bytes). Same as base/code/communication/Communication.cpp:computeUpChecksum.
+
+    :param value: The integer holding the payload bytes.
+    :type value: int
+    :return: The checksum (0 - 255)
+    :rtype: int
+    """
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
+
+
+def pack_down(buffer, offset, down_id, type_value, *fields):
+    """
+    Packs a down (raspi -> teensy) frame into buffer, computing its checksum.
+    Unlike sMessageDown.serialize, the checksum is not reduced modulo 0xFF: the Teensy compares it with the plain
+    XOR of the payload, so a payload whose XOR is 0xFF was never accepted.
+
+    :param buffer: Writable buffer of at least offset + DOWN_MESSAGE_SIZE bytes.
+    :type buffer: bytearray|memoryview
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :param down_id: The id of the message (0 - 255).
+    :type down_id: int
+    :param type_value: The value of the eTypeDown of the message.
+    :type type_value: int
+    :param fields: The raw payload fields, as sent over the wire (see DOWN_PAYLOAD_FORMATS).
+    :type fields: int
+    :return: The size of the frame (DOWN_MESSAGE_SIZE).
+    :rtype: int
+    """
+    DOWN_FRAME_STRUCTS[type_value][0].pack_into(buffer, offset, down_id, type_value, 0, *fields)
+    buffer[offset + 2] = xor_checksum(int.from_bytes(buffer[offset + DOWN_HEADER_SIZE:offset + DOWN_MESSAGE_SIZE],
+                                                     'little'))
+    return DOWN_MESSAGE_SIZE
+
+
+def _pack_cobs(frame_struct, buffer, offset, msg_id, type_value, fields):
+    frame = frame_struct.pack(msg_id, type_value, *fields)
+    encoded = cobs_encode(frame + crc16(frame).to_bytes(CRC_SIZE, 'big'))
+    end = offset + len(encoded)
+    buffer[offset:end] = encoded
+    buffer[end] = COBS_DELIMITER
+    return end + 1 - offset
+
+
+def pack_down_cobs(buffer, offset, down_id, type_value, *fields):
+    """
+    Same as pack_down, in the COBS_CRC16 protocol.
+
+    :param buffer: Writable buffer of at least offset + COBS_DOWN_MESSAGE_MAX_SIZE bytes.
+    :type buffer: bytearray|memoryview
+    :return: The size of the frame, with its delimiter.
+    :rtype: int
+    """
+    return _pack_cobs(DOWN_COBS_STRUCTS[type_value], buffer, offset, down_id, type_value, fields)
+
+
+def pack_speed_command(buffer, offset, down_id, vx, vy, vtheta):
+    """
+    Fast path of pack_down for the speed command, converting the speeds the same way as sSpeedCommand
+    (truncated towards zero).
+
+    :param buffer: Writable buffer of at least offset + DOWN_MESSAGE_SIZE bytes.
+    :type buffer: bytearray|memoryview
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :param down_id: The id of the message (0 - 255).
+    :type down_id: int
+    :param vx: speed along the table x axis.
+    :type vx: float
+    :param vy: speed along the table y axis.
+    :type vy: float
+    :param vtheta: rotation speed (direct with z ascending)
+    :type vtheta: float
+    """
+    _SPEED_COMMAND_FRAME.pack_into(buffer, offset, down_id, _SPEED_COMMAND, 0, int(vx + LINEAR_SPEED_TO_MSG_ADDER),
+                                   int(vy + LINEAR_SPEED_TO_MSG_ADDER),
+                                   int((vtheta + ANGULAR_SPEED_TO_MSG_ADDER) * ANGULAR_SPEED_TO_MSG_FACTOR))
+    buffer[offset + 2] = xor_checksum(int.from_bytes(buffer[offset + DOWN_HEADER_SIZE:offset + DOWN_MESSAGE_SIZE],
+                                                     'little'))
+    return DOWN_MESSAGE_SIZE
+
+
+def message_down_fields(msg):
+    """
+    Raw payload fields of a sMessageDown, in wire order (fractional values are truncated as bitstring does).
+
+    :param msg: The message.
+    :type msg: sMessageDown
+    :return: The fields to give to pack_down.
+    :rtype: tuple
+    """
+    data = msg.data
+    return tuple([int(getattr(data, name)) for name in _DOWN_FIELDS[msg.type.value]])
+
+
+def speed_command_fields(vx, vy, vtheta):
+    """
+    Wire value of a speed command, converted the same way as sSpeedCommand (truncated towards zero).
+
+    :param vx: speed along the table x axis.
+    :type vx: float
+    :param vy: speed along the table y axis.
+    :type vy: float
+    :param vtheta: rotation speed (direct with z ascending)
+    :type vtheta: float
+    :return: The fields to give to pack_down.
+    :rtype: (int, int, int)
+    """
+    return (int(vx + LINEAR_SPEED_TO_MSG_ADDER), int(vy + LINEAR_SPEED_TO_MSG_ADDER),
+            int((vtheta + ANGULAR_SPEED_TO_MSG_ADDER) * ANGULAR_SPEED_TO_MSG_FACTOR))
+
+
+def pack_message_down(buffer, offset, msg):
+    """
+    Packs a sMessageDown (with its payload object) into buffer.
+
+    :param buffer: Writable buffer of at least offset + DOWN_MESSAGE_SIZE bytes.
+    :type buffer: bytearray|memoryview
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :param msg: The message to pack.
+    :type msg: sMessageDown
+    :return: The size of the frame.
+    :rtype: int
+    """
+    return pack_down(buffer, offset, msg.down_id, msg.type.value, *message_down_fields(msg))
+
+
+def unpack_down(buffer, offset=0):
+    """
+    Reads a down frame (used on the Teensy side, eg. by an emulator or to decode a trace).
+
+    :return: (down_id, type value, checksum, payload fields)
+    :rtype: (int, int, int, tuple)
+    :raise DeserializationException: if the type is unknown.
+    """
+    down_id, type_value, checksum = HEADER_STRUCT.unpack_from(buffer, offset)
+    if type_value >= len(DOWN_FRAME_STRUCTS):
+        raise DeserializationException("Can't deserialize down message header : unknown type {}".format(type_value))
+    fields = DOWN_FRAME_STRUCTS[type_value][1].unpack_from(buffer, offset + DOWN_HEADER_SIZE)
+    return down_id, type_value, checksum, fields
+
+
+def _decode_cobs(encoded, sizes, direction):
+    frame = cobs_decode(encoded)
+    if len(frame) < COBS_HEADER_SIZE + CRC_SIZE or crc16(frame) != 0:
+        raise DeserializationException("Can't deserialize {} message : bad CRC".format(direction))
+    type_value = frame[1]
+    if type_value >= len(sizes) or len(frame) != sizes[type_value]:
+        raise DeserializationException("Can't deserialize {} message header : type {} and size {}".format(
+            direction, type_value, len(frame)))
+    return frame
+
+
+def unpack_down_cobs(encoded):
+    """
+    Same as unpack_down, in the COBS_CRC16 protocol (the CRC is checked).
+
+    :param encoded: The encoded frame, without its delimiter.
+    :type encoded: bytes|bytearray|memoryview
+    :return: (down_id, type value, payload fields)
+    :rtype: (int, int, tuple)
+    :raise DeserializationException: if the frame is invalid.
+    """
+    frame = _decode_cobs(encoded, _DOWN_COBS_SIZES, "down")
+    fields = DOWN_COBS_STRUCTS[frame[1]].unpack_from(frame)
+    return fields[0], fields[1], fields[2:]
+
+
+def pack_up(buffer, offset, up_id, type_value, *fields):
+    """
+    Packs an up (teensy -> raspi) frame into buffer, checksum computed over the whole frame after the header
+    as the Teensy does.
+
+    :param buffer: Writable buffer of at least offset + UP_MESSAGE_SIZE bytes.
+    :type buffer: bytearray|memoryview
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :param up_id: The id of the message (0 - 255).
+    :type up_id: int
+    :param type_value: The value of the eTypeUp of the message.
+    :type type_value: int
+    :param fields: The raw payload fields, as sent over the wire (see UP_PAYLOAD_FORMATS).
+    :type fields: int
+    :return: The size of the frame (UP_MESSAGE_SIZE).
+    :rtype: int
+    """
+    UP_FRAME_STRUCTS[type_value][0].pack_into(buffer, offset, up_id, type_value, 0, *fields)
+    buffer[offset + 2] = xor_checksum(int.from_bytes(buffer[offset + UP_HEADER_SIZE:offset + UP_MESSAGE_SIZE],
+                                                     'little'))
+    return UP_MESSAGE_SIZE
+
+
+def pack_up_cobs(buffer, offset, up_id, type_value, *fields):
+    """
+    Same as pack_up, in the COBS_CRC16 protocol.
+
+    :param buffer: Writable buffer of at least offset + COBS_UP_MESSAGE_MAX_SIZE bytes.
+    :type buffer: bytearray|memoryview
+    :return: The size of the frame, with its delimiter.
+    :rtype: int
+    """
+    return _pack_cobs(UP_COBS_STRUCTS[type_value], buffer, offset, up_id, type_value, fields)
+
+
+def unpack_up(buffer, offset=0):
+    """
+    Reads an up frame into a sMessageUp (same result as sMessageUp.deserialize).
+
+    :param buffer: Buffer holding at least offset + UP_MESSAGE_SIZE bytes.
+    :type buffer: bytes|bytearray|memoryview
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :return: The decoded message.
+    :rtype: sMessageUp
+    :raise DeserializationException: if the type is unknown.
+    """
+    up_id, type_value, checksum = HEADER_STRUCT.unpack_from(buffer, offset)
+    if type_value >= len(_UP_TYPES):
+        raise DeserializationException("Can't deserialize up message header : unknown type {}".format(type_value))
+    payload_class, names = _UP_PAYLOADS[type_value]
+    data = payload_class()
+    for name, value in zip(names, UP_FRAME_STRUCTS[type_value][1].unpack_from(buffer, offset + UP_HEADER_SIZE)):
+        setattr(data, name, value)
+    msg = sMessageUp()
+    msg.up_id = up_id
+    msg.type = _UP_TYPES[type_value]
+    msg.checksum = checksum
+    msg.data = data
+    return msg
+
+
+def unpack_up_event(buffer, offset=0):
+    """
+    Reads an up frame into the event of its type (see communication.events), the fields are not converted.
+
+    :param buffer: Buffer holding at least offset + UP_MESSAGE_SIZE bytes.
+    :type buffer: bytes|bytearray|memoryview
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :return: The decoded message.
+    :rtype: communication.events.UpEvent
+    :raise DeserializationException: if the type is unknown.
+    """
+    type_value = buffer[offset + 1]
+    if type_value >= len(_UP_EVENT_DECODERS):
+        raise DeserializationException("Can't deserialize up message header : unknown type {}".format(type_value))
+    event_class, unpack_payload = _UP_EVENT_DECODERS[type_value]
+    return event_class(buffer[offset], *unpack_payload(buffer, offset + UP_HEADER_SIZE))
+
+
+def unpack_up_event_cobs(encoded):
+    """
+    Same as unpack_up_event, in the COBS_CRC16 protocol (the CRC is checked).
+
+    :param encoded: The encoded frame, without its delimiter.
+    :type encoded: bytes|bytearray|memoryview
+    :return: The decoded message.
+    :rtype: communication.events.UpEvent
+    :raise DeserializationException: if the frame is invalid.
+    """
+    frame = _decode_cobs(encoded, _UP_COBS_SIZES, "up")
+    event_class, unpack_payload = _UP_EVENT_DECODERS[frame[1]]
+    return event_class(frame[0], *unpack_payload(frame, COBS_HEADER_SIZE))
+
+
+# Packing function of the down frames, by protocol
+DOWN_PACKERS = {eProtocolVersion.LEGACY: pack_down, eProtocolVersion.COBS_CRC16: pack_down_cobs}
+UP_PACKERS = {eProtocolVersion.LEGACY: pack_up, eProtocolVersion.COBS_CRC16: pack_up_cobs}
@@ -0,0 +1,135 @@
+"""
+Decoded up (teensy -> raspi) messages, as given to the callbacks registered with event=True.
+
+The fields are kept as received over the wire and only converted when read (eg. OdomReportEvent.dtheta), so a
+callback pays only for the fields it uses. EVENT_CLASSES gives the class of each message type, indexed by the
+type value.
+"""
+
+from communication.message_definition import eTypeUp, LINEAR_ODOM_TO_MSG_ADDER, RADIAN_TO_MSG_FACTOR, \
+    RADIAN_TO_MSG_ADDER
+
+
+class UpEvent:
+    """
+    Base of the up events. type is the eTypeUp of the message, type_value its value.
+    """
+    __slots__ = ('up_id',)
+    type = None  # type: eTypeUp
+    type_value = None  # type: int
+
+    def args(self):
+        """
+        :return: The arguments given to the callbacks registered without event=True
+            (see Communication.register_callback).
+        :rtype: tuple
+        """
+        raise NotImplementedError()
+
+
+class AckDownEvent(UpEvent):
+    """
+    protocol_version is the eProtocolVersion the Teensy uses from this message on, when it acknowledges a RESET
+    requesting one (see UpFrameScanner.negotiating), None otherwise.
+    """
+    __slots__ = ('ack_down_id', 'protocol_version')
+    type = eTypeUp.ACK_DOWN
+    type_value = eTypeUp.ACK_DOWN.value
+
+    def __init__(self, up_id, ack_down_id, protocol_version=None):
+        self.up_id = up_id
+        self.ack_down_id = ack_down_id
+        self.protocol_version = protocol_version
+
+    def args(self):
+        return self.ack_down_id,
+
+
+class OdomReportEvent(UpEvent):
+    __slots__ = ('previous_report_id', 'new_report_id', 'raw_dx', 'raw_dy', 'raw_dtheta')
+    type = eTypeUp.ODOM_REPORT
+    type_value = eTypeUp.ODOM_REPORT.value
+
+    def __init__(self, up_id, previous_report_id, new_report_id, raw_dx, raw_dy, raw_dtheta):
+        self.up_id = up_id
+        self.previous_report_id = previous_report_id
+        self.new_report_id = new_report_id
+        self.raw_dx = raw_dx
+        self.raw_dy = raw_dy
+        self.raw_dtheta = raw_dtheta
+
+    @property
+    def dx(self):
+        return self.raw_dx - LINEAR_ODOM_TO_MSG_ADDER
+
+    @property
+    def dy(self):
+        return self.raw_dy - LINEAR_ODOM_TO_MSG_ADDER
+
+    @property
+    def dtheta(self):
+        return self.raw_dtheta / RADIAN_TO_MSG_FACTOR - RADIAN_TO_MSG_ADDER
+
+    def args(self):
+        return self.previous_report_id, self.new_report_id, self.raw_dx - LINEAR_ODOM_TO_MSG_ADDER, \
+            self.raw_dy - LINEAR_ODOM_TO_MSG_ADDER, self.raw_dtheta / RADIAN_TO_MSG_FACTOR - RADIAN_TO_MSG_ADDER
+
+
+class HMIStateEvent(UpEvent):
+    """
+    hmi_state bits (base/code/communication/Communication.cpp:sendIHMState) : cord, button 1, button 2, red, green
+    and blue led, from bit 7 to bit 2.
+    """
+    __slots__ = ('hmi_state',)
+    type = eTypeUp.HMI_STATE
+    type_value = eTypeUp.HMI_STATE.value
+
+    def __init__(self, up_id, hmi_state):
+        self.up_id = up_id
+        self.hmi_state = hmi_state
+
+    @property
+    def cord_state(self):
+        return bool(self.hmi_state & (1 << 7))
+
+    @property
+    def button1_state(self):
+        return bool(self.hmi_state & (1 << 6))
+
+    @property
+    def button2_state(self):
+        return bool(self.hmi_state & (1 << 5))
+
+    @property
+    def red_led_state(self):
+        return 255 if self.hmi_state & (1 << 4) else 0
+
+    @property
+    def green_led_state(self):
+        return 255 if self.hmi_state & (1 << 3) else 0
+
+    @property
+    def blue_led_state(self):
+        return 255 if self.hmi_state & (1 << 2) else 0
+
+    def args(self):
+        return self.cord_state, self.button1_state, self.button2_state, self.red_led_state, self.green_led_state, \
+            self.blue_led_state
+
+
+class SensorValueEvent(UpEvent):
+    __slots__ = ('sensor_id', 'sensor_value')
+    type = eTypeUp.SENSOR_VALUE
+    type_value = eTypeUp.SENSOR_VALUE.value
+
+    def __init__(self, up_id, sensor_id, sensor_value):
+        self.up_id = up_id
+        self.sensor_id = sensor_id
+        self.sensor_value = sensor_value
+
+    def args(self):
+        return self.sensor_id, self.sensor_value
+
+
+EVENT_CLASSES = tuple(sorted((AckDownEvent, OdomReportEvent, HMIStateEvent, SensorValueEvent),
+                             key=lambda c: c.type_value))
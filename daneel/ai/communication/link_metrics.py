@@ -0,0 +1,262 @@
+"""
+Metrics of the serial link with the Teensy: round trip times of the down messages, retransmissions and failures,
+synchronisation losses of the up stream and bytes per second in each direction.
+
+Communication feeds a LinkMetrics (Communication.metrics) as the messages are sent and received; it can be queried
+with snapshot() (plain dicts and lists, json serializable) or printed with report().
+"""
+
+import bisect
+from collections import deque
+
+from communication.message_definition import eTypeDown, eTypeUp
+
+# s, upper bounds of the round trip time histogram buckets (the last bucket holds everything above)
+RTT_BUCKETS = (0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5,
+               1., 2.)
+RATE_WINDOW = 1.  # s, duration over which the bytes per second are averaged
+RATE_SAMPLE_PERIOD = 0.1  # s, minimum time between two samples of the byte counters
+SYNC_EVENTS_COUNT = 100  # number of synchronisation losses / recoveries kept
+BITS_PER_BYTE = 10  # 8N1 : start bit, 8 data bits, stop bit
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket bounds, which also keeps the count, sum, min and max of the values.
+    """
+    def __init__(self, bounds=RTT_BUCKETS):
+        """
+        :param bounds: Upper bounds of the buckets, ascending. A last bucket holds the values above bounds[-1].
+        :type bounds: tuple[float]
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = None  # type: float
+        self.max = None  # type: float
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """
+        :param p: The percentile (0 - 100).
+        :type p: float
+        :return: The upper bound of the bucket holding the p-th percentile (max for the last bucket), None if empty.
+        :rtype: float
+        """
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        cumulated = 0
+        for i, count in enumerate(self.counts):
+            cumulated += count
+            if count and cumulated >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean': self.mean, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'buckets': [[bound, count] for bound, count in zip(self.bounds + (None,), self.counts) if count]}
+
+
+class DownTypeMetrics:
+    """
+    Counters of one eTypeDown. The round trip time is measured from the last sending of a message to its
+    acknowledgement, the latency from its submission to its completion (what a blocking send waits).
+    """
+    __slots__ = ('submitted', 'transmissions', 'retries', 'acknowledged', 'superseded', 'failed', 'rtt', 'latency')
+
+    def __init__(self):
+        self.submitted = 0
+        self.transmissions = 0  # frames written, first sendings and retransmissions
+        self.retries = 0  # retransmissions after an acknowledgement timeout
+        self.acknowledged = 0
+        self.superseded = 0
+        self.failed = 0  # never acknowledged (max_retries reached, or the window has been reset)
+        self.rtt = Histogram()
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return {'submitted': self.submitted, 'transmissions': self.transmissions, 'retries': self.retries,
+                'acknowledged': self.acknowledged, 'superseded': self.superseded, 'failed': self.failed,
+                'rtt': self.rtt.snapshot(), 'latency': self.latency.snapshot()}
+
+
+class LinkMetrics:
+    """
+    Metrics of the serial link. The owner serializes the calls (Communication holds its serial lock), every method
+    takes the current time of the robot clock.
+    """
+    def __init__(self, baudrate, now=0.):
+        """
+        :param baudrate: Baudrate of the serial, to compute its utilization.
+        :type baudrate: int
+        :param now: The current time in seconds (start of the measures).
+        :type now: float
+        """
+        self.baudrate = baudrate
+        self.down = {t: DownTypeMetrics() for t in eTypeDown}  # type: dict[eTypeDown, DownTypeMetrics]
+        self._down_by_value = {t.value: m for t, m in self.down.items()}
+        self.received = {t: 0 for t in eTypeUp}  # up messages received, per type
+        self.acks_sent = 0  # ACK_UP and ACK_ODOM_REPORT written
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.desync_count = 0
+        self.resync_count = 0
+        self.sync_events = deque(maxlen=SYNC_EVENTS_COUNT)  # (time, 'desync' or 'resync', bytes dropped so far)
+        self.start_time = now
+        self._samples = deque([(now, 0, 0)])  # (time, rx_bytes, tx_bytes)
+
+    def reset(self, now):
+        self.__init__(self.baudrate, now)
+
+    def submitted(self, type_value):
+        self._down_by_value[type_value].submitted += 1
+
+    def transmitted(self, type_value, size, retry, now):
+        """
+        A frame of a message given to the send window has been written.
+
+        :param retry: True if this is a retransmission.
+        :type retry: bool
+        """
+        metrics = self._down_by_value[type_value]
+        metrics.transmissions += 1
+        if retry:
+            metrics.retries += 1
+        self.wrote(size, now)
+
+    def completed(self, type_value, result, latency, rtt=None):
+        """
+        A message given to the send window has been completed.
+
+        :param result: see SendHandle.result
+        :type result: int
+        :param latency: Time since its submission in seconds.
+        :type latency: float
+        :param rtt: Time since its last sending in seconds, if acknowledged.
+        :type rtt: float
+        """
+        metrics = self._down_by_value[type_value]
+        if result == 0:
+            metrics.acknowledged += 1
+            metrics.rtt.add(rtt)
+        elif result == 1:
+            metrics.superseded += 1
+        else:
+            metrics.failed += 1
+        metrics.latency.add(latency)
+
+    def acknowledgement_sent(self, type_value, size, now):
+        """
+        An ACK_UP or ACK_ODOM_REPORT (not handled by the send window) has been written.
+        """
+        self.acks_sent += 1
+        self._down_by_value[type_value].transmissions += 1
+        self.wrote(size, now)
+
+    def wrote(self, size, now):
+        self.tx_bytes += size
+        self._sample(now)
+
+    def read(self, size, now):
+        self.rx_bytes += size
+        self._sample(now)
+
+    def up_message(self, msg_type):
+        self.received[msg_type] += 1
+
+    def sync_changed(self, synchronised, dropped_bytes, now):
+        """
+        Called by the frame scanner when it loses or recovers the synchronisation.
+
+        :param synchronised: False on a loss, True on a recovery.
+        :type synchronised: bool
+        :param dropped_bytes: Number of bytes dropped by the scanner so far.
+        :type dropped_bytes: int
+        """
+        if synchronised:
+            self.resync_count += 1
+        else:
+            self.desync_count += 1
+        self.sync_events.append((now, 'resync' if synchronised else 'desync', dropped_bytes))
+
+    def rates(self, now):
+        """
+        :return: The bytes per second received and sent over the last RATE_WINDOW seconds.
+        :rtype: (float, float)
+        """
+        self._sample(now)
+        oldest_time, oldest_rx, oldest_tx = self._samples[0]
+        duration = now - oldest_time
+        if duration <= 0:
+            return 0., 0.
+        return (self.rx_bytes - oldest_rx) / duration, (self.tx_bytes - oldest_tx) / duration
+
+    def snapshot(self, now):
+        """
+        :return: All the metrics, as json serializable dicts and lists.
+        :rtype: dict
+        """
+        rx_rate, tx_rate = self.rates(now)
+        capacity = self.baudrate / BITS_PER_BYTE
+        return {
+            'duration': now - self.start_time,
+            'rx_bytes': self.rx_bytes,
+            'tx_bytes': self.tx_bytes,
+            'rx_bytes_per_s': rx_rate,
+            'tx_bytes_per_s': tx_rate,
+            'rx_utilization': rx_rate / capacity,
+            'tx_utilization': tx_rate / capacity,
+            'received': {t.name: count for t, count in self.received.items()},
+            'acks_sent': self.acks_sent,
+            'down': {t.name: m.snapshot() for t, m in self.down.items() if m.submitted or m.transmissions},
+            'desync_count': self.desync_count,
+            'resync_count': self.resync_count,
+            'sync_events': [list(e) for e in self.sync_events],
+        }
+
+    def report(self, now):
+        """
+        :return: A human readable summary of the metrics.
+        :rtype: str
+        """
+        s = self.snapshot(now)
+        lines = ["Serial link over {:.1f} s : rx {} B ({:.0f} B/s, {:.1%}), tx {} B ({:.0f} B/s, {:.1%}), "
+                 "{} desync(s), {} resync(s)".format(s['duration'], s['rx_bytes'], s['rx_bytes_per_s'],
+                                                     s['rx_utilization'], s['tx_bytes'], s['tx_bytes_per_s'],
+                                                     s['tx_utilization'], s['desync_count'], s['resync_count']),
+                 "Received : {}, acknowledgements sent : {}".format(
+                     ", ".join("{} {}".format(name, count) for name, count in s['received'].items()), s['acks_sent']),
+                 "{:<20}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8}{:>10}{:>10}{:>10}{:>12}".format(
+                     "down type", "subm.", "sent", "retries", "acked", "supers.", "failed", "rtt p50", "rtt p90",
+                     "rtt p99", "lat. max")]
+        for name, m in s['down'].items():
+            lines.append("{:<20}{:>8}{:>8}{:>8}{:>8}{:>8}{:>8}{:>10}{:>10}{:>10}{:>12}".format(
+                name, m['submitted'], m['transmissions'], m['retries'], m['acknowledged'], m['superseded'],
+                m['failed'], _ms(m['rtt']['p50']), _ms(m['rtt']['p90']), _ms(m['rtt']['p99']),
+                _ms(m['latency']['max'])))
+        return "\n".join(lines)
+
+    def _sample(self, now):
+        if now - self._samples[-1][0] >= RATE_SAMPLE_PERIOD:
+            self._samples.append((now, self.rx_bytes, self.tx_bytes))
+            while len(self._samples) > 2 and now - self._samples[1][0] >= RATE_WINDOW:
+                self._samples.popleft()
+
+
+def _ms(value):
+    return "-" if value is None else "{:.1f} ms".format(value * 1000)
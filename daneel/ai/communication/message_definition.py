@@ -1,4 +1,5 @@
 from enum import Enum
+import binascii
 import bitstring
 
 
@@ -6,6 +7,18 @@ UP_MESSAGE_SIZE = 11  # maximum size of a up message (teensy -> raspi) in bytes
 UP_HEADER_SIZE = 3  # size of the header (all except the data) of an up message
 DOWN_MESSAGE_SIZE = 9  # maximum size of a down message (raspi -> teensy) in bytes
 
+# COBS protocol (see eProtocolVersion.COBS_CRC16) : id, type, payload of the size of the type, CRC-16 (big endian),
+# the whole COBS encoded and followed by COBS_DELIMITER.
+COBS_DELIMITER = 0
+COBS_HEADER_SIZE = 2  # id, type
+CRC_SIZE = 2
+CRC16_INIT = 0xFFFF  # CRC-16/CCITT-FALSE (polynomial 0x1021), as computed by binascii.crc_hqx
+COBS_UP_MESSAGE_MAX_SIZE = 14  # encoded odometry report (1 + 2 + 8 + 2) and delimiter
+COBS_DOWN_MESSAGE_MAX_SIZE = 12  # encoded speed command (1 + 2 + 6 + 2) and delimiter
+# Written after the protocol version in the ACK_DOWN of a RESET by a Teensy which negotiates the protocol (the legacy
+# firmware leaves these bytes uninitialised).
+PROTOCOL_ACK_MAGIC = 0xC0B5
+
 # Data converters (from and to what is sent over the wire and what is used as data).
 LINEAR_ODOM_TO_MSG_ADDER = 32768
 LINEAR_SPEED_TO_MSG_ADDER = 32768
@@ -15,6 +28,19 @@ RADIAN_TO_MSG_FACTOR = 10430.378350470453
 RADIAN_TO_MSG_ADDER = 3.14159265358979323846
 
 
+class eProtocolVersion(Enum):
+    """
+    Framings of the messages, requested by the raspi in its RESET message (see sReset).
+
+    * LEGACY : fixed size frames (UP_MESSAGE_SIZE, DOWN_MESSAGE_SIZE) zero padded, XOR checksum of the payload. On an
+      invalid frame, the receiver drops one byte at a time until it finds valid frames again.
+    * COBS_CRC16 : frames of the size of their payload checked by a CRC-16, COBS encoded so that COBS_DELIMITER only
+      appears at their end : the receiver is synchronised again at the next delimiter.
+    """
+    LEGACY = 0
+    COBS_CRC16 = 1
+
+
 class DeserializationException(Exception):
     """
     Raised on deserialization error (when trying to read what is sent over the wire into usable data)
@@ -29,6 +55,53 @@ class DeserializationException(Exception):
         super().__init__(message)
 
 
+def crc16(data):
+    """
+    :param data: The bytes to check.
+    :type data: bytes|bytearray|memoryview
+    :return: The CRC-16/CCITT-FALSE of data. Computed over data followed by its CRC (big endian), it is 0.
+    :rtype: int
+    """
+    return binascii.crc_hqx(data, CRC16_INIT)
+
+
+def cobs_encode(data):
+    """
+    Consistent Overhead Byte Stuffing of a frame of less than 254 bytes : every zero byte is replaced by the distance to
+    the next one (or to the end, plus one), and the distance to the first one is put in front.
+
+    :param data: The frame to encode.
+    :type data: bytes
+    :return: The encoded frame (one byte longer, without zero bytes), without the delimiter.
+    :rtype: bytes
+    """
+    return b''.join(bytes((len(chunk) + 1,)) + chunk for chunk in data.split(b'\0'))
+
+
+def cobs_decode(data):
+    """
+    Reverse of cobs_encode.
+
+    :param data: The encoded frame, without the delimiter.
+    :type data: bytes|bytearray|memoryview
+    :return: The frame.
+    :rtype: bytearray
+    :raise DeserializationException: if data is not a valid COBS encoding.
+    """
+    decoded = bytearray()
+    i = 0
+    size = len(data)
+    while i < size:
+        code = data[i]
+        if code == 0 or i + code > size:
+            raise DeserializationException("Invalid COBS frame")
+        decoded += data[i + 1:i + code]
+        i += code
+        if i < size and code < 0xFF:
+            decoded.append(0)
+    return decoded
+
+
 # ======= Up (Prop -> raspi) message declaration ======== #
 
 class eTypeUp(Enum):
@@ -151,7 +224,19 @@ class sMessageUp:
         self.checksum = None
         self.data = None
 
-    def deserialize(self, packed):
+    def deserialize(self, packed, protocol=eProtocolVersion.LEGACY):
+        """
+        :param packed: The frame, without the delimiter for COBS_CRC16.
+        :type packed: bytes
+        :param protocol: The framing of packed.
+        :type protocol: eProtocolVersion
+        """
+        if protocol == eProtocolVersion.COBS_CRC16:
+            frame = cobs_decode(packed)
+            if len(frame) < COBS_HEADER_SIZE + CRC_SIZE or crc16(frame) != 0:
+                raise DeserializationException("Can't deserialize up message : bad CRC")
+            # Same layout as a legacy frame without the checksum
+            packed = bytes(frame[:COBS_HEADER_SIZE]) + b'\0' + bytes(frame[COBS_HEADER_SIZE:-CRC_SIZE])
         header = bitstring.BitStream(packed[0:UP_HEADER_SIZE])
         try:
             self.up_id, type_value, self.data = header.unpack('uint:8, uint:8, uint:8')
@@ -288,6 +373,14 @@ class sThetaRepositioning:
         return bitstring.pack('uintle:16', self._theta_repositioning)
 
 
+class sReset:
+    def __init__(self):
+        self.protocol_version = eProtocolVersion.LEGACY.value  # uint:8, not read by the legacy firmware
+
+    def serialize(self):
+        return bitstring.pack('uint:8', self.protocol_version)
+
+
 class sSensorCommand:
     def __init__(self):
         self.sensor_id = None
@@ -302,7 +395,7 @@ class sMessageDown:
     :type type: eTypeDown
     :type down_id: int
     :type checksum: int
-    :type data: sAckOdomReport|sAckUp|sActuatorCommand|sSpeedCommand|sHMICommand|sThetaRepositioning
+    :type data: sAckOdomReport|sAckUp|sActuatorCommand|sSpeedCommand|sHMICommand|sThetaRepositioning|sReset
     """
     def __init__(self):
         self.down_id = 0  # :8
@@ -310,7 +403,20 @@ class sMessageDown:
         self.checksum = 0  # :8
         self.data = None
 
-    def serialize(self):
+    def serialize(self, protocol=eProtocolVersion.LEGACY):
+        """
+        :param protocol: The framing of the message.
+        :type protocol: eProtocolVersion
+        :return: The frame (with its delimiter for COBS_CRC16).
+        :rtype: bitstring.BitStream
+        """
+        if protocol == eProtocolVersion.COBS_CRC16:
+            frame = bitstring.pack('uint:8, uint:8', self.down_id, self.type.value)
+            if self.data is not None:
+                frame += self.data.serialize()
+            frame = frame.tobytes()
+            frame += crc16(frame).to_bytes(CRC_SIZE, 'big')
+            return bitstring.BitStream(bytes=cobs_encode(frame) + bytes((COBS_DELIMITER,)))
 
         ser2 = None
         if self.data is not None:
@@ -0,0 +1,343 @@
+"""
+Sliding window of down messages waiting for their acknowledgement.
+
+Several down messages can be in flight at the same time; their ACK_DOWN are matched by id whenever they arrive
+and the messages not acknowledged in time are retransmitted by service().
+The messages waiting for room in the window are sent by priority (see Priority).
+"""
+
+import threading
+from collections import deque
+from enum import IntEnum
+
+from communication.message_definition import DOWN_MESSAGE_SIZE, COBS_DOWN_MESSAGE_MAX_SIZE, eTypeDown
+from communication.codec import pack_down
+
+SEND_WINDOW_SIZE = 4  # messages in flight (the Teensy reads one message per loop, with a 64 bytes serial buffer)
+
+# a newer message of these types makes the older useless (see SendWindow.submit for the other messages)
+SUPERSEDABLE_TYPES = (eTypeDown.SPEED_COMMAND.value, eTypeDown.HMI_COMMAND.value)
+
+
+class Priority(IntEnum):
+    """
+    Priority classes of the down messages, the most urgent first. A queued message is sent before all the queued
+    messages of the less urgent classes, and each class can only fill the window up to size + 1 - priority messages
+    in flight (at least 1) : the last slots are kept for the motion commands, and a stop always has one.
+    """
+    SAFETY_STOP = 0
+    MOTION = 1
+    ACTUATOR = 2
+    HMI = 3  # leds, score display
+
+
+# priority of the messages given to the window (the acknowledgements are written at once, without the window)
+DEFAULT_PRIORITIES = {
+    eTypeDown.SPEED_COMMAND.value: Priority.MOTION,
+    eTypeDown.ACTUATOR_COMMAND.value: Priority.ACTUATOR,
+    eTypeDown.HMI_COMMAND.value: Priority.HMI,
+    eTypeDown.RESET.value: Priority.SAFETY_STOP,
+    eTypeDown.THETA_REPOSITIONING.value: Priority.MOTION,
+    eTypeDown.SENSOR_COMMAND.value: Priority.ACTUATOR,
+}
+
+
+class SendHandle:
+    """
+    Completion handle of a message given to the send window.
+
+    result is None while the message is in flight, then:
+
+    * 0 : the message has been acknowledged,
+    * 1 : the message has been superseded by a newer message of the same type before being acknowledged,
+    * -1 : max_retries has been reached (or the window has been reset).
+    """
+    ACKNOWLEDGED = 0
+    SUPERSEDED = 1
+    FAILED = -1
+
+    def __init__(self, msg_type, poll=None):
+        """
+        :param msg_type: The type of the message.
+        :type msg_type: eTypeDown
+        :param poll: Function called in loop by wait() until completion, when nothing else reads the serial.
+        :type poll: function
+        """
+        self.msg_type = msg_type
+        self.result = None  # type: int
+        self.attempts = 0  # number of times the message has been written on the serial
+        self._poll = poll
+        self._event = threading.Event()
+        self._callbacks = []
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def complete(self, result):
+        if self.result is None:
+            self.result = result
+            self._event.set()
+            for callback in self._callbacks:
+                try:
+                    callback(result)
+                except Exception as e:  # the window must still be updated by its caller
+                    print("[Comm] Error in the completion callback of a {} : {}".format(self.msg_type.name, e))
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback with the result once the message is completed (at once if it is already). It is called by
+        whoever reads the serial (the main thread in check_message or the reader thread) with the serial lock held:
+        it must not send messages.
+
+        :param callback: Function taking the result.
+        :type callback: function
+        :return: self
+        :rtype: SendHandle
+        """
+        if self.result is None:
+            self._callbacks.append(callback)
+        else:
+            callback(self.result)
+        return self
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the message is acknowledged, superseded or failed.
+
+        :param timeout: maximum time to wait in seconds (None : until completion)
+        :type timeout: float
+        :return: the result, None on timeout
+        :rtype: int
+        """
+        if self._poll is None:
+            self._event.wait(timeout)
+        else:
+            self._poll(self, timeout)
+        return self.result
+
+
+class MessageIdCounter:
+    """
+    Allocator of the down message ids (shared by the commands and the acknowledgements).
+    """
+    def __init__(self):
+        self.next_id = 0
+        self.last_id = None  # last id taken
+
+    def take(self):
+        self.last_id = self.next_id
+        self.next_id = (self.next_id + 1) % 256
+        return self.last_id
+
+    def reset(self):
+        self.next_id = 0
+        self.last_id = None
+
+
+class _InFlight:
+    __slots__ = ('handle', 'type_value', 'priority', 'fields', 'max_retries', 'ids', 'deadline', 'sequence',
+                 'submit_time', 'send_time', 'supersede_key')
+
+    def __init__(self, handle, type_value, priority, fields, max_retries, sequence, submit_time, supersede_key=None):
+        self.handle = handle
+        self.type_value = type_value
+        self.priority = priority
+        self.fields = fields
+        self.max_retries = max_retries
+        self.ids = []  # every down id used to send this message (the last one is the current)
+        self.deadline = 0
+        self.sequence = sequence  # submission order, to know which message supersedes which
+        self.submit_time = submit_time
+        self.send_time = None  # time of the last sending
+        self.supersede_key = supersede_key  # a newer message with the same key supersedes this one, if not None
+
+
+class SendWindow:
+    """
+    Bookkeeping of the messages in flight. The owner must serialize the calls (Communication holds its
+    serial lock around them).
+    """
+    def __init__(self, msg_ids, write, size=SEND_WINDOW_SIZE, retransmit_timeout=0.5, metrics=None):
+        """
+        :param msg_ids: The down id allocator (shared with the acknowledgements).
+        :type msg_ids: MessageIdCounter
+        :param write: Function writing a frame on the serial.
+        :type write: function
+        :param size: Maximum number of messages waiting for their acknowledgement.
+        :type size: int
+        :param retransmit_timeout: Time (in seconds) after which a non acknowledged message is sent again.
+        :type retransmit_timeout: float
+        :param metrics: Told about the sendings and completions, if given.
+        :type metrics: communication.link_metrics.LinkMetrics
+        """
+        self.size = size
+        self.retransmit_timeout = retransmit_timeout
+        self._msg_ids = msg_ids
+        self._write = write
+        self.pack = pack_down  # packs the frames, in the protocol of the link (see codec.DOWN_PACKERS)
+        self._frame = bytearray(max(DOWN_MESSAGE_SIZE, COBS_DOWN_MESSAGE_MAX_SIZE))
+        self._frame_view = memoryview(self._frame)
+        self._by_id = {}  # type: dict[int, _InFlight]
+        self._in_flight = []  # type: list[_InFlight]
+        self._queues = tuple(deque() for _ in Priority)  # messages waiting for room in the window, by priority
+        self._sequence = 0
+        self._latest_sequence = {}  # type: dict[object, int] # sequence of the last message of each supersede key
+        self.metrics = metrics
+
+    def __len__(self):
+        return len(self._in_flight) + sum(len(q) for q in self._queues)
+
+    def submit(self, handle, type_value, fields, max_retries, now, priority=None, supersede_key=None):
+        """
+        Adds a message to the window, sends it at once if there is room for its priority.
+
+        :param handle: The completion handle of the message.
+        :type handle: SendHandle
+        :param type_value: Value of the eTypeDown of the message.
+        :type type_value: int
+        :param fields: Raw payload fields of the message.
+        :type fields: tuple
+        :param max_retries: Number of times the message can be written before failing.
+        :type max_retries: int
+        :param now: current time in seconds.
+        :type now: float
+        :param priority: The priority class of the message (default : DEFAULT_PRIORITIES of its type).
+        :type priority: Priority
+        :param supersede_key: The message supersedes the older ones with the same key which are not acknowledged yet
+            (default : its type for the SUPERSEDABLE_TYPES, else None : never superseded).
+        :type supersede_key: object
+        """
+        if priority is None:
+            priority = DEFAULT_PRIORITIES[type_value]
+        if supersede_key is None and type_value in SUPERSEDABLE_TYPES:
+            supersede_key = type_value
+        if self.metrics is not None:
+            self.metrics.submitted(type_value)
+        entry = _InFlight(handle, type_value, priority, fields, max_retries, self._sequence, now, supersede_key)
+        if max_retries <= 0:
+            self._complete(entry, SendHandle.FAILED, now)
+            return
+        self._sequence += 1
+        queue = self._queues[priority]
+        if supersede_key is not None:
+            self._latest_sequence[supersede_key] = entry.sequence
+            # Latest wins : the new message takes the place of the older one with the same key waiting in the queue
+            for older_queue in self._queues:
+                for i, queued in enumerate(older_queue):
+                    if queued.supersede_key == supersede_key:
+                        self._complete(queued, SendHandle.SUPERSEDED, now)
+                        if older_queue is queue:
+                            queue[i] = entry
+                            return
+                        del older_queue[i]
+                        break
+        if not queue and len(self._in_flight) < self._limit(priority):
+            self._transmit(entry, now, fresh_id=True)
+        else:
+            queue.append(entry)
+
+    def acknowledge(self, down_id, now):
+        """
+        Completes the message sent with down_id (if any), and fills the window with the queued messages.
+
+        :return: the handle of the acknowledged message, None if the id was not in flight.
+        :rtype: SendHandle
+        """
+        entry = self._by_id.get(down_id)
+        if entry is None:
+            return None
+        self._remove(entry)
+        self._complete(entry, SendHandle.ACKNOWLEDGED, now)
+        self._fill(now)
+        return entry.handle
+
+    def service(self, now):
+        """
+        Retransmits the messages whose acknowledgement timed out and fails those which reached max_retries.
+        """
+        for entry in [e for e in self._in_flight if e.deadline <= now]:
+            if self._is_superseded(entry):
+                self._remove(entry)
+                self._complete(entry, SendHandle.SUPERSEDED, now)
+            elif entry.handle.attempts >= entry.max_retries:
+                self._remove(entry)
+                self._complete(entry, SendHandle.FAILED, now)
+            else:
+                # The Teensy only filters out a frame with the same id as the last one it accepted : the same id can
+                # be used again (and the message executed at most once) only if no other frame has been sent since.
+                # Otherwise a fresh id is taken, so that the retransmission is not mistaken for an old message.
+                self._transmit(entry, now, fresh_id=entry.ids[-1] != self._msg_ids.last_id)
+        self._fill(now)
+
+    def next_deadline(self):
+        """
+        :return: the time of the next retransmission, None if nothing is in flight.
+        :rtype: float
+        """
+        if len(self._in_flight) == 0:
+            return None
+        return min(e.deadline for e in self._in_flight)
+
+    def reset(self, now=None):
+        """
+        Fails all the messages in flight or queued (eg. after a reset of the Teensy).
+
+        :param now: current time in seconds (for the metrics).
+        :type now: float
+        """
+        for entry in self._in_flight + [e for q in self._queues for e in q]:
+            self._complete(entry, SendHandle.FAILED, now)
+        self._in_flight = []
+        self._by_id.clear()
+        for queue in self._queues:
+            queue.clear()
+
+    def _transmit(self, entry, now, fresh_id):
+        if fresh_id:
+            down_id = self._msg_ids.take()
+            stale = self._by_id.get(down_id)  # the ids wrapped around on a message in flight for too long
+            if stale is not None and stale is not entry:
+                stale.ids.remove(down_id)
+                del self._by_id[down_id]
+            entry.ids.append(down_id)
+            self._by_id[down_id] = entry
+            if entry not in self._in_flight:
+                self._in_flight.append(entry)
+        size = self.pack(self._frame, 0, entry.ids[-1], entry.type_value, *entry.fields)
+        self._write(self._frame_view[:size])
+        if self.metrics is not None:
+            self.metrics.transmitted(entry.type_value, size, entry.handle.attempts > 0, now)
+        entry.handle.attempts += 1
+        entry.send_time = now
+        entry.deadline = now + self.retransmit_timeout
+
+    def _complete(self, entry, result, now):
+        if self.metrics is not None and not entry.handle.done and now is not None:
+            rtt = now - entry.send_time if result == SendHandle.ACKNOWLEDGED else None
+            self.metrics.completed(entry.type_value, result, now - entry.submit_time, rtt)
+        entry.handle.complete(result)
+
+    def _is_superseded(self, entry):
+        return entry.supersede_key is not None and self._latest_sequence[entry.supersede_key] != entry.sequence
+
+    def _remove(self, entry):
+        self._in_flight.remove(entry)
+        for down_id in entry.ids:
+            if self._by_id.get(down_id) is entry:
+                del self._by_id[down_id]
+
+    def _limit(self, priority):
+        return max(1, self.size + 1 - priority)
+
+    def _fill(self, now):
+        for priority, queue in zip(Priority, self._queues):
+            limit = self._limit(priority)
+            while queue and len(self._in_flight) < limit:
+                entry = queue.popleft()
+                if self._is_superseded(entry):
+                    self._complete(entry, SendHandle.SUPERSEDED, now)
+                    continue
+                self._transmit(entry, now, fresh_id=True)
+            if queue:
+                return  # the less urgent classes have less room
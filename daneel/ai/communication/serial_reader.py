@@ -0,0 +1,343 @@
+"""
+Reception of the up (teensy -> raspi) messages: a frame scanner re synchronising on the header checksum (or on the
+delimiters of the COBS protocol), and a thread draining the serial into it.
+"""
+
+import os
+import struct
+import threading
+
+import serial
+
+from communication.message_definition import eTypeUp, eProtocolVersion, DeserializationException, UP_MESSAGE_SIZE, \
+    UP_HEADER_SIZE, COBS_UP_MESSAGE_MAX_SIZE, COBS_DELIMITER, PROTOCOL_ACK_MAGIC
+from communication.codec import unpack_up_event, unpack_up_event_cobs, xor_checksum, NEGOTIATION_STRUCT
+
+READ_BUFFER_SIZE = 4096  # bytes, about 370 up messages
+READER_PERIOD = 0.005  # s, read timeout of the reader thread (thus resolution of the retransmission timer)
+
+_UP_TYPES_COUNT = len(eTypeUp)
+_ACK_DOWN = eTypeUp.ACK_DOWN.value
+_UP_PAYLOAD = struct.Struct('<Q')  # the 8 bytes after the header of an up frame, read in place for the checksum
+_PROTOCOL_VERSIONS = {p.value: p for p in eProtocolVersion}
+_MAGIC_BYTES = PROTOCOL_ACK_MAGIC.to_bytes(2, 'little')  # as packed by NEGOTIATION_STRUCT
+
+
+def is_valid_up_frame(buffer, offset):
+    """
+    Checks the type and checksum of the up frame at offset.
+    The Teensy does not fill the id and checksum of its ACK_DOWN messages, only their type can be checked.
+
+    :param buffer: Buffer holding at least offset + UP_MESSAGE_SIZE bytes.
+    :type buffer: bytearray
+    :param offset: Position of the frame in the buffer.
+    :type offset: int
+    :rtype: bool
+    """
+    type_value = buffer[offset + 1]
+    if type_value >= _UP_TYPES_COUNT:
+        return False
+    if type_value == _ACK_DOWN:
+        return True
+    return xor_checksum(_UP_PAYLOAD.unpack_from(buffer, offset + UP_HEADER_SIZE)[0]) == buffer[offset + 2]
+
+
+class UpFrameScanner:
+    """
+    Cuts the bytes received from the Teensy in up messages.
+
+    The bytes are stored in a fixed size buffer (read and write indices, the unread bytes are moved back to the
+    start of the buffer when its end is reached). When an invalid frame is met, the scanner drops one byte at a time
+    until it finds two valid frames in a row, and synchronises on the first one.
+    As any misaligned position whose second byte is 0 looks like an ACK_DOWN, the ACK_DOWN are also checked by
+    is_expected_ack, if given.
+
+    With the COBS_CRC16 protocol, the frames are cut on the delimiters and an invalid frame only loses itself.
+    The scanner switches to it on the ACK_DOWN of a RESET which negotiated it, while negotiating is set : the bytes
+    following this acknowledgement are decoded with the new protocol.
+    """
+    def __init__(self, size=READ_BUFFER_SIZE, is_expected_ack=None, on_sync_change=None):
+        """
+        :param size: Size of the receive buffer in bytes.
+        :type size: int
+        :param is_expected_ack: Called with the id acknowledged by an ACK_DOWN, returns False if no down message
+            with this id has been sent recently.
+        :type is_expected_ack: function
+        :param on_sync_change: Called with (synchronised, dropped_bytes) when the synchronisation is lost (False) or
+            recovered (True).
+        :type on_sync_change: function
+        """
+        self._buffer = bytearray(size)
+        self.is_expected_ack = is_expected_ack
+        self.on_sync_change = on_sync_change
+        self._start = 0  # first unread byte
+        self._end = 0  # first free byte
+        self.synchronised = True
+        self.desync_count = 0  # number of synchronisation losses
+        self.dropped_bytes = 0  # number of bytes dropped to re synchronise (or on overflow)
+        self.received_bytes = 0  # number of bytes given to the scanner
+        self.on_receive = None  # if set, called with the bytes given to the scanner (eg. TraceRecorder)
+        self.protocol = eProtocolVersion.LEGACY
+        self.negotiating = False  # True while waiting for the acknowledgement of a RESET requesting a protocol
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        """
+        Drops the bytes buffered and goes back to the legacy protocol (as the Teensy after a reset).
+        """
+        self._start = 0
+        self._end = 0
+        self.synchronised = True
+        self.protocol = eProtocolVersion.LEGACY
+        self.negotiating = False
+
+    def feed(self, data):
+        """
+        Appends the bytes read from the serial. If the buffer is full, the oldest bytes are dropped.
+
+        :param data: bytes read from the serial
+        :type data: bytes
+        """
+        size = len(self._buffer)
+        self.received_bytes += len(data)
+        if self.on_receive is not None:
+            self.on_receive(data)
+        if len(data) >= size:
+            self.dropped_bytes += self._end - self._start + len(data) - size
+            data = data[-size:]
+            self._start = self._end = 0
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def read_from(self, serial_port, size):
+        """
+        Reads bytes waiting on the serial directly into the buffer: with a single os.readv when the serial has a file
+        descriptor (pyserial on posix), else with its readinto.
+
+        :param serial_port: The serial to read.
+        :type serial_port: serial.Serial
+        :param size: Number of bytes to read (at most the size of the buffer), they must be already waiting.
+        :type size: int
+        :return: The number of bytes read.
+        :rtype: int
+        """
+        size = min(size, len(self._buffer))
+        self._reserve(size)
+        view = memoryview(self._buffer)[self._end:self._end + size]
+        try:
+            fd = getattr(serial_port, 'fd', None)
+            if fd is not None:
+                try:
+                    read = os.readv(fd, [view])
+                except BlockingIOError:
+                    read = 0
+            else:
+                read = serial_port.readinto(view) or 0
+            if read and self.on_receive is not None:
+                self.on_receive(view[:read])
+        finally:
+            view.release()
+        self._end += read
+        self.received_bytes += read
+        return read
+
+    def _reserve(self, size):
+        """
+        Makes room for size bytes after the unread ones : moves them back to the start of the buffer, and drops the
+        oldest if needed.
+        """
+        if self._end + size > len(self._buffer):
+            unread = self._end - self._start
+            if unread + size > len(self._buffer):
+                overflow = unread + size - len(self._buffer)
+                self.dropped_bytes += overflow
+                self._start += overflow
+                unread -= overflow
+                self._lose_synchronisation()
+            self._buffer[:unread] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = unread
+
+    def frames(self):
+        """
+        Decodes all the complete messages buffered.
+
+        :return: The messages, in reception order
+        :rtype: list[communication.events.UpEvent]
+        """
+        if self.protocol == eProtocolVersion.COBS_CRC16:
+            messages = self._cobs_frames([])
+        else:
+            messages = self._legacy_frames()
+        if self._start == self._end:
+            self._start = self._end = 0
+        return messages
+
+    def _legacy_frames(self):
+        messages = []
+        if self.negotiating:
+            # Searched first : before it, the Teensy may already send in the new protocol (if the acknowledgement of a
+            # previous RESET has been lost), and a misaligned frame found in these bytes could overlap it.
+            offset = self._find_negotiation()
+            if offset >= 0:
+                self._scan_legacy(messages, offset)
+                self.dropped_bytes += offset - self._start
+                message = unpack_up_event(self._buffer, offset)
+                version = self._buffer[offset + UP_HEADER_SIZE + 1]
+                message.protocol_version = self.protocol = _PROTOCOL_VERSIONS[version]
+                messages.append(message)
+                self._start = offset + UP_MESSAGE_SIZE
+                self.negotiating = False
+                if not self.synchronised:
+                    self.synchronised = True
+                    if self.on_sync_change is not None:
+                        self.on_sync_change(True, self.dropped_bytes)
+                if self.protocol == eProtocolVersion.COBS_CRC16:
+                    return self._cobs_frames(messages)
+        self._scan_legacy(messages, self._end)
+        return messages
+
+    def _scan_legacy(self, messages, end):
+        """
+        Decodes the legacy frames between the first unread byte and end.
+        """
+        buffer = self._buffer
+        while end - self._start >= UP_MESSAGE_SIZE:
+            offset = self._start
+            if self._is_valid(buffer, offset):
+                if not self.synchronised:
+                    # A misaligned position can pass the checks by chance : wait for the next frame to confirm it
+                    if end - offset < 2 * UP_MESSAGE_SIZE:
+                        break
+                    if not self._is_valid(buffer, offset + UP_MESSAGE_SIZE):
+                        self._start += 1
+                        self.dropped_bytes += 1
+                        continue
+                    self.synchronised = True
+                    if self.on_sync_change is not None:
+                        self.on_sync_change(True, self.dropped_bytes)
+                messages.append(unpack_up_event(buffer, offset))
+                self._start += UP_MESSAGE_SIZE
+            else:
+                self._lose_synchronisation()
+                self._start += 1
+                self.dropped_bytes += 1
+
+    def _find_negotiation(self):
+        """
+        :return: The position of the acknowledgement of a RESET negotiating the protocol (an ACK_DOWN followed by a
+            known version and PROTOCOL_ACK_MAGIC), -1 if none has been fully received.
+        :rtype: int
+        """
+        buffer = self._buffer
+        magic_offset = UP_HEADER_SIZE + 1 + NEGOTIATION_STRUCT.size - len(_MAGIC_BYTES)
+        position = buffer.find(_MAGIC_BYTES, self._start + magic_offset, self._end)
+        while position >= 0:
+            offset = position - magic_offset
+            if offset + UP_MESSAGE_SIZE > self._end:
+                return -1
+            if buffer[offset + 1] == _ACK_DOWN and buffer[offset + UP_HEADER_SIZE + 1] in _PROTOCOL_VERSIONS:
+                return offset
+            position = buffer.find(_MAGIC_BYTES, position + 1, self._end)
+        return -1
+
+    def _cobs_frames(self, messages):
+        buffer = self._buffer
+        while True:
+            end = buffer.find(COBS_DELIMITER, self._start, self._end)
+            if end < 0:
+                if self._end - self._start >= COBS_UP_MESSAGE_MAX_SIZE:  # too long to be the start of a frame
+                    self._lose_synchronisation()
+                    self.dropped_bytes += self._end - self._start
+                    self._start = self._end
+                return messages
+            if end > self._start:  # else an empty frame, ignored
+                try:
+                    message = unpack_up_event_cobs(buffer[self._start:end])
+                except DeserializationException:
+                    self._lose_synchronisation()
+                    self.dropped_bytes += end + 1 - self._start
+                else:
+                    if not self.synchronised:
+                        self.synchronised = True
+                        if self.on_sync_change is not None:
+                            self.on_sync_change(True, self.dropped_bytes)
+                    messages.append(message)
+            self._start = end + 1
+
+    def _lose_synchronisation(self):
+        if self.synchronised:
+            print("[Comm] Message synchronisation lost : Trying to re synchronise")
+            self.synchronised = False
+            self.desync_count += 1
+            if self.on_sync_change is not None:
+                self.on_sync_change(False, self.dropped_bytes)
+
+    def _is_valid(self, buffer, offset):
+        if not is_valid_up_frame(buffer, offset):
+            return False
+        return buffer[offset + 1] != _ACK_DOWN or self.is_expected_ack is None \
+            or self.is_expected_ack(buffer[offset + UP_HEADER_SIZE])
+
+
+class SerialReader(threading.Thread):
+    """
+    Thread draining the serial (everything waiting in one read) into an UpFrameScanner, and giving the decoded messages
+    to a callback. The callback is also called (with an empty list) at least every READER_PERIOD, to let the owner
+    service its timers. The errors are printed and the thread keeps reading, so that the blocking sends are still
+    acknowledged.
+    """
+    def __init__(self, serial_port, on_messages, is_expected_ack=None, on_sync_change=None):
+        """
+        :param serial_port: The serial plugged to the Teensy. Its read timeout is set to READER_PERIOD.
+        :type serial_port: serial.Serial
+        :param on_messages: Called from the reader thread with the list of the messages received.
+        :type on_messages: function
+        :param is_expected_ack: see UpFrameScanner
+        :type is_expected_ack: function
+        :param on_sync_change: see UpFrameScanner
+        :type on_sync_change: function
+        """
+        super().__init__(name="SerialReader", daemon=True)
+        self._serial_port = serial_port
+        self._serial_port.timeout = READER_PERIOD
+        self._on_messages = on_messages
+        self.scanner = UpFrameScanner(is_expected_ack=is_expected_ack, on_sync_change=on_sync_change)
+        self._running = True
+        self._flush_requested = False
+        self._flushed = threading.Event()
+
+    def run(self):
+        while self._running:
+            try:
+                waiting = self._serial_port.in_waiting
+                if waiting == 0:
+                    data = self._serial_port.read(1)  # waits up to READER_PERIOD for the next bytes
+                    if data:
+                        self.scanner.feed(data)
+                        waiting = self._serial_port.in_waiting
+                if waiting:
+                    self.scanner.read_from(self._serial_port, waiting)
+                if self._flush_requested:
+                    self.scanner.clear()
+                    self._flush_requested = False
+                    self._flushed.set()
+                self._on_messages(self.scanner.frames())
+            except serial.SerialException as e:
+                print("[Comm] Serial reader error : {}".format(e))
+            except Exception as e:
+                print("[Comm] Error while handling the messages : {}".format(e))
+
+    def flush(self):
+        """
+        Discards what has been received so far (done by the reader thread on its next read, this call waits for it).
+        """
+        self._flushed.clear()
+        self._flush_requested = True
+        self._flushed.wait(10 * READER_PERIOD)
+
+    def stop(self):
+        self._running = False
@@ -0,0 +1,488 @@
+"""
+Pure Python emulator of the Teensy (base) side of the serial protocol, served on a pseudo terminal.
+
+It behaves like base/code/propulsion_FAT_2018.cpp compiled with SIMULATOR: the down messages are read 9 bytes at a
+time and acknowledged, the speed commands are integrated into odometry reports (first order motor model of
+base/code/Simulator.cpp, failsafe stop of ExtNavigation.cpp) sent with the cumulated non acknowledged reports, the
+HMI state is sent when it changes and the sensors are reported as configured by the SENSOR_COMMAND messages.
+Frame loss, latency and byte corruption can be added on the link, in both directions.
+Unlike the current firmware, it accepts the COBS protocol requested by a RESET (unless legacy is set).
+
+Run it with ``python3 -m communication.teensy_emulator`` (from the ai directory), then start the robot with
+``-t <the printed pty path>``. EmulatedSerial runs it in the same process instead, on the time of a Clock.
+"""
+
+import argparse
+import heapq
+import math
+import os
+import pty
+import random
+import select
+import time
+import tty
+from collections import deque
+import multiprocessing
+
+from communication.codec import unpack_down, unpack_down_cobs, xor_checksum, DOWN_HEADER_SIZE, UP_PACKERS, \
+    NEGOTIATION_STRUCT
+from communication.message_definition import eTypeUp, eTypeDown, eProtocolVersion, UP_MESSAGE_SIZE, \
+    DOWN_MESSAGE_SIZE, UP_HEADER_SIZE, COBS_UP_MESSAGE_MAX_SIZE, COBS_DELIMITER, PROTOCOL_ACK_MAGIC, \
+    LINEAR_ODOM_TO_MSG_ADDER, LINEAR_SPEED_TO_MSG_ADDER, ANGULAR_SPEED_TO_MSG_FACTOR, ANGULAR_SPEED_TO_MSG_ADDER, \
+    RADIAN_TO_MSG_FACTOR, RADIAN_TO_MSG_ADDER, DeserializationException
+
+# base/code/params.h
+CONTROL_PERIOD = 0.05  # s
+POS_REPORT_PERIOD = 0.2  # s
+IO_REPORT_PERIOD = 0.5  # s
+TIME_SPEED_FAILSAFE = 1  # s
+# base/code/Simulator.cpp
+MOTOR_TAU = 0.2  # s, time at which the motors reach about 63% of their final speed
+# base/code/communication/Communication.h
+MAX_NON_ACK_ODOM_REPORTS = 40
+# base/code/InputOutputs.h
+SENSOR_PERIODIC_TIME = 0.1  # s
+SENSOR_STOPPED, SENSOR_ON_CHANGE, SENSOR_PERIODIC = range(3)
+DEFAULT_SENSOR_VALUES = {0: 820, 1: 830, 2: 0, 3: 0}  # battery signal, battery power, ball detectors
+
+SERVE_PERIOD = 0.001  # s, maximum time between two loops of the emulator (as the Teensy loop)
+# The zero padding of a legacy RESET, which cannot appear in a COBS stream (only made of frames and delimiters)
+LEGACY_RESET_PADDING = bytes(DOWN_MESSAGE_SIZE - DOWN_HEADER_SIZE - 1)
+_RESET = eTypeDown.RESET.value
+
+
+class TeensyEmulator:
+    """
+    State of the emulated Teensy. update() must be called in loop with the current time, the frames to send to the
+    raspi are given to write (after the link impairments).
+    """
+    def __init__(self, write, loss=0., latency=0., corruption=0., seed=None, legacy=False):
+        """
+        :param write: Function writing bytes to the raspi.
+        :type write: function
+        :param loss: Probability for a frame to be lost (in each direction).
+        :type loss: float
+        :param latency: Transmission delay of the frames (in seconds, in each direction).
+        :type latency: float
+        :param corruption: Probability for each byte to have a bit flipped.
+        :type corruption: float
+        :param seed: Seed of the random generator of the impairments.
+        :type seed: int
+        :param legacy: If True, emulates the firmware which ignores the protocol requested by the RESET.
+        :type legacy: bool
+        """
+        self._write = write
+        self.loss = loss
+        self.latency = latency
+        self.corruption = corruption
+        self._random = random.Random(seed)
+        self._in_transit = []  # heap of (delivery time, order, is down frame, data)
+        self._transit_order = 0
+        self._down_buffer = bytearray()
+        self._up_frame = bytearray(max(UP_MESSAGE_SIZE, COBS_UP_MESSAGE_MAX_SIZE))
+        self.legacy = legacy
+        self.protocol = eProtocolVersion.LEGACY
+        self.received = []  # (down id, eTypeDown, payload fields) of the down messages accepted
+        self.actuators = {}  # actuator id -> last command
+        self.hmi_command = 0
+        self.cord_in = False
+        self.button1_pressed = False
+        self.button2_pressed = False
+        self.sensor_values = dict(DEFAULT_SENSOR_VALUES)
+        self.reset(0)
+
+    def reset(self, now):
+        """
+        Same as the RESET message (base/code/propulsion_FAT_2018.cpp:resetCallback).
+        """
+        self.x = self.y = self.theta = 0.
+        self.speed = [0., 0., 0.]  # mm/s, mm/s, rad/s in the table frame
+        self.speed_command = [0., 0., 0.]
+        self._time_last_speed_message = -math.inf
+        self._move_delta = [0., 0., 0.]
+        self._non_ack_odom_reports = deque()  # (report id, dx, dy, dtheta)
+        self._odom_report_index = 0
+        self._last_odom_report_acknowledged = 0
+        self._up_msg_index = 0
+        self._last_down_id = 0
+        self._is_first_message = True
+        self._sensor_states = {sensor_id: SENSOR_STOPPED for sensor_id in self.sensor_values}
+        self._sensor_last_values = {sensor_id: 0 for sensor_id in self.sensor_values}
+        self._sensor_last_times = {sensor_id: -math.inf for sensor_id in self.sensor_values}
+        self._down_buffer.clear()
+        self._hmi_changed = True
+        self._next_control = self._next_report = self._next_io = now
+
+    def receive(self, data, now):
+        """
+        Bytes written by the raspi on the serial (they go through the link impairments).
+        """
+        if self.protocol == eProtocolVersion.COBS_CRC16:
+            start = 0
+            while start < len(data):
+                end = data.find(COBS_DELIMITER, start)
+                if end < 0:
+                    end = len(data)
+                while end < len(data) and data[end] == COBS_DELIMITER:  # the padding of a legacy RESET
+                    end += 1
+                self._transmit(data[start:end], True, now)
+                start = end
+            return
+        for i in range(0, len(data) - DOWN_MESSAGE_SIZE + 1, DOWN_MESSAGE_SIZE):
+            self._transmit(data[i:i + DOWN_MESSAGE_SIZE], True, now)
+        if len(data) % DOWN_MESSAGE_SIZE:
+            self._transmit(data[len(data) - len(data) % DOWN_MESSAGE_SIZE:], True, now)
+
+    def set_hmi_inputs(self, cord_in, button1_pressed, button2_pressed):
+        """
+        Changes the state of the cord and buttons (an HMI_STATE is sent on the next loop).
+        """
+        self.cord_in, self.button1_pressed, self.button2_pressed = cord_in, button1_pressed, button2_pressed
+        self._hmi_changed = True
+
+    def next_event_time(self):
+        """
+        :return: The time at which update() has something to do.
+        :rtype: float
+        """
+        next_time = min(self._next_control, self._next_report, self._next_io)
+        if self._in_transit:
+            next_time = min(next_time, self._in_transit[0][0])
+        return next_time
+
+    def update(self, now):
+        """
+        One loop of the Teensy: delivers the frames in transit, reads the down messages, then runs the timers.
+        """
+        while self._in_transit and self._in_transit[0][0] <= now:
+            _, _, is_down, data = heapq.heappop(self._in_transit)
+            if is_down:
+                self._down_buffer += data
+            else:
+                self._write(data)
+        self._read_down_frames(now)
+
+        while self._next_control <= now:
+            self._control()
+            self._next_control += CONTROL_PERIOD
+        if self._next_report <= now:
+            self._send_odometry_report(now)
+            self._next_report = max(self._next_report + POS_REPORT_PERIOD, now)
+        if self._next_io <= now:
+            self._run_io(now)
+            self._next_io = max(self._next_io + IO_REPORT_PERIOD, now)
+
+    def _transmit(self, data, is_down, now):
+        if self._random.random() < self.loss:
+            return
+        data = bytearray(data)
+        if self.corruption > 0:
+            for i in range(len(data)):
+                if self._random.random() < self.corruption:
+                    data[i] ^= 1 << self._random.randrange(8)
+        if self.latency <= 0 and not is_down:
+            self._write(data)
+            return
+        heapq.heappush(self._in_transit, (now + self.latency, self._transit_order, is_down, data))
+        self._transit_order += 1
+
+    def _send_up(self, type_value, *fields, now):
+        size = UP_PACKERS[self.protocol](self._up_frame, 0, self._up_msg_index, type_value, *fields)
+        self._up_msg_index = (self._up_msg_index + 1) % 256
+        self._transmit(self._up_frame[:size], False, now)
+
+    def _read_down_frames(self, now):
+        """
+        Handles the complete frames of the down buffer (a RESET empties it, as Communication::reset).
+        """
+        buffer = self._down_buffer
+        while self.protocol == eProtocolVersion.LEGACY and len(buffer) >= DOWN_MESSAGE_SIZE:
+            frame = bytes(buffer[:DOWN_MESSAGE_SIZE])
+            del buffer[:DOWN_MESSAGE_SIZE]
+            self._check_message(frame, now)
+        while self.protocol == eProtocolVersion.COBS_CRC16:
+            end = buffer.find(COBS_DELIMITER)
+            reset_start = self._find_legacy_reset()
+            if reset_start >= 0 and (end < 0 or end >= reset_start):
+                if len(buffer) < reset_start + DOWN_MESSAGE_SIZE:
+                    return
+                frame = bytes(buffer[reset_start:reset_start + DOWN_MESSAGE_SIZE])
+                del buffer[:reset_start + DOWN_MESSAGE_SIZE]
+                self._check_message(frame, now)
+                continue
+            if end < 0:
+                return
+            encoded = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if encoded:
+                self._check_cobs_message(encoded, now)
+
+    def _find_legacy_reset(self):
+        """
+        :return: The position of a legacy RESET in the down buffer (its padding starts after the protocol version, or
+            after the type if the version, and thus the checksum, are 0), -1 if none.
+        :rtype: int
+        """
+        buffer = self._down_buffer
+        padding = buffer.find(LEGACY_RESET_PADDING)
+        if padding >= 1 and buffer[padding - 1] == _RESET:
+            return padding - 2
+        if padding >= 3 and buffer[padding - 3] == _RESET:
+            return padding - 4
+        return -1
+
+    def _check_message(self, frame, now):
+        """
+        base/code/communication/Communication.cpp:checkMessages (no re synchronisation : a frame is always 9 bytes)
+        """
+        down_id, type_value, checksum = frame[0], frame[1], frame[2]
+        if xor_checksum(int.from_bytes(frame[DOWN_HEADER_SIZE:], 'little')) != checksum:
+            return
+        # The Teensy leaves the header of its acknowledgements uninitialised, zero here.
+        ack = bytearray(UP_MESSAGE_SIZE)
+        ack[1] = eTypeUp.ACK_DOWN.value
+        ack[3] = down_id
+        protocol = None
+        if type_value == eTypeDown.RESET.value and not self.legacy:
+            protocol = eProtocolVersion(frame[DOWN_HEADER_SIZE]) if frame[DOWN_HEADER_SIZE] < len(eProtocolVersion) \
+                else eProtocolVersion.LEGACY
+            NEGOTIATION_STRUCT.pack_into(ack, UP_HEADER_SIZE + 1, protocol.value, PROTOCOL_ACK_MAGIC)
+        self._transmit(ack, False, now)
+        if protocol is not None:
+            self.protocol = protocol
+        if self._is_first_message or type_value == eTypeDown.RESET.value or \
+                0 < (down_id - self._last_down_id) % 256 < 128:
+            try:
+                _, _, _, fields = unpack_down(frame)
+            except DeserializationException:
+                return
+            self._accept(down_id, type_value, fields, now)
+
+    def _check_cobs_message(self, encoded, now):
+        """
+        Same as _check_message, in the COBS protocol : the acknowledgements are complete frames.
+        """
+        try:
+            down_id, type_value, fields = unpack_down_cobs(encoded)
+        except DeserializationException:
+            return
+        self._send_up(eTypeUp.ACK_DOWN.value, down_id, now=now)
+        if self._is_first_message or 0 < (down_id - self._last_down_id) % 256 < 128:
+            self._accept(down_id, type_value, fields, now)
+
+    def _accept(self, down_id, type_value, fields, now):
+        self._is_first_message = False
+        self._last_down_id = down_id
+        self.received.append((down_id, eTypeDown(type_value), fields))
+        self._on_message(eTypeDown(type_value), fields, now)
+
+    def _on_message(self, msg_type, fields, now):
+        if msg_type == eTypeDown.ACK_ODOM_REPORT:
+            acknowledged = fields[1]
+            if any(report[0] == acknowledged for report in self._non_ack_odom_reports):
+                while self._non_ack_odom_reports.popleft()[0] != acknowledged:
+                    pass
+            self._last_odom_report_acknowledged = acknowledged
+        elif msg_type == eTypeDown.SPEED_COMMAND:
+            self.speed_command = [fields[0] - LINEAR_SPEED_TO_MSG_ADDER, fields[1] - LINEAR_SPEED_TO_MSG_ADDER,
+                                  fields[2] / ANGULAR_SPEED_TO_MSG_FACTOR - ANGULAR_SPEED_TO_MSG_ADDER]
+            self._time_last_speed_message = now
+        elif msg_type == eTypeDown.ACTUATOR_COMMAND:
+            self.actuators[fields[0]] = fields[1]
+        elif msg_type == eTypeDown.HMI_COMMAND:
+            self.hmi_command = fields[0]
+            self._hmi_changed = True  # InputOutputs::HMISetLedColor sends the state
+        elif msg_type == eTypeDown.RESET:
+            self.reset(now)
+        elif msg_type == eTypeDown.THETA_REPOSITIONING:
+            theta = fields[0] / RADIAN_TO_MSG_FACTOR - RADIAN_TO_MSG_ADDER
+            theta += sum(report[3] for report in self._non_ack_odom_reports)
+            self.theta = theta + self._move_delta[2]
+        elif msg_type == eTypeDown.SENSOR_COMMAND:
+            if fields[0] in self._sensor_states:
+                self._sensor_states[fields[0]] = fields[1]
+
+    def _control(self):
+        """
+        ExtNavigation::update and Simulator::update : the table speed follows the command with a first order lag,
+        and falls to 0 when no speed command has been received for TIME_SPEED_FAILSAFE.
+        """
+        if self._next_control - self._time_last_speed_message < TIME_SPEED_FAILSAFE:
+            target = self.speed_command
+        else:
+            target = (0., 0., 0.)
+        for i in range(3):
+            self.speed[i] += (target[i] - self.speed[i]) * CONTROL_PERIOD / MOTOR_TAU
+        dx, dy, dtheta = (v * CONTROL_PERIOD for v in self.speed)
+        self.x += dx
+        self.y += dy
+        self.theta += dtheta
+        self._move_delta[0] += dx
+        self._move_delta[1] += dy
+        self._move_delta[2] += dtheta
+
+    def _send_odometry_report(self, now):
+        """
+        Communication::sendOdometryReport : the report holds the sum of all the reports not acknowledged yet.
+        """
+        dx, dy, dtheta = int(self._move_delta[0]), int(self._move_delta[1]), self._move_delta[2]
+        self._move_delta = [0., 0., 0.]
+        self._odom_report_index = (self._odom_report_index + 1) % 256
+        cumulated_dx = dx + sum(report[1] for report in self._non_ack_odom_reports)
+        cumulated_dy = dy + sum(report[2] for report in self._non_ack_odom_reports)
+        cumulated_dtheta = dtheta + sum(report[3] for report in self._non_ack_odom_reports)
+        self._non_ack_odom_reports.append((self._odom_report_index, dx, dy, dtheta))
+        if len(self._non_ack_odom_reports) >= MAX_NON_ACK_ODOM_REPORTS:
+            # The ring buffer of the Teensy wraps around on its start and looks empty
+            self._non_ack_odom_reports.clear()
+        msg_dx = cumulated_dx + LINEAR_ODOM_TO_MSG_ADDER
+        msg_dy = cumulated_dy + LINEAR_ODOM_TO_MSG_ADDER
+        msg_dtheta = round((cumulated_dtheta + RADIAN_TO_MSG_ADDER) * RADIAN_TO_MSG_FACTOR)
+        if not (0 <= msg_dx <= 65535 and 0 <= msg_dy <= 65535 and 0 <= msg_dtheta <= 65535):
+            return
+        self._send_up(eTypeUp.ODOM_REPORT.value, self._last_odom_report_acknowledged, self._odom_report_index,
+                      msg_dx, msg_dy, msg_dtheta, now=now)
+
+    def _run_io(self, now):
+        """
+        InputOutputs::run
+        """
+        if self._hmi_changed:
+            self._hmi_changed = False
+            red, green, blue = (self.hmi_command >> 5) & 7, (self.hmi_command >> 2) & 7, self.hmi_command & 3
+            # The cord and buttons are read on pull up inputs : a pressed button reads 0
+            hmi_state = self.cord_in << 7 | (not self.button1_pressed) << 6 | (not self.button2_pressed) << 5 | \
+                (red > 0) << 4 | (green > 0) << 3 | (blue > 0) << 2
+            self._send_up(eTypeUp.HMI_STATE.value, hmi_state, now=now)
+        for sensor_id, state in self._sensor_states.items():
+            value = self.sensor_values[sensor_id]
+            if state == SENSOR_ON_CHANGE and value != self._sensor_last_values[sensor_id] or \
+                    state == SENSOR_PERIODIC and now - self._sensor_last_times[sensor_id] >= SENSOR_PERIODIC_TIME:
+                self._sensor_last_values[sensor_id] = value
+                self._sensor_last_times[sensor_id] = now
+                self._send_up(eTypeUp.SENSOR_VALUE.value, sensor_id, value, now=now)
+
+
+class EmulatedSerial:
+    """
+    Serial-like object (the part of serial.Serial used by Communication) connected to an emulator running in the
+    same process. The emulator is updated on each access, at the time of the given clock, so that it follows the
+    virtual time of a simulation.
+    """
+    def __init__(self, clock, **emulator_options):
+        """
+        :param clock: The time source of the emulator.
+        :type clock: clock.Clock
+        :param emulator_options: see TeensyEmulator
+        """
+        self.clock = clock
+        self.timeout = None
+        self._received = bytearray()
+        self.emulator = TeensyEmulator(self._received.extend, **emulator_options)
+        self.emulator.reset(clock.time())
+
+    @property
+    def in_waiting(self):
+        self.emulator.update(self.clock.time())
+        return len(self._received)
+
+    def read(self, size=1):
+        self.emulator.update(self.clock.time())
+        data = bytes(self._received[:size])
+        del self._received[:size]
+        return data
+
+    def readinto(self, buffer):
+        self.emulator.update(self.clock.time())
+        size = min(len(buffer), len(self._received))
+        buffer[:size] = self._received[:size]
+        del self._received[:size]
+        return size
+
+    def read_all(self):
+        return self.read(self.in_waiting)
+
+    def write(self, data):
+        self.emulator.receive(bytes(data), self.clock.time())
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def serve(master_fd, **emulator_options):
+    """
+    Runs an emulator on the master side of a pty until it is closed.
+
+    :param master_fd: File descriptor of the master side of the pty.
+    :type master_fd: int
+    :param emulator_options: see TeensyEmulator
+    """
+    emulator = TeensyEmulator(lambda data: os.write(master_fd, data), **emulator_options)
+    emulator.reset(time.time())
+    while True:
+        timeout = min(max(emulator.next_event_time() - time.time(), 0), SERVE_PERIOD)
+        readable, _, _ = select.select([master_fd], [], [], timeout)
+        now = time.time()
+        if readable:
+            try:
+                data = os.read(master_fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            emulator.receive(data, now)
+        emulator.update(now)
+
+
+def open_pty():
+    """
+    :return: The master file descriptor and the slave file descriptor (in raw mode) and path of a new pty.
+    :rtype: (int, int, str)
+    """
+    master_fd, slave_fd = pty.openpty()
+    tty.setraw(slave_fd)
+    return master_fd, slave_fd, os.ttyname(slave_fd)
+
+
+def start_emulator(**emulator_options):
+    """
+    Starts an emulator in a new process.
+
+    :param emulator_options: see TeensyEmulator
+    :return: The emulator process (to terminate when done) and the path of the serial to open.
+    :rtype: (multiprocessing.Process, str)
+    """
+    master_fd, slave_fd, slave_path = open_pty()
+    # fork, so that the process inherits the pty file descriptors
+    process = multiprocessing.get_context('fork').Process(target=_serve_process, args=(master_fd, slave_fd),
+                                                          kwargs=emulator_options, daemon=True)
+    process.start()
+    os.close(master_fd)
+    # The process keeps the slave side open, so that the pty is not hung up between the connections
+    os.close(slave_fd)
+    return process, slave_path
+
+
+def _serve_process(master_fd, slave_fd, **emulator_options):
+    serve(master_fd, **emulator_options)
+    os.close(slave_fd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Emulates the Teensy on a pseudo terminal.")
+    parser.add_argument('-l', '--loss', type=float, default=0., help="Probability for a frame to be lost.")
+    parser.add_argument('-d', '--latency', type=float, default=0., help="One way delay of the frames (s).")
+    parser.add_argument('-c', '--corruption', type=float, default=0.,
+                        help="Probability for each byte to have a bit flipped.")
+    parser.add_argument('-s', '--seed', type=int, default=None, help="Seed of the impairments.")
+    parser.add_argument('--legacy', action='store_true', default=False,
+                        help="Emulate the firmware which only speaks the legacy protocol.")
+    args = parser.parse_args()
+    master, slave, path = open_pty()
+    print("[Emulator] Teensy emulated on {}".format(path))
+    try:
+        serve(master, loss=args.loss, latency=args.latency, corruption=args.corruption, seed=args.seed,
+              legacy=args.legacy)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,257 @@
+"""
+Recording and replay of the raw traffic of the serial link with the Teensy.
+
+A trace file starts with TRACE_HEADER (magic and wall time of the start of the recording), followed by records made
+of a RECORD_HEADER (monotonic time in seconds, direction, length) and the bytes:
+
+* UP records hold the bytes as read from the serial (one or more up frames, or pieces of frames),
+* DOWN records hold one down frame as written on the serial,
+* RESET_MARK records (no bytes) mark the start of a Communication.reset_soft_teensy.
+
+The file is written through a memory map grown by TRACE_CHUNK_SIZE, so recording a frame only costs a copy.
+An interrupted recording leaves zeros after the last record, which end the trace for the reader.
+
+Usage (from the ai directory) : python3 -m communication.wire_trace FILE [--speed SPEED] [--profile]
+"""
+
+import argparse
+import cProfile
+import mmap
+import os
+import pstats
+import struct
+import threading
+import time
+
+from clock import Clock
+from communication.codec import unpack_down_cobs
+from communication.message_definition import eTypeUp, eTypeDown, eProtocolVersion, DeserializationException
+from communication.serial_reader import UpFrameScanner
+
+TRACE_MAGIC = b'DNLWIRE1'
+TRACE_HEADER = struct.Struct('<8sd')  # magic, wall time of the start of the recording
+RECORD_HEADER = struct.Struct('<dBH')  # monotonic time (s), direction, length of the bytes which follow
+TRACE_CHUNK_SIZE = 1 << 20  # bytes, the file is grown by this size (a match is about 1 MB)
+END, UP, DOWN, RESET_MARK = 0, 1, 2, 3  # record directions (END : zeros after the last record)
+RECENT_IDS_COUNT = 128  # see communication.RECENT_IDS_COUNT
+
+
+class TraceRecorder:
+    """
+    Appends the frames to a trace file. record() can be called from several threads.
+    """
+    def __init__(self, path, monotonic=time.monotonic):
+        """
+        :param path: The trace file, overwritten if it exists.
+        :type path: str
+        :param monotonic: Time source of the records (eg. Clock.monotonic).
+        :type monotonic: function
+        """
+        self.path = path
+        self._monotonic = monotonic
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._size = TRACE_CHUNK_SIZE
+        os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        TRACE_HEADER.pack_into(self._map, 0, TRACE_MAGIC, time.time())
+        self._offset = TRACE_HEADER.size
+
+    def record(self, direction, data):
+        """
+        :param direction: UP or DOWN
+        :type direction: int
+        :param data: The bytes read or written.
+        :type data: bytes | bytearray | memoryview
+        """
+        length = len(data)
+        with self._lock:
+            if self._map is None:
+                return
+            end = self._offset + RECORD_HEADER.size + length
+            if end > self._size:
+                self._grow(end)
+            RECORD_HEADER.pack_into(self._map, self._offset, self._monotonic(), direction, length)
+            self._map[self._offset + RECORD_HEADER.size:end] = data
+            self._offset = end
+
+    def record_up(self, data):
+        self.record(UP, data)
+
+    def record_down(self, frame):
+        self.record(DOWN, frame)
+
+    def record_reset(self):
+        self.record(RESET_MARK, b'')
+
+    def close(self):
+        """
+        Truncates the file after the last record and closes it.
+        """
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.close()
+            self._map = None
+            os.ftruncate(self._fd, self._offset)
+            os.close(self._fd)
+
+    def _grow(self, end):
+        self._map.close()
+        while self._size < end:
+            self._size += TRACE_CHUNK_SIZE
+        os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+
+
+def read_trace(path):
+    """
+    Reads the records of a trace file.
+
+    :param path: The trace file.
+    :type path: str
+    :return: The wall time of the start of the recording, and the records (monotonic time, direction, bytes), in
+        recording order.
+    :rtype: (float, list[(float, int, bytes)])
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < TRACE_HEADER.size or TRACE_HEADER.unpack_from(data, 0)[0] != TRACE_MAGIC:
+        raise ValueError("{} is not a wire trace".format(path))
+    start_time = TRACE_HEADER.unpack_from(data, 0)[1]
+    records = []
+    offset = TRACE_HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+        timestamp, direction, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if direction == END or offset + length > len(data):
+            break
+        records.append((timestamp, direction, data[offset:offset + length]))
+        offset += length
+    return start_time, records
+
+
+def trace_events(records):
+    """
+    Decodes the up messages of a trace as they were when recorded: the UP bytes go through an UpFrameScanner whose
+    ACK_DOWN check uses the ids of the DOWN frames recorded so far. As in Communication, the messages other than
+    ACK_DOWN received during a reset (from a RESET_MARK to the acknowledgement of the RESET) are discarded, and the
+    protocol negotiated by the RESET is followed in both directions.
+
+    :param records: see read_trace
+    :type records: list[(float, int, bytes)]
+    :return: (monotonic time of the bytes completing the message, message) for each up message.
+    :rtype: generator[(float, communication.events.UpEvent)]
+    """
+    last_down_id = [None]
+
+    def is_expected_ack(down_id):
+        return last_down_id[0] is not None and (last_down_id[0] - down_id) % 256 < RECENT_IDS_COUNT
+
+    scanner = UpFrameScanner(is_expected_ack=is_expected_ack)
+    down_protocol = eProtocolVersion.LEGACY
+    resetting = False
+    reset_ids = set()
+    for timestamp, direction, data in records:
+        if direction == DOWN:
+            if down_protocol == eProtocolVersion.COBS_CRC16:
+                try:
+                    down_id, type_value, _ = unpack_down_cobs(data[:-1])
+                except DeserializationException:
+                    continue
+            else:
+                down_id, type_value = data[0], data[1]
+            last_down_id[0] = down_id
+            if type_value == eTypeDown.RESET.value:
+                reset_ids.add(down_id)
+        elif direction == RESET_MARK:
+            resetting = True
+            reset_ids.clear()
+            scanner.clear()
+            scanner.negotiating = True
+            down_protocol = eProtocolVersion.LEGACY
+        else:
+            scanner.feed(data)
+            for event in scanner.frames():
+                if event.type == eTypeUp.ACK_DOWN:
+                    if event.protocol_version is not None:
+                        down_protocol = event.protocol_version
+                    if resetting and event.ack_down_id in reset_ids:
+                        resetting = False
+                        scanner.negotiating = False
+                elif resetting:
+                    continue
+                yield timestamp, event
+
+
+def replay(path, handle_message, speed=None, clock=None):
+    """
+    Gives the up messages of a trace (except the ACK_DOWN, handled by the send window) to handle_message, eg.
+    Communication.handle_message to run the callbacks of a robot on the messages of a real match.
+
+    :param path: The trace file.
+    :type path: str
+    :param handle_message: Called with each up message.
+    :type handle_message: function
+    :param speed: 1 for the original pace, 2 for twice as fast... None to replay as fast as possible.
+    :type speed: float
+    :param clock: Time source used to wait, with speed (default : wall clock).
+    :type clock: clock.Clock
+    :return: The number of messages replayed.
+    :rtype: int
+    """
+    if clock is None:
+        clock = Clock()
+    _, records = read_trace(path)
+    count = 0
+    replay_start = clock.monotonic()
+    trace_start = records[0][0] if records else 0
+    for timestamp, event in trace_events(records):
+        if event.type == eTypeUp.ACK_DOWN:
+            continue
+        if speed is not None:
+            delay = (timestamp - trace_start) / speed - (clock.monotonic() - replay_start)
+            if delay > 0:
+                clock.sleep(delay)
+        handle_message(event)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summary and replay of a Teensy wire trace.")
+    parser.add_argument('trace', type=str, help="The trace file (see robot.py --trace).")
+    parser.add_argument('--speed', type=float, default=None,
+                        help="Replay speed (1 : original pace, default : as fast as possible).")
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="Profile the decoding and print the most expensive functions.")
+    args = parser.parse_args()
+
+    start_time, records = read_trace(args.trace)
+    duration = records[-1][0] - records[0][0] if records else 0.
+    up_bytes = sum(len(d) for _, direction, d in records if direction == UP)
+    down_frames = sum(1 for _, direction, _ in records if direction == DOWN)
+    print("Recorded on {} : {} records over {:.1f} s, {} bytes up, {} frames down".format(
+        time.ctime(start_time), len(records), duration, up_bytes, down_frames))
+
+    counts = {t: 0 for t in eTypeUp if t != eTypeUp.ACK_DOWN}
+
+    def count(event):
+        counts[event.type] += 1
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    wall_start = time.perf_counter()
+    replay(args.trace, count, args.speed)
+    wall_time = time.perf_counter() - wall_start
+    if profiler is not None:
+        profiler.disable()
+    print("Replayed in {:.3f} s : {}".format(
+        wall_time, ", ".join("{} {}".format(t.name, c) for t, c in counts.items())))
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Reading and decoding of the lidar in a child process, so that the decoding does not compete for the GIL with the
+control loop of the ai.
+
+The child process (run_lidar_process) reads the lidar with read_v_2_4 and publishes each revolution in a
+RevolutionRing : a multiprocessing.shared_memory block holding the last RING_SIZE revolutions, after a header with the
+sequence of the last one. The ai reads the revolutions in place through a SharedLidarStream, which has the latest
+attribute of PacketStream. Both processes time the revolutions with time.monotonic (the monotonic time of the Clock of
+the robot), which is shared by the processes of the system.
+"""
+
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import serial
+
+from drivers.neato_xv11_lidar import LidarRevolution, LidarRecorder, PacketStream, read_v_2_4, AZIMUT_COUNT, \
+    PACKETS_PER_REVOLUTION
+
+RING_SIZE = 4  # revolutions, a slot is written again about 600 ms after its revolution has been replaced
+POLL_PERIOD = 0.02  # s, period at which the ai process looks for a new revolution (see LidarProcess)
+HEADER_DTYPE = np.dtype([('latest', '<i8'), ('valid_packets', '<i8'), ('invalid_packets', '<i8'),
+                         ('dropped_bytes', '<i8')])
+SLOT_DTYPE = np.dtype([('sequence', '<i8'), ('end_time', '<f8'),
+                       ('distance', '<u2', AZIMUT_COUNT), ('quality', '<u2', AZIMUT_COUNT),
+                       ('valid', '?', AZIMUT_COUNT), ('warning', '?', AZIMUT_COUNT), ('received', '?', AZIMUT_COUNT),
+                       ('packet_times', '<f8', PACKETS_PER_REVOLUTION)])
+SLOT_ARRAYS = ('distance', 'quality', 'valid', 'warning', 'received', 'packet_times')
+
+
+class RevolutionRing:
+    """
+    The shared memory block : a header (HEADER_DTYPE) and RING_SIZE slots (SLOT_DTYPE). The revolution of sequence s
+    is written in the slot s % RING_SIZE, whose sequence is -1 while it is written, then the latest sequence of the
+    header is set to s.
+    """
+    def __init__(self, name=None):
+        """
+        :param name: Name of the block to attach to, None to create one (see unlink).
+        :type name: str
+        """
+        size = HEADER_DTYPE.itemsize + RING_SIZE * SLOT_DTYPE.itemsize
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.header = np.ndarray((), HEADER_DTYPE, self.memory.buf)
+        self.slots = np.ndarray((RING_SIZE,), SLOT_DTYPE, self.memory.buf, HEADER_DTYPE.itemsize)
+        if name is None:
+            self.header['latest'] = -1
+            self.slots['sequence'] = -1
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def publish(self, revolution, stream):
+        """
+        :param revolution: A revolution published by stream (see PacketStream.on_revolution).
+        :type revolution: LidarRevolution
+        :param stream: Its counters are copied in the header.
+        :type stream: PacketStream
+        """
+        index = revolution.sequence % RING_SIZE
+        self.slots['sequence'][index] = -1
+        for name in SLOT_ARRAYS:
+            self.slots[name][index] = getattr(revolution, name)
+        self.slots['end_time'][index] = revolution.end_time
+        self.slots['sequence'][index] = revolution.sequence
+        self.header['valid_packets'] = stream.valid_packets
+        self.header['invalid_packets'] = stream.invalid_packets
+        self.header['dropped_bytes'] = stream.dropped_bytes
+        self.header['latest'] = revolution.sequence
+
+    def unlink(self):
+        """
+        Destroys the block (it is freed when all the processes have stopped using it).
+        """
+        self.memory.unlink()
+
+
+class SharedLidarRevolution(LidarRevolution):
+    """
+    A slot of a RevolutionRing as a LidarRevolution : its arrays are read only views of the shared memory, and its
+    sequence is the one of the slot (-1 while it is written), which changes when the slot is written again.
+    """
+    def __init__(self, ring, index):
+        for name in SLOT_ARRAYS:
+            array = ring.slots[name][index]
+            array.flags.writeable = False
+            setattr(self, name, array)
+        self._sequence = ring.slots['sequence'][index:index + 1]
+        self._end_time = ring.slots['end_time'][index:index + 1]
+
+    @property
+    def sequence(self):
+        return int(self._sequence[0])
+
+    @property
+    def end_time(self):
+        return float(self._end_time[0])
+
+
+class SharedLidarStream:
+    """
+    The revolutions published in a RevolutionRing by another process, with the attributes of PacketStream read by the
+    ai. The counters are the ones of the end of the last revolution.
+    """
+    def __init__(self, ring):
+        """
+        :type ring: RevolutionRing
+        """
+        self._ring = ring
+        self._revolutions = [SharedLidarRevolution(ring, index) for index in range(RING_SIZE)]
+
+    @property
+    def latest(self):
+        """
+        :return: The last complete revolution (see SharedLidarRevolution), None before the first one.
+        :rtype: SharedLidarRevolution
+        """
+        sequence = int(self._ring.header['latest'])
+        return None if sequence < 0 else self._revolutions[sequence % RING_SIZE]
+
+    @property
+    def valid_packets(self):
+        return int(self._ring.header['valid_packets'])
+
+    @property
+    def invalid_packets(self):
+        return int(self._ring.header['invalid_packets'])
+
+    @property
+    def dropped_bytes(self):
+        return int(self._ring.header['dropped_bytes'])
+
+
+def run_lidar_process(serial_path, baudrate, ring_name, record_path=None):
+    """
+    Reads the lidar forever, publishing its revolutions in the RevolutionRing ring_name (see LidarProcess).
+
+    :param record_path: If given, the bytes read are recorded in this file (see LidarRecorder).
+    :type record_path: str
+    """
+    ring = RevolutionRing(ring_name)
+    stream = PacketStream(time.monotonic, lambda revolution: ring.publish(revolution, stream))
+    recorder = None if record_path is None else LidarRecorder(record_path)
+    read_v_2_4(serial.Serial(serial_path, baudrate), stream, recorder)
+
+
+class LidarProcess:
+    """
+    Runs run_lidar_process in a child process. stream gives its revolutions, and on_revolution is called with each one
+    from a thread of the ai process (which looks for a new revolution every POLL_PERIOD).
+    """
+    def __init__(self, serial_path, baudrate, record_path=None, on_revolution=None):
+        """
+        :param serial_path: Path of the serial plugged to the lidar.
+        :type serial_path: str
+        :param record_path: see run_lidar_process
+        :type record_path: str
+        :param on_revolution: Called with each revolution (a SharedLidarRevolution), the revolutions published while
+            it runs are skipped.
+        :type on_revolution: function
+        """
+        self.ring = RevolutionRing()
+        self.stream = SharedLidarStream(self.ring)
+        # spawn : the ai already runs threads, which must not be forked
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=run_lidar_process, args=(serial_path, baudrate, self.ring.name, record_path), daemon=True)
+        self.process.start()
+        self._on_revolution = on_revolution
+        self._stopped = threading.Event()
+        self._thread = None
+        if on_revolution is not None:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the child process and destroys the ring.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.process.terminate()
+        self.process.join()
+        self.ring.unlink()
+
+    def _watch(self):
+        last_sequence = -1
+        while not self._stopped.wait(POLL_PERIOD):
+            revolution = self.stream.latest
+            sequence = -1 if revolution is None else revolution.sequence
+            if sequence in (-1, last_sequence):
+                continue
+            last_sequence = sequence
+            try:
+                self._on_revolution(revolution)
+            except Exception as err:
+                print(err)
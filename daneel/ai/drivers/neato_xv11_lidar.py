@@ -1,14 +1,48 @@
 """
 Modified from : https://github.com/Xevel/NXV11
 Under Apache 2.0 License
+
+A packet of the lidar (PACKET_SIZE bytes) holds START_BYTE, the index of the packet (FIRST_INDEX to LAST_INDEX), the
+speed of the motor, POINTS_PER_PACKET points of 4 bytes and a checksum. Its points have the azimuts
+4 * (index - FIRST_INDEX) to 4 * (index - FIRST_INDEX) + 3.
+
+The bytes read from the lidar can be recorded (see LidarRecorder) and replayed with replay_v_2_4. A recording starts
+with RECORDING_HEADER (magic and wall time of the start of the recording), followed by a RECORD_HEADER (monotonic time
+of the read in seconds, length) and the bytes of each read. An interrupted recording can end with an incomplete
+record, which is ignored.
+
+Usage (from the ai directory) : python3 -m drivers.neato_xv11_lidar RECORDING [--speed SPEED]
 """
 
-import time
+import argparse
+import functools
 import math
+import struct
+import threading
+import time
+import numpy as np
 import serial
 
-lidar_points = [None]*360  # type: list[LidarPoint]
-packet_per_cyle = int(359/4)  # In order to flush the input on each rotation
+PACKET_SIZE = 22
+START_BYTE = 0xFA
+START_BYTES = bytes([START_BYTE])
+FIRST_INDEX = 0xA0
+LAST_INDEX = 0xF9
+PACKETS_PER_REVOLUTION = LAST_INDEX - FIRST_INDEX + 1
+POINTS_PER_PACKET = 4
+AZIMUT_COUNT = 360
+CHECKSUM_WEIGHTS = 1 << np.arange(9, -1, -1, dtype=np.int64)  # the 10 words of the checksum are shifted in one by one
+POINT_OFFSETS = np.arange(POINTS_PER_PACKET)
+PACKET_OFFSETS = np.arange(PACKET_SIZE)
+PACKETS_PER_READ = 5  # about 11 ms of data (90 packets per revolution, 5 revolutions per second)
+REVOLUTION_BUFFERS = 3  # the pending revolution, the latest one and the one before, untouched for a revolution
+AZIMUT_COS = np.cos(np.radians(np.arange(AZIMUT_COUNT)))
+AZIMUT_SIN = np.sin(np.radians(np.arange(AZIMUT_COUNT)))
+RECORDING_MAGIC = b'DNLLIDR1'
+RECORDING_HEADER = struct.Struct('<8sd')  # magic, wall time of the start of the recording
+RECORD_HEADER = struct.Struct('<dH')  # monotonic time of the read (s), length of the bytes which follow
+RECORD_MAX_SIZE = (1 << 16) - 1  # bytes, the longer reads are split in several records
+
 
 class LidarPoint:
     def __init__(self, azimut=0, distance=0, quality=0, valid=False, warning=True, updTour=0, point = None):
@@ -28,96 +62,373 @@ class LidarPoint:
             self.updTour = updTour  # type: int
 
     def get_cartesian_coord(self):
-        return (self.distance * math.cos(math.radians(self.azimut)),
-                self.distance * math.sin(math.radians(self.azimut)))
+        return (self.distance * AZIMUT_COS[self.azimut % AZIMUT_COUNT],
+                self.distance * AZIMUT_SIN[self.azimut % AZIMUT_COUNT])
+
+
+@functools.lru_cache(maxsize=1024)
+def cone_azimuts(direction, half_angle):
+    """
+    :param direction: Direction of the cone, in degrees.
+    :type direction: int
+    :param half_angle: Half angle of the cone, in degrees.
+    :type half_angle: int
+    :return: The azimuts whose difference with direction is at most half_angle, from the most clockwise one (read
+        only, shared by the calls).
+    :rtype: numpy.ndarray
+    """
+    if 2 * half_angle + 1 >= AZIMUT_COUNT:
+        azimuts = np.arange(AZIMUT_COUNT)
+    else:
+        azimuts = np.arange(direction - half_angle, direction + half_angle + 1) % AZIMUT_COUNT
+    azimuts.flags.writeable = False
+    return azimuts
+
+
+class LidarScan:
+    """
+    The last point received for each azimut (in degrees, the index of the arrays), written by write_points.
+    """
+    def __init__(self):
+        self.distance = np.zeros(AZIMUT_COUNT, np.uint16)  # mm
+        self.quality = np.zeros(AZIMUT_COUNT, np.uint16)
+        self.valid = np.zeros(AZIMUT_COUNT, np.bool_)
+        self.warning = np.ones(AZIMUT_COUNT, np.bool_)
+        self.received = np.zeros(AZIMUT_COUNT, np.bool_)  # False until a point has been received for the azimut
+
+    def points(self):
+        """
+        :return: The points as LidarPoint, None for the azimuts not received yet.
+        :rtype: list[LidarPoint]
+        """
+        return [LidarPoint(azimut, distance, quality, valid, warning, 0) if received else None
+                for azimut, (distance, quality, valid, warning, received) in enumerate(zip(
+                    self.distance.tolist(), self.quality.tolist(), self.valid.tolist(), self.warning.tolist(),
+                    self.received.tolist()))]
+
+
+class LidarRevolution(LidarScan):
+    """
+    The points of the lidar at the end of a revolution (the points of the packets lost during this revolution are the
+    ones of the previous revolutions), with the time at which each packet has been received.
+
+    A revolution published by PacketStream is a snapshot : its arrays are read only and are not copied. It stays
+    untouched while it is the latest revolution and during the whole revolution after (about 200 ms), then its buffer
+    is written again when the revolution after the next one is published, and its sequence changes at that moment.
+    A consumer outside of the thread feeding the stream must read the sequence before using the revolution and check
+    that it is still the same at the end (otherwise, its results are to be dropped).
+    """
+    def __init__(self):
+        super().__init__()
+        self.packet_times = np.full(PACKETS_PER_REVOLUTION, np.nan)  # s, monotonic time of reception, by packet index
+        self.sequence = -1  # number of the revolution, from 0
+        self.end_time = None  # type: float # s, monotonic time of reception of its last packet
+
+    def age(self, now):
+        """
+        :param now: The current monotonic time, from the time source of the PacketStream.
+        :type now: float
+        :return: The time since the reception of the last packet of the revolution, in seconds.
+        :rtype: float
+        """
+        return now - self.end_time
+
+    def _arrays(self):
+        return self.distance, self.quality, self.valid, self.warning, self.received, self.packet_times
+
+    def _copy_from(self, revolution):
+        for array, source in zip(self._arrays(), revolution._arrays()):
+            array.flags.writeable = True
+            np.copyto(array, source)
+
+    def _freeze(self):
+        for array in self._arrays():
+            array.flags.writeable = False
+
+
+class PacketStream:
+    """
+    Cuts the byte stream of the lidar in packets and decodes them into revolutions. The packet starts are found with
+    bytearray.find, the bytes of an incomplete packet are kept for the next feed, and nothing is flushed.
+
+    The revolutions are written in turn in REVOLUTION_BUFFERS LidarRevolution buffers : a revolution ends when a packet
+    index is not greater than the previous one, it is then published in latest (a reference assignment, the readers
+    take no lock) and the next one is written in the next buffer (the one of the revolution before the previous one),
+    starting from a copy of it.
+    """
+    def __init__(self, monotonic=time.monotonic, on_revolution=None):
+        """
+        :param monotonic: Time source of the packet times (eg. Clock.monotonic).
+        :type monotonic: function
+        :param on_revolution: Called (from the thread feeding the stream) with each revolution published, its
+            exceptions are printed.
+        :type on_revolution: function
+        """
+        self.latest = None  # type: LidarRevolution # the last revolution completed
+        self.valid_packets = 0
+        self.invalid_packets = 0  # start byte and packet index found, but wrong checksum
+        self.dropped_bytes = 0  # bytes outside of the valid packets
+        self._monotonic = monotonic
+        self._on_revolution = on_revolution
+        self._buffer = bytearray()
+        self._revolutions = tuple(LidarRevolution() for _ in range(REVOLUTION_BUFFERS))
+        self._pending = self._revolutions[0]
+        self._pending.sequence = 0
+        self._last_index = -1
+
+    @property
+    def pending(self):
+        """
+        :return: The revolution being written (not a snapshot : it changes with the next packets).
+        :rtype: LidarRevolution
+        """
+        return self._pending
+
+    def feed(self, data, now=None):
+        """
+        Decodes the packets completed by data.
+
+        :param data: Bytes read from the lidar.
+        :type data: bytes
+        :param now: Time of the read of data (default : the current time of the time source).
+        :type now: float
+        :return: The number of valid packets decoded.
+        :rtype: int
+        """
+        if now is None:
+            now = self._monotonic()
+        buffer = self._buffer
+        buffer += data
+        decoded = 0
+        position = 0
+        while True:
+            starts, end = self._find_starts(position)
+            if not starts:
+                break
+            packets = np.frombuffer(buffer, np.uint8)[np.array(starts)[:, None] + PACKET_OFFSETS]
+            valid = check_packets(packets)
+            count = int(np.count_nonzero(valid))
+            if count == len(starts):
+                self._write(packets, now)
+                decoded += count
+                position = end
+                break
+            # Maybe a start byte within the data of a packet : look again from the byte after it.
+            first_invalid = int(np.argmin(valid))
+            self._write(packets[:first_invalid], now)
+            decoded += first_invalid
+            self.invalid_packets += 1
+            position = starts[first_invalid] + 1
+        keep = buffer.find(START_BYTES, position)
+        consumed = len(buffer) if keep < 0 else keep
+        self.valid_packets += decoded
+        self.dropped_bytes += consumed - decoded * PACKET_SIZE
+        del buffer[:consumed]
+        return decoded
+
+    def _find_starts(self, position):
+        """
+        :return: The starts of the consecutive complete packets found from position (the next one is looked for just
+            after each of them), and the position after the last one.
+        :rtype: (list[int], int)
+        """
+        buffer = self._buffer
+        last_start = len(buffer) - PACKET_SIZE
+        starts = []
+        start = buffer.find(START_BYTES, position)
+        while 0 <= start <= last_start:
+            if FIRST_INDEX <= buffer[start + 1] <= LAST_INDEX:
+                starts.append(start)
+                position = start + PACKET_SIZE
+                start = buffer.find(START_BYTES, position)
+            else:
+                start = buffer.find(START_BYTES, start + 1)
+        return starts, position
+
+    def _write(self, packets, now):
+        """
+        Writes valid packets in the pending revolution, publishing it when a packet starts the next one.
+        """
+        if not len(packets):
+            return
+        indexes = packets[:, 1].astype(np.intp) - FIRST_INDEX
+        previous = np.empty_like(indexes)
+        previous[0] = self._last_index
+        previous[1:] = indexes[:-1]
+        start = 0
+        for cut in np.flatnonzero(indexes <= previous).tolist():
+            write_points(packets[start:cut], self._pending)
+            self._pending.packet_times[indexes[start:cut]] = now
+            self._publish(now)
+            start = cut
+        write_points(packets[start:], self._pending)
+        self._pending.packet_times[indexes[start:]] = now
+        self._last_index = int(indexes[-1])
 
+    def _publish(self, now):
+        revolution = self._pending
+        revolution.end_time = now
+        revolution._freeze()
+        self.latest = revolution
+        self._pending = self._revolutions[(revolution.sequence + 1) % REVOLUTION_BUFFERS]
+        self._pending.sequence = revolution.sequence + 1
+        self._pending._copy_from(revolution)
+        if self._on_revolution is not None:
+            try:
+                self._on_revolution(revolution)
+            except Exception as err:
+                print(err)
 
-def read_v_2_4(lidar_serial):
-    global lidar_points
-    init_level = 0
-    index = 0
-    cycle = 0
+
+def read_v_2_4(lidar_serial, stream, recorder=None):
+    """
+    Reads the lidar forever (PACKETS_PER_READ packets at least, or all the bytes waiting) and gives the bytes to
+    stream.
+
+    :param lidar_serial: The serial plugged to the lidar.
+    :type lidar_serial: serial.Serial
+    :param stream: Decodes the bytes and publishes the revolutions.
+    :type stream: PacketStream
+    :param recorder: If given, records the bytes read.
+    :type recorder: LidarRecorder
+    """
     while True:
         try:
-            time.sleep(0.00001)  # do not hog the processor power
-            if init_level == 0:
-                b = lidar_serial.read(1)
-                # start byte
-                if b == bytes([0xFA]):
-                    init_level = 1
-                else:
-                    init_level = 0
-            elif init_level == 1:
-                # position index
-                b = lidar_serial.read(1)
-                if bytes([0xA0]) <= b <= bytes([0xF9]):
-                    index = int.from_bytes(b, byteorder='big') - 0xA0
-                    init_level = 2
-                elif b != bytes([0xFA]):
-                    init_level = 0
-            elif init_level == 2:
-                # speed
-                b_speed = [b for b in lidar_serial.read(2)]
-
-                # data
-                b_data0 = [b for b in lidar_serial.read(4)]
-                b_data1 = [b for b in lidar_serial.read(4)]
-                b_data2 = [b for b in lidar_serial.read(4)]
-                b_data3 = [b for b in lidar_serial.read(4)]
-
-                # for the checksum, we need all the data of the packet...
-                # this could be collected in a more elegent fashion...
-                all_data = [0xFA, index + 0xA0] + b_speed + b_data0 + b_data1 + b_data2 + b_data3
-
-                # checksum
-                b_checksum = [b for b in lidar_serial.read(2)]
-                incoming_checksum = int(b_checksum[0]) + (int(b_checksum[1]) << 8)
-
-                # verify that the received checksum is equal to the one computed from the data
-                if checksum(all_data) == incoming_checksum:
-                    # speed_rpm = compute_speed(b_speed)
-                    # gui_update_speed(speed_rpm)
-
-                    # motor_control(speed_rpm)
-
-                    lidar_points[index * 4 + 0] = new_lidar_point(index * 4 + 0, b_data0)
-                    lidar_points[index * 4 + 1] = new_lidar_point(index * 4 + 1, b_data1)
-                    lidar_points[index * 4 + 2] = new_lidar_point(index * 4 + 2, b_data2)
-                    lidar_points[index * 4 + 3] = new_lidar_point(index * 4 + 3, b_data3)
-
-                    if index == packet_per_cyle:
-                        cycle = (cycle + 1) % 2
-                        if cycle == 0:
-                            lidar_serial.flushInput()
-
-                else:
-                    pass
-                    # the checksum does not match, something went wrong...
-                    # nb_errors += 1
-                    # label_errors.text = "errors: " + str(nb_errors)
-                    #
-                    # # display the samples in an error state
-                    # update_view(index * 4 + 0, [0, 0x80, 0, 0])
-                    # update_view(index * 4 + 1, [0, 0x80, 0, 0])
-                    # update_view(index * 4 + 2, [0, 0x80, 0, 0])
-                    # update_view(index * 4 + 3, [0, 0x80, 0, 0])
-
-                init_level = 0  # reset and wait for the next packet
-
-            else:  # default, should never happen...
-                init_level = 0
+            data = lidar_serial.read(max(PACKETS_PER_READ * PACKET_SIZE, lidar_serial.in_waiting))
+            if recorder is not None:
+                recorder.record(data)
+            stream.feed(data)
         except Exception as err:
             print(err)
 
 
-def new_lidar_point(angle, data):
-    x = data[0]
-    x1 = data[1]
-    x2 = data[2]
-    x3 = data[3]
-    dist_mm = x | ((x1 & 0x3f) << 8)  # distance is coded on 13 bits ? 14 bits ?
-    quality = x2 | (x3 << 8)  # quality is on 16 bits
-    return LidarPoint(angle, dist_mm, quality, not (x1 & 0x80),  bool(x1 & 0x40), 0)
+def replay_v_2_4(path, stream, speed=None, clock=None):
+    """
+    Gives the bytes of a recording to stream, as read_v_2_4 does with the lidar, and returns at its end.
+
+    :param path: The recording (see LidarRecorder).
+    :type path: str
+    :param stream: Decodes the bytes and publishes the revolutions.
+    :type stream: PacketStream
+    :param speed: 1 for the original pace, 2 for twice as fast... The packet times are then the ones of the time
+        source of stream. None to replay as fast as possible, with the recorded packet times.
+    :type speed: float
+    :param clock: Time source used to wait, with speed (default : wall clock).
+    :type clock: clock.Clock
+    :return: The number of reads replayed.
+    :rtype: int
+    """
+    _, records = read_recording(path)
+    monotonic, sleep = (time.monotonic, time.sleep) if clock is None else (clock.monotonic, clock.sleep)
+    replay_start = monotonic()
+    recording_start = records[0][0] if records else 0.
+    for timestamp, data in records:
+        if speed is not None:
+            delay = (timestamp - recording_start) / speed - (monotonic() - replay_start)
+            if delay > 0:
+                sleep(delay)
+        try:
+            stream.feed(data, timestamp if speed is None else None)
+        except Exception as err:
+            print(err)
+    return len(records)
+
+
+class LidarRecorder:
+    """
+    Appends the bytes read from the lidar to a recording (about 10 kB per second). record() and close() can be called
+    from different threads.
+    """
+    def __init__(self, path, monotonic=time.monotonic):
+        """
+        :param path: The recording, overwritten if it exists.
+        :type path: str
+        :param monotonic: Time source of the records (eg. Clock.monotonic).
+        :type monotonic: function
+        """
+        self.path = path
+        self._monotonic = monotonic
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb', buffering=0)  # a record per read, kept if the robot is stopped abruptly
+        self._file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, time.time()))
+
+    def record(self, data):
+        """
+        :param data: The bytes read.
+        :type data: bytes
+        """
+        now = self._monotonic()
+        with self._lock:
+            if self._file is None:
+                return
+            for start in range(0, len(data), RECORD_MAX_SIZE):
+                chunk = data[start:start + RECORD_MAX_SIZE]
+                self._file.write(RECORD_HEADER.pack(now, len(chunk)) + chunk)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path):
+    """
+    :param path: The recording.
+    :type path: str
+    :return: The wall time of the start of the recording, and the reads (monotonic time, bytes), in recording order.
+    :rtype: (float, list[(float, bytes)])
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < RECORDING_HEADER.size or RECORDING_HEADER.unpack_from(data, 0)[0] != RECORDING_MAGIC:
+        raise ValueError("{} is not a lidar recording".format(path))
+    start_time = RECORDING_HEADER.unpack_from(data, 0)[1]
+    records = []
+    offset = RECORDING_HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+        timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            break
+        records.append((timestamp, data[offset:offset + length]))
+        offset += length
+    return start_time, records
+
+
+def check_packets(packets):
+    """
+    :param packets: The packets, one per row.
+    :type packets: numpy.ndarray
+    :return: Which packets are valid (start byte, packet index and checksum).
+    :rtype: numpy.ndarray
+    """
+    words = packets[:, 0:20:2].astype(np.int64) | (packets[:, 1:20:2].astype(np.int64) << 8)
+    chk32 = words @ CHECKSUM_WEIGHTS
+    computed = ((chk32 & 0x7FFF) + (chk32 >> 15)) & 0x7FFF
+    received = packets[:, 20].astype(np.int64) | (packets[:, 21].astype(np.int64) << 8)
+    indexes = packets[:, 1]
+    return (computed == received) & (packets[:, 0] == START_BYTE) & (indexes >= FIRST_INDEX) & (indexes <= LAST_INDEX)
+
+
+def write_points(packets, scan):
+    """
+    Writes the points of valid packets in scan, all at once.
+
+    :param packets: The packets, one per row.
+    :type packets: numpy.ndarray
+    :param scan: Where to write the points.
+    :type scan: LidarScan
+    """
+    # points[packet, point, byte] : distance on 14 bits (bit 7 of byte 1 : invalid, bit 6 : warning), quality
+    points = packets[:, 4:20].reshape(-1, POINTS_PER_PACKET, 4)
+    azimuts = (packets[:, 1:2].astype(np.intp) - FIRST_INDEX) * POINTS_PER_PACKET + POINT_OFFSETS
+    flags = points[:, :, 1]
+    scan.distance[azimuts] = points[:, :, 0] | ((flags & 0x3F).astype(np.uint16) << 8)
+    scan.quality[azimuts] = points[:, :, 2] | (points[:, :, 3].astype(np.uint16) << 8)
+    scan.valid[azimuts] = (flags & 0x80) == 0
+    scan.warning[azimuts] = (flags & 0x40) != 0
+    scan.received[azimuts] = True
 
 
 def checksum(data):
@@ -140,3 +451,26 @@ def checksum(data):
     checksum = checksum & 0x7FFF  # truncate to 15 bits
     return int(checksum)
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Summary and replay of a lidar recording.")
+    parser.add_argument('recording', type=str, help="The recording (see robot.py --lidar_record).")
+    parser.add_argument('--speed', type=float, default=None,
+                        help="Replay speed (1 : original pace, default : as fast as possible).")
+    args = parser.parse_args()
+
+    start_time, records = read_recording(args.recording)
+    duration = records[-1][0] - records[0][0] if records else 0.
+    print("Recorded on {} : {} reads over {:.1f} s, {} bytes".format(
+        time.ctime(start_time), len(records), duration, sum(len(data) for _, data in records)))
+    stream = PacketStream()
+    wall_start = time.perf_counter()
+    replay_v_2_4(args.recording, stream, args.speed)
+    wall_time = time.perf_counter() - wall_start
+    revolutions = 0 if stream.latest is None else stream.latest.sequence + 1
+    print("Replayed in {:.3f} s : {} revolutions, {} valid packets, {} invalid packets, {} bytes dropped".format(
+        wall_time, revolutions, stream.valid_packets, stream.invalid_packets, stream.dropped_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,12 @@ import threading, serial
 
 import math
 
-from drivers.neato_xv11_lidar import lidar_points, read_v_2_4
+from communication.send_window import Priority
+from drivers.neato_xv11_lidar import PacketStream, LidarRecorder, read_v_2_4, replay_v_2_4, cone_azimuts, AZIMUT_COUNT
+from lidar_cloud import LidarPointCloud
+from opponent_tracker import OpponentTracker
 from drivers.line_detector_cny70 import LineDetector
+from drivers.lidar_process import LidarProcess
 
 
 LIDAR_SERIAL_PATH = "/dev/ttyUSB0"
@@ -29,7 +33,25 @@ class ActuatorID(Enum):
 
 
 class IO(object):
-    def __init__(self, robot):
+    def __init__(self, robot, lidar_serial_path=LIDAR_SERIAL_PATH, line_detector=None, lidar_record_path=None,
+                 lidar_replay_path=None, lidar_process=False):
+        """
+        The lidar is started by start_lidar, once the robot has its map and its locomotion.
+
+        :param lidar_serial_path: Path of the serial plugged to the lidar, None to run without lidar.
+        :type lidar_serial_path: str
+        :param lidar_record_path: If given, the bytes read from the lidar are recorded in this file (see
+            drivers.neato_xv11_lidar.LidarRecorder).
+        :type lidar_record_path: str
+        :param lidar_replay_path: If given, this recording is replayed at the original pace instead of reading the
+            lidar.
+        :type lidar_replay_path: str
+        :param lidar_process: If True, the lidar is read and decoded in a child process (see
+            drivers.lidar_process.LidarProcess), else in a thread.
+        :type lidar_process: bool
+        :param line_detector: The line detector (default : the CNY70 one, on the I2C bus).
+        :type line_detector: LineDetector
+        """
         self.robot = robot
         self.cord_state = None
         self.button1_state = None
@@ -46,10 +68,19 @@ class IO(object):
         self.bee_arm_orange_state = None
         self.ball_count_orange = 0
         self.ball_count_green = 0
-        self.lidar_serial = serial.Serial(LIDAR_SERIAL_PATH, LIDAR_SERIAL_BAUDRATE)
-        self.lidar_thread = threading.Thread(target=read_v_2_4, args=(self.lidar_serial,))
-        self.lidar_thread.start()
-        self.line_detector = LineDetector()
+        self.lidar_serial = None
+        self.lidar_thread = None
+        self.lidar_recorder = None  # type: LidarRecorder
+        self.lidar_process = None  # type: LidarProcess
+        self.opponent_tracker = OpponentTracker()
+        self.lidar_stream = PacketStream(self.robot.clock.monotonic)
+        self._lidar_point_cloud = None  # type: LidarPointCloud
+        self._lidar_point_cloud_lock = threading.Lock()  # the cloud is computed by the control loop or the lidar thread
+        self._lidar_serial_path = lidar_serial_path
+        self._lidar_record_path = lidar_record_path
+        self._lidar_replay_path = lidar_replay_path
+        self._lidar_use_process = lidar_process
+        self.line_detector = LineDetector() if line_detector is None else line_detector
         self.robot.communication.register_callback(self.robot.communication.eTypeUp.HMI_STATE, self._on_hmi_state_receive)
         self.robot.communication.register_callback(self.robot.communication.eTypeUp.SENSOR_VALUE, self._on_sensor_value_receive)
 
@@ -61,9 +92,96 @@ class IO(object):
         self.raise_bee_arm_green()
         self.score_display_fat()
 
+    def start_lidar(self):
+        """
+        Starts reading (or replaying) the lidar. Each revolution is projected with the pose history of the locomotion
+        and classified with the map, which must exist.
+        """
+        self.lidar_stream = PacketStream(self.robot.clock.monotonic, self._on_lidar_revolution)
+        if self._lidar_replay_path is not None:
+            self.lidar_thread = threading.Thread(target=replay_v_2_4, args=(self._lidar_replay_path, self.lidar_stream,
+                                                                           1, self.robot.clock), daemon=True)
+            self.lidar_thread.start()
+        elif self._lidar_serial_path is not None and self._lidar_use_process:
+            self.lidar_process = LidarProcess(self._lidar_serial_path, LIDAR_SERIAL_BAUDRATE, self._lidar_record_path,
+                                              self._on_lidar_revolution)
+            self.lidar_stream = self.lidar_process.stream
+        elif self._lidar_serial_path is not None:
+            self.lidar_serial = serial.Serial(self._lidar_serial_path, LIDAR_SERIAL_BAUDRATE)
+            if self._lidar_record_path is not None:
+                self.lidar_recorder = LidarRecorder(self._lidar_record_path, self.robot.clock.monotonic)
+            self.lidar_thread = threading.Thread(target=read_v_2_4, args=(self.lidar_serial, self.lidar_stream,
+                                                                         self.lidar_recorder))
+            self.lidar_thread.start()
+
+    def stop_lidar(self):
+        """
+        Stops the lidar process and closes the recording of the lidar, if any.
+        """
+        if self.lidar_process is not None:
+            self.lidar_process.stop()
+        if self.lidar_recorder is not None:
+            self.lidar_recorder.close()
+
+    @property
+    def lidar_revolution(self):
+        """
+        :return: The last complete revolution of the lidar (a snapshot, see LidarRevolution), None before the first one.
+        :rtype: drivers.neato_xv11_lidar.LidarRevolution
+        """
+        return self.lidar_stream.latest
+
+    @property
+    def lidar_age(self):
+        """
+        :return: The time since the end of the last complete revolution of the lidar in seconds, None before the first
+            one.
+        :rtype: float
+        """
+        revolution = self.lidar_stream.latest
+        return None if revolution is None else revolution.age(self.robot.clock.monotonic())
+
+    @property
+    def lidar_point_cloud(self):
+        """
+        :return: The last complete revolution of the lidar projected on the table with the pose history of the
+            locomotion, computed once per revolution, None before the first one.
+        :rtype: LidarPointCloud
+        """
+        with self._lidar_point_cloud_lock:
+            revolution = self.lidar_stream.latest
+            while revolution is not None and (self._lidar_point_cloud is None or
+                                              self._lidar_point_cloud.sequence != revolution.sequence):
+                sequence = revolution.sequence
+                if sequence >= 0:  # else the lidar process is writing the revolution : read it again
+                    cloud = LidarPointCloud(revolution, self.robot.locomotion.pose_history)
+                    # else its buffer has been written again during the computation, or a newer one has been published
+                    if revolution.sequence == sequence and self.lidar_stream.latest.sequence == sequence:
+                        self._lidar_point_cloud = cloud
+                revolution = self.lidar_stream.latest
+            return None if revolution is None else self._lidar_point_cloud
+
+    @property
+    def opponents(self):
+        """
+        :return: The robots seen by the lidar, as estimated at the last revolution (see OpponentTracker).
+        :rtype: tuple[opponent_tracker.Opponent]
+        """
+        return self.opponent_tracker.opponents
+
+    def _on_lidar_revolution(self, revolution):
+        cloud = self.lidar_point_cloud
+        xs, ys = cloud.x[cloud.usable], cloud.y[cloud.usable]
+        on_table, in_obstacle = self.robot.map.classify_lidar_points(xs, ys)
+        unmasked = on_table & ~in_obstacle
+        self.opponent_tracker.update(xs[unmasked], ys[unmasked], cloud.end_time)
+
     @property
     def lidar_points(self):
-        return lidar_points[:] # returns a copy of the lidar point to avoid modification while iterating over the array
+        revolution = self.lidar_stream.latest
+        if revolution is None:
+            return [None] * AZIMUT_COUNT
+        return revolution.points()
 
     class SensorId(Enum):
         BATTERY_SIGNAL = 0
@@ -163,35 +281,44 @@ class IO(object):
             if __debug__:
                 print("[IO] Stop orange water cannon")
 
+    # The leds and the score display are set without waiting for the Teensy (their commands have the lowest priority,
+    # see send_window.Priority) : the state below is updated when the command is acknowledged.
+
     def set_led_color(self, color):
         if isinstance(color, self.LedColor):
             color = color.value
-        if self.robot.communication.send_hmi_command(*color) == 0:
-            self.led_color = color
-            if __debug__:
-                print("[IO] Led switched to {}".format(color))
+
+        def on_sent(result):
+            if result == 0:
+                self.led_color = color
+                if __debug__:
+                    print("[IO] Led switched to {}".format(color))
+        self.robot.communication.send_hmi_command_async(*color).add_done_callback(on_sent)
 
     def score_display_fat(self):
-        if self.robot.communication.send_actuator_command(ActuatorID.SCORE_COUNTER.value, self.ScoreDisplayTexts.FAT.value) == 0:
-            self.score_display_text = "FAT"
-            print("[IO] Score display displays " + self.score_display_text)
+        self._send_score_display(self.ScoreDisplayTexts.FAT.value, "FAT")
 
     def score_display_enac(self):
-        if self.robot.communication.send_actuator_command(ActuatorID.SCORE_COUNTER.value, self.ScoreDisplayTexts.ENAC.value) == 0:
-            self.score_display_text = "ENAC"
-            print("[IO] Score display displays " + self.score_display_text)
+        self._send_score_display(self.ScoreDisplayTexts.ENAC.value, "ENAC")
 
     def score_display_number(self, number, with_two_points=False):
         command = number
         if with_two_points:
             command += 10000
-        if self.robot.communication.send_actuator_command(ActuatorID.SCORE_COUNTER.value, command) == 0:
-            if with_two_points:
-                self.score_display_text = str(number)[:-2] + ":" + str(number)[-2:]
-                #FIXME: Not working with number = 4 (text = ":4" instead of ": 4")
-            else:
-                self.score_display_text = str(number)
-            print("[IO] Score display displays " + self.score_display_text)
+            text = str(number)[:-2] + ":" + str(number)[-2:]
+            #FIXME: Not working with number = 4 (text = ":4" instead of ": 4")
+        else:
+            text = str(number)
+        self._send_score_display(command, text)
+
+    def _send_score_display(self, command, text):
+        def on_sent(result):
+            if result == 0:
+                self.score_display_text = text
+                print("[IO] Score display displays " + self.score_display_text)
+        self.robot.communication.send_actuator_command_async(ActuatorID.SCORE_COUNTER.value, command,
+                                                             priority=Priority.HMI,
+                                                             supersedable=True).add_done_callback(on_sent)
 
     def raise_bee_arm_green(self):
         if self.robot.communication.send_actuator_command(ActuatorID.BEE_ARM_GREEN.value, self.BeeArmState.RAISED.value[0]) == 0:
@@ -232,37 +359,47 @@ class IO(object):
     def _bit10_to_battery_voltage(self, bit10):
         return bit10 * BIT10_TO_BATTERY_FACTOR
 
+    def lidar_obstacles(self, direction, cone_angle, distance):
+        """
+        Selects the usable points of the cone (see cone_azimuts) closer than distance in lidar_point_cloud, and
+        classifies them with Map.classify_lidar_points, as array operations.
+
+        :param direction: Direction of the cone in the robot frame, in radians.
+        :type direction: float
+        :param cone_angle: Half angle of the cone, in degrees.
+        :type cone_angle: float
+        :param distance: Points further than this distance (in mm) are ignored.
+        :type distance: float
+        :return: The table coordinates (xs, ys) of the points on the table and out of the static obstacles, and of the
+            points in the static obstacles. None before the first revolution of the lidar.
+        :rtype: ((numpy.ndarray, numpy.ndarray), (numpy.ndarray, numpy.ndarray))
+        """
+        cloud = self.lidar_point_cloud
+        if cloud is None:
+            return None
+        azimuts = cone_azimuts(round(math.degrees(direction)) % AZIMUT_COUNT, math.floor(cone_angle))
+        azimuts = azimuts[cloud.usable[azimuts] & (cloud.distance[azimuts] < distance)]
+        xs, ys = cloud.x[azimuts], cloud.y[azimuts]
+        on_table, in_obstacle = self.robot.map.classify_lidar_points(xs, ys)
+        obstacles = on_table & ~in_obstacle
+        masked = on_table & in_obstacle
+        return (xs[obstacles], ys[obstacles]), (xs[masked], ys[masked])
+
     def is_obstacle_in_cone(self, direction, cone_angle, distance):
-        direction = round(math.degrees(direction))
-        for i in range(len(self.lidar_points)):
-            pt = self.lidar_points[i]
-            if pt is None:
-                return
-            a = (pt.azimut - direction + 180) % 360 - 180
-            if abs(a) <= cone_angle:
-
-                #print(pt.azimut)
-                #print(pt.distance)
-                if pt.valid and not pt.warning and pt.distance < distance:
-                    x_t = self.robot.locomotion.x + pt.distance * math.cos(
-                        math.radians(pt.azimut) + self.robot.locomotion.theta)
-                    y_t = self.robot.locomotion.y + pt.distance * math.sin(
-                        math.radians(pt.azimut) + self.robot.locomotion.theta)
-                    if not self.robot.map.lidar_table_bb.contains(x_t, y_t):
-                        continue
-                    in_mask = False
-                    for mask in self.robot.map.lidar_static_obstacles_bb:
-                        if mask.contains(x_t, y_t):
-                            self.robot.ivy.highlight_point(50, x_t, y_t)
-                            in_mask = True
-                            break
-                    if in_mask:
-                        continue
-                    self.robot.ivy.highlight_point(51, x_t, y_t)
-                    # print(x_t, y_t)
-                    # print(pt.azimut, pt.distance)
-                    return True
-        return False
+        """
+        see lidar_obstacles, whose points are highlighted on Ivy.
+
+        :return: True if there is an obstacle in the cone, None before the first revolution of the lidar.
+        :rtype: bool
+        """
+        detected = self.lidar_obstacles(direction, cone_angle, distance)
+        if detected is None:
+            return
+        obstacles, masked = detected
+        if self.robot.ivy is not None:
+            self.robot.ivy.highlight_points(50, *masked)
+            self.robot.ivy.highlight_points(51, *obstacles)
+        return len(obstacles[0]) > 0
 
 
 # class USReader(threading.Thread):
@@ -41,6 +41,16 @@ class Ivy:
     def highlight_point(self, ident, x, y):
         IvySendMsg(HIGHLIGHT_POINT_REGEXP.format(str(ident) + ';' + str(x) + ';' + str(y)))
 
+    def highlight_points(self, ident, xs, ys):
+        """
+        :param xs: x of the points to highlight.
+        :type xs: numpy.ndarray
+        :param ys: y of the points to highlight.
+        :type ys: numpy.ndarray
+        """
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            self.highlight_point(ident, x, y)
+
     def highlight_robot_angle(self, ident, theta):
         IvySendMsg(HIGHLIGHT_ANGLE_REGEXP.format(str(ident) + ";" + str(theta)))
 
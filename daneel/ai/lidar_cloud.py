@@ -0,0 +1,35 @@
+"""
+Lidar revolutions projected on the table with the pose of the robot at the reception of each packet.
+"""
+
+import numpy as np
+
+from drivers.neato_xv11_lidar import AZIMUT_COS, AZIMUT_SIN, POINTS_PER_PACKET
+
+
+class LidarPointCloud:
+    """
+    The points of a LidarRevolution in the table frame (mm), indexed by azimut like the revolution.
+
+    The pose of the robot is interpolated in a locomotion.PoseHistory at the reception time of each packet, which
+    undoes the move of the robot during the revolution (about 200 ms). The points not usable (not received, not valid
+    or with a warning) have nan coordinates. The arrays are computed once and not shared with the revolution.
+    """
+    def __init__(self, revolution, pose_history):
+        """
+        :param revolution: The revolution, kept unchanged during the computation (see LidarRevolution.sequence).
+        :type revolution: drivers.neato_xv11_lidar.LidarRevolution
+        :param pose_history: The poses of the robot, on the time source of the revolution.
+        :type pose_history: locomotion.PoseHistory
+        """
+        self.sequence = revolution.sequence
+        self.end_time = revolution.end_time  # type: float
+        self.distance = revolution.distance.astype(float)  # mm
+        self.usable = revolution.received & revolution.valid & ~revolution.warning
+        robot_x, robot_y, robot_theta = (np.repeat(pose, POINTS_PER_PACKET)
+                                         for pose in pose_history.poses_at(revolution.packet_times))
+        cos_theta, sin_theta = np.cos(robot_theta), np.sin(robot_theta)
+        self.x = robot_x + self.distance * (AZIMUT_COS * cos_theta - AZIMUT_SIN * sin_theta)
+        self.y = robot_y + self.distance * (AZIMUT_SIN * cos_theta + AZIMUT_COS * sin_theta)
+        self.x[~self.usable] = np.nan
+        self.y[~self.usable] = np.nan
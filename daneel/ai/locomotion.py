@@ -1,8 +1,10 @@
 import math
-import time
+import threading
 from collections import namedtuple
 from enum import Enum
 
+import numpy as np
+
 ACCELERATION_MAX = 300  # mm/s²
 LINEAR_SPEED_MAX = 200  # mm/s
 ADMITTED_POSITION_ERROR = 10  # mm
@@ -11,6 +13,11 @@ ROTATION_ACCELERATION_MAX = 0.8  # rad/s²
 ROTATION_SPEED_MAX = 0.7  # rad/s
 ADMITTED_ANGLE_ERROR = 0.05  # rad
 
+ODOMETRY_REPORT_IDS = 256  # the odometry report ids are 8 bits
+ODOMETRY_REPORT_WINDOW = 128  # a report id up to 127 reports before (after) the latest one is older (newer)
+POSE_HISTORY_SIZE = 32  # poses kept, about 6 s with an odometry report every 200 ms (base/code/params.h)
+POSE_EXTRAPOLATION_LIMIT = 0.25  # s, the pose is extrapolated at most this long after the last one
+
 Speed = namedtuple("Speed", ['vx', 'vy', 'vtheta'])
 GoalPoint = namedtuple("GoalPoint", ['goal_point', 'goal_speed'])
 
@@ -30,6 +37,67 @@ class LocomotionState(Enum):
     REPOSITIONING = 3
 
 
+class PoseHistory:
+    """
+    The last poses of the robot with their monotonic time, to know where the robot was when a sensor measured
+    something (see poses_at). theta is kept continuous (not centered) so that it can be interpolated. It is appended
+    to by the odometry callback and read from the lidar thread, under a lock.
+    """
+    def __init__(self, size=POSE_HISTORY_SIZE):
+        # time, x, y, theta ; each pose is written at i and i + size, so the poses from the oldest one are always the
+        # columns _next to _next + size
+        self._poses = np.full((4, 2 * size), np.nan)
+        self._size = size
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, time, x, y, theta):
+        """
+        :param time: Monotonic time of the pose, not before the time of the last one.
+        :type time: float
+        """
+        with self._lock:
+            if self._count:
+                last_theta = self._poses[3, self._next + self._size - 1]
+                theta = last_theta + center_radians(theta - last_theta)
+            self._poses[:, self._next] = self._poses[:, self._next + self._size] = time, x, y, theta
+            self._next = (self._next + 1) % self._size
+            self._count = min(self._count + 1, self._size)
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def poses_at(self, times):
+        """
+        Interpolates the poses linearly between the poses of the history. Before the oldest pose, it is the oldest
+        pose. After the last pose, the move between the last two poses is extrapolated for at most
+        POSE_EXTRAPOLATION_LIMIT seconds.
+
+        :param times: Monotonic times, with at least one pose in the history.
+        :type times: numpy.ndarray
+        :return: x, y and theta (not centered) of the robot at times.
+        :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        """
+        with self._lock:
+            end = self._next + self._size
+            history_times, xs, ys, thetas = self._poses[:, end - self._count:end].copy()
+        poses = tuple(np.interp(times, history_times, values) for values in (xs, ys, thetas))
+        if len(history_times) < 2:
+            return poses
+        span = history_times[-1] - history_times[-2]
+        late = times > history_times[-1]
+        if span > 0 and late.any():
+            ratios = (np.minimum(times[late], history_times[-1] + POSE_EXTRAPOLATION_LIMIT) - history_times[-1]) / span
+            for pose, values in zip(poses, (xs, ys, thetas)):
+                pose[late] += ratios * (values[-1] - values[-2])
+        return poses
+
+
 class Locomotion:
     def __init__(self, robot):
         self.robot = robot
@@ -61,50 +129,59 @@ class Locomotion:
         self.robot.communication.register_callback(self.robot.communication.eTypeUp.ODOM_REPORT,
                                                    self.handle_new_odometry_report)
         self._last_position_control_time = None
-        self._odometry_reports = {}  # type: dict[(int, int): (float, float, float)]
+        # Ring indexed by report id : (report number since the start, x, y, theta cumulated since the start) of the
+        # reports received. The number tells a slot of the last ODOMETRY_REPORT_WINDOW reports from an older one.
+        self._odometry_reports = [None] * ODOMETRY_REPORT_IDS  # type: list[(int, float, float, float)]
+        self._odometry_reports[0] = (0, 0., 0., 0.)
         self._latest_odometry_report = 0
+        self._latest_odometry_report_number = 0
+        self.pose_history = PoseHistory()
+        self.pose_history.append(self.robot.clock.monotonic(), self.x, self.y, self.theta)
 
     def handle_new_odometry_report(self, old_report_id, new_report_id, dx, dy, dtheta):
-        if (new_report_id - self._latest_odometry_report + 256) % 256 < 128:
-            if old_report_id - self._latest_odometry_report > 128:
-                #  Need to find previous report and add the new information
-                for ids, deltas in list(self._odometry_reports.items()):
-                    if ids[0] == old_report_id and ids[1] == self._latest_odometry_report:
-                        self.x -= deltas[0]
-                        self.y -= deltas[1]
-                        self.theta = center_radians(self.theta - deltas[2])
-                        break
-                # in fact we search for old_report_id -> _latest_odemtry_report, but what we need is
-                #  a CHAIN going from old_report_id to _latest_odemetry_report and substract each node (and add them if
-                # they overlap).
-
-                self.x += dx
-                self.y += dy
-                self.theta = center_radians(self.theta + dtheta)
-
-                self._odometry_reports[(old_report_id, new_report_id)] = (dx, dy, dtheta)
-            elif old_report_id == self._latest_odometry_report:
-                # Nominal case, the new report brings only new information
-                self.x += dx
-                self.y += dy
-                self.theta = center_radians(self.theta + dtheta)
-
-                self._odometry_reports[(old_report_id, new_report_id)] = (dx, dy, dtheta)
-            else:
-                # Should not happen, information has been missed
-                pass
-            self._latest_odometry_report = new_report_id
-        elif new_report_id == self._latest_odometry_report:
-            # We already have this information, but it may worth to update it
-            pass
+        """
+        A report holds the move from report old_report_id (the last one the Teensy knows acknowledged) to
+        new_report_id, so it sums up all the reports not acknowledged in between. Its cumulated pose is the one of
+        old_report_id plus the move, whatever the reports lost or received out of order : the position is then
+        corrected by the difference with the cumulated pose of the latest report.
+        """
+        age = (self._latest_odometry_report - new_report_id) % ODOMETRY_REPORT_IDS
+        if age == 0:
+            return  # already known
+        origin = self._odometry_report(old_report_id)
+        if age < ODOMETRY_REPORT_WINDOW:
+            # Received out of order : its pose may be the origin of the next reports
+            if origin is not None and self._odometry_report(new_report_id) is None:
+                self._odometry_reports[new_report_id] = (self._latest_odometry_report_number - age, origin[1] + dx,
+                                                         origin[2] + dy, origin[3] + dtheta)
+            return
+        latest = self._odometry_reports[self._latest_odometry_report]
+        number = self._latest_odometry_report_number + ODOMETRY_REPORT_IDS - age
+        if origin is None:
+            # The origin has been missed (eg. acknowledged before the locomotion started) : the move of this report is
+            # lost, but the next ones can be placed from it
+            report = (number,) + latest[1:]
         else:
-            # Only old information; it probably don't worth to update it...
-            pass
-
-        # Delete all the old reports (those taken into account by the teensy)
-        for ids, delta in list(self._odometry_reports.items()):
-            if (ids[1] - old_report_id + 256) % 256 == 0 or (ids[1] - old_report_id + 256) % 256 > 128:
-                del (self._odometry_reports[ids])
+            report = (number, origin[1] + dx, origin[2] + dy, origin[3] + dtheta)
+            self.x += report[1] - latest[1]
+            self.y += report[2] - latest[2]
+            self.theta = center_radians(self.theta + report[3] - latest[3])
+            self.pose_history.append(self.robot.clock.monotonic(), self.x, self.y, self.theta)
+        self._odometry_reports[new_report_id] = report
+        self._latest_odometry_report = new_report_id
+        self._latest_odometry_report_number = number
+
+    def _odometry_report(self, report_id):
+        """
+        :return: The slot of report_id if it has been received and is one of the last ODOMETRY_REPORT_WINDOW reports,
+            else None.
+        :rtype: (int, float, float, float)
+        """
+        age = (self._latest_odometry_report - report_id) % ODOMETRY_REPORT_IDS
+        report = self._odometry_reports[report_id]
+        if age >= ODOMETRY_REPORT_WINDOW or report is None or report[0] != self._latest_odometry_report_number - age:
+            return None
+        return report
 
     def go_to_orient(self, x, y, theta):
         self.mode = LocomotionState.POSITION_CONTROL
@@ -154,7 +231,7 @@ class Locomotion:
         return False
 
     def locomotion_loop(self, obstacle_detection=False):
-        control_time = time.time()
+        control_time = self.robot.clock.time()
         if self._last_position_control_time is None:
             delta_time = 0
         else:
@@ -200,7 +277,7 @@ class Locomotion:
             vy_r = wanted_speed.vx * -math.sin(self.theta) + wanted_speed.vy * math.cos(self.theta)
             self.handle_obstacle(Speed(vx_r, vy_r, 0), 35, 350)
         self.current_speed = speed
-        self.robot.communication.send_speed_command(*self.current_speed)
+        self.robot.communication.send_speed_command_async(*self.current_speed)
 
     def stop(self):
         self.previous_mode = self.mode
@@ -287,7 +364,8 @@ class Locomotion:
                     self.position_control_speed_goal = self.trajectory[0].goal_speed
 
         if self.current_point_objective is not None:
-            self.robot.ivy.highlight_point(0, self.current_point_objective.x, self.current_point_objective.y)
+            if self.robot.ivy is not None:
+                self.robot.ivy.highlight_point(0, self.current_point_objective.x, self.current_point_objective.y)
             distance_to_objective = self.current_point_objective.lin_distance_to(self.x, self.y)
             # if distance_to_objective <= ADMITTED_POSITION_ERROR:
             #     self.current_point_objective = None
@@ -306,7 +384,8 @@ class Locomotion:
                 # current_speed_alpha = math.atan2(self.current_speed[1], self.current_speed[0])
                 planned_stop_point = self.Point(self.x + reach_speed_length * math.cos(alpha),
                                                 self.y + reach_speed_length * math.sin(alpha))
-                self.robot.ivy.highlight_point(1, planned_stop_point.x, planned_stop_point.y)
+                if self.robot.ivy is not None:
+                    self.robot.ivy.highlight_point(1, planned_stop_point.x, planned_stop_point.y)
                 planned_stop_error = planned_stop_point.lin_distance_to_point(self.current_point_objective)
                 if planned_stop_error <= ADMITTED_POSITION_ERROR or planned_stop_point.lin_distance_to(self.x,
                                                                                                        self.y) > distance_to_objective:
@@ -321,8 +400,9 @@ class Locomotion:
                 self.theta + rotation_error_sign * 2.5 * (
                     abs(
                         self.current_speed.vtheta) * t_rotation_stop - 1 / 2 * ROTATION_ACCELERATION_MAX * t_rotation_stop ** 2))
-            self.robot.ivy.highlight_robot_angle(0, self.current_point_objective.theta)
-            self.robot.ivy.highlight_robot_angle(1, planned_stop_angle)
+            if self.robot.ivy is not None:
+                self.robot.ivy.highlight_robot_angle(0, self.current_point_objective.theta)
+                self.robot.ivy.highlight_robot_angle(1, planned_stop_angle)
             if abs(center_radians(
                             planned_stop_angle - self.current_point_objective.theta)) <= ADMITTED_ANGLE_ERROR or abs(
                 center_radians(planned_stop_angle - self.theta)) > abs(
@@ -365,6 +445,9 @@ class Locomotion:
         self.y = y
         if self.robot.communication.send_theta_repositioning(theta) == 0:
             self.theta = theta
+        # The previous poses are in the frame before the repositioning
+        self.pose_history.clear()
+        self.pose_history.append(self.robot.clock.monotonic(), self.x, self.y, self.theta)
 
     def follow_trajectory(self, points_list):
         """
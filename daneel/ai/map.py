@@ -1,17 +1,30 @@
+import math
+
+import numpy as np
 import yaml
 
+TABLE_WIDTH = 3000  # mm, along x
+TABLE_HEIGHT = 2000  # mm, along y
+LIDAR_MASK_RESOLUTION = 5  # mm, side of the cells of Map._lidar_mask
+LIDAR_MASK_TABLE = 1  # flag of the cells in Map.lidar_table_bb
+LIDAR_MASK_STATIC_OBSTACLE = 2  # flag of the cells in one of Map.lidar_static_obstacles_bb
+
 
 class Map:
     def __init__(self, robot, obstacle_lidar_mask_path):
         self.robot = robot
         self.lidar_table_bb = None  #   type: BoundingBox
         self.lidar_static_obstacles_bb = []  # type: list[BoundingBox]
+        # cells of LIDAR_MASK_RESOLUTION mm with the LIDAR_MASK_* flags, framed by a border of empty cells where the
+        # points outside the table are clipped (see classify_lidar_points)
+        self._lidar_mask = np.zeros((TABLE_WIDTH // LIDAR_MASK_RESOLUTION + 2,
+                                     TABLE_HEIGHT // LIDAR_MASK_RESOLUTION + 2), dtype=np.uint8)
         self.load_lidar_static_obstacle(obstacle_lidar_mask_path)
 
     def load_lidar_static_obstacle(self, obstacle_lidar_mask_path):
         with open(obstacle_lidar_mask_path) as f:
             try:
-                lidar_obstacles_dict = yaml.load(f)
+                lidar_obstacles_dict = yaml.safe_load(f)
             except yaml.YAMLError as exc:
                 lidar_obstacles_dict = None
                 print(exc)
@@ -27,6 +40,51 @@ class Map:
                 x2 = int(o['x_stop'])
                 y2 = int(o['y_stop'])
                 self.lidar_static_obstacles_bb.append(BoundingBox(self.robot, x1, y1, x2, y2))
+            self._rasterize_lidar_mask()
+
+    def _rasterize_lidar_mask(self):
+        """
+        Marks the cells of lidar_table_bb and lidar_static_obstacles_bb in the mask, rounded on the safe side : the
+        cells entirely inside the table (the points up to LIDAR_MASK_RESOLUTION mm inside its border can be rejected,
+        never the points outside), and all the cells touched by the static obstacles (the points up to
+        LIDAR_MASK_RESOLUTION mm around them are masked).
+        """
+        self._lidar_mask[:] = 0
+        last_x, last_y = self._lidar_mask.shape[0] - 2, self._lidar_mask.shape[1] - 2
+        # the cell i of the mask covers [(i - 1) * LIDAR_MASK_RESOLUTION, i * LIDAR_MASK_RESOLUTION[
+        bb = self.lidar_table_bb
+        x1 = max(math.ceil(bb.min_x / LIDAR_MASK_RESOLUTION) + 1, 1)
+        x2 = min(math.floor(bb.max_x / LIDAR_MASK_RESOLUTION), last_x)
+        y1 = max(math.ceil(bb.min_y / LIDAR_MASK_RESOLUTION) + 1, 1)
+        y2 = min(math.floor(bb.max_y / LIDAR_MASK_RESOLUTION), last_y)
+        self._lidar_mask[x1:x2 + 1, y1:y2 + 1] |= LIDAR_MASK_TABLE
+        for bb in self.lidar_static_obstacles_bb:
+            x1 = max(math.floor(bb.min_x / LIDAR_MASK_RESOLUTION) + 1, 1)
+            x2 = min(math.floor(bb.max_x / LIDAR_MASK_RESOLUTION) + 1, last_x)
+            y1 = max(math.floor(bb.min_y / LIDAR_MASK_RESOLUTION) + 1, 1)
+            y2 = min(math.floor(bb.max_y / LIDAR_MASK_RESOLUTION) + 1, last_y)
+            self._lidar_mask[x1:x2 + 1, y1:y2 + 1] |= LIDAR_MASK_STATIC_OBSTACLE
+
+    def classify_lidar_points(self, xs, ys):
+        """
+        Looks up lidar points in the mask rasterized from lidar_table_bb and lidar_static_obstacles_bb, at the same
+        cost whatever the number of boxes.
+
+        :param xs: x of the points on the table (mm).
+        :type xs: numpy.ndarray
+        :param ys: y of the points on the table (mm).
+        :type ys: numpy.ndarray
+        :return: Which points are on the table, and which are in a static obstacle on the table.
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        mask = self._lidar_mask
+        # shifted by one cell, the truncation is the floor for all the points which are not clipped to the border
+        cells_x = np.minimum(np.maximum(((xs + LIDAR_MASK_RESOLUTION) / LIDAR_MASK_RESOLUTION).astype(np.intp), 0),
+                             mask.shape[0] - 1)
+        cells_y = np.minimum(np.maximum(((ys + LIDAR_MASK_RESOLUTION) / LIDAR_MASK_RESOLUTION).astype(np.intp), 0),
+                             mask.shape[1] - 1)
+        flags = mask[cells_x, cells_y]
+        return (flags & LIDAR_MASK_TABLE) != 0, (flags & LIDAR_MASK_STATIC_OBSTACLE) != 0
 
 
 class Obstacle:
@@ -0,0 +1,159 @@
+"""
+Tracking of the opponent robots with the lidar.
+
+At each revolution, the points on the table and out of the static obstacles are split in clusters of consecutive
+points (by azimut), and the clusters of the size of a robot are associated to the tracks, which follow them with a
+constant velocity Kalman filter.
+"""
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+CLUSTER_MAX_GAP = 80  # mm, maximum distance between two consecutive points of a cluster
+CLUSTER_MIN_POINTS = 2
+OPPONENT_MAX_SIZE = 500  # mm, the clusters bigger than this are not robots
+TRACK_GATE = 400  # mm, maximum distance between the predicted position of a track and the cluster it follows
+TRACK_CONFIRMATION_HITS = 3  # revolutions in a row with a cluster before a track is published
+TRACK_MAX_MISSES = 5  # revolutions without cluster before a track is dropped
+POSITION_NOISE = 30.  # mm, standard deviation of the center of a cluster
+ACCELERATION_NOISE = 1000.  # mm/s², standard deviation of the acceleration of the opponents
+INITIAL_SPEED_NOISE = 500.  # mm/s, standard deviation of the speed of a new track
+
+Opponent = namedtuple("Opponent", ['id', 'x', 'y', 'vx', 'vy', 'time'])  # mm, mm/s, monotonic time of the estimate
+
+
+def cluster_points(xs, ys, max_gap=CLUSTER_MAX_GAP):
+    """
+    :param xs: x of the points, ordered by azimut (mm).
+    :type xs: numpy.ndarray
+    :param ys: y of the points, ordered by azimut (mm).
+    :type ys: numpy.ndarray
+    :param max_gap: Two consecutive points closer than this distance (in mm) are in the same cluster. The last and the
+        first points are consecutive too (the points are a full revolution).
+    :type max_gap: float
+    :return: The indexes of the points of each cluster.
+    :rtype: list[numpy.ndarray]
+    """
+    if len(xs) == 0:
+        return []
+    indexes = np.arange(len(xs))
+    clusters = np.split(indexes, np.flatnonzero(np.hypot(np.diff(xs), np.diff(ys)) > max_gap) + 1)
+    if len(clusters) > 1 and math.hypot(xs[0] - xs[-1], ys[0] - ys[-1]) <= max_gap:
+        clusters[0] = np.concatenate((clusters.pop(), clusters[0]))
+    return clusters
+
+
+def find_opponents(xs, ys):
+    """
+    :return: The centers of the clusters of xs, ys (see cluster_points) which may be robots (at least
+        CLUSTER_MIN_POINTS points, and at most OPPONENT_MAX_SIZE mm wide), as a (clusters, 2) array.
+    :rtype: numpy.ndarray
+    """
+    centers = []
+    for cluster in cluster_points(xs, ys):
+        if len(cluster) < CLUSTER_MIN_POINTS:
+            continue
+        cluster_xs, cluster_ys = xs[cluster], ys[cluster]
+        if math.hypot(cluster_xs.max() - cluster_xs.min(), cluster_ys.max() - cluster_ys.min()) > OPPONENT_MAX_SIZE:
+            continue
+        centers.append((cluster_xs.mean(), cluster_ys.mean()))
+    return np.array(centers, dtype=float).reshape(-1, 2)
+
+
+class Track:
+    """
+    An object followed across the revolutions. x and y are filtered independently with the same constant velocity
+    model, so they share the covariance (position variance, position speed covariance, speed variance).
+    """
+    _ID = 0
+
+    def __init__(self, x, y, time):
+        self.id = Track._ID
+        Track._ID += 1
+        self.x = x
+        self.y = y
+        self.vx = 0.
+        self.vy = 0.
+        self.time = time
+        self.hits = 1  # revolutions in a row with a cluster
+        self.misses = 0  # revolutions in a row without cluster
+        self.confirmed = False  # TRACK_CONFIRMATION_HITS hits in a row once
+        self._covariance = (POSITION_NOISE ** 2, 0., INITIAL_SPEED_NOISE ** 2)
+
+    def predict(self, time):
+        dt = time - self.time
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+        self.time = time
+        p_pp, p_pv, p_vv = self._covariance
+        q = ACCELERATION_NOISE ** 2
+        self._covariance = (p_pp + 2 * dt * p_pv + dt ** 2 * p_vv + q * dt ** 4 / 4,
+                            p_pv + dt * p_vv + q * dt ** 3 / 2,
+                            p_vv + q * dt ** 2)
+
+    def correct(self, x, y):
+        p_pp, p_pv, p_vv = self._covariance
+        innovation_variance = p_pp + POSITION_NOISE ** 2
+        gain_position, gain_speed = p_pp / innovation_variance, p_pv / innovation_variance
+        dx, dy = x - self.x, y - self.y
+        self.x += gain_position * dx
+        self.y += gain_position * dy
+        self.vx += gain_speed * dx
+        self.vy += gain_speed * dy
+        self._covariance = ((1 - gain_position) * p_pp, (1 - gain_position) * p_pv, p_vv - gain_speed * p_pv)
+        self.hits += 1
+        self.misses = 0
+        self.confirmed = self.confirmed or self.hits >= TRACK_CONFIRMATION_HITS
+
+    def miss(self):
+        self.hits = 0
+        self.misses += 1
+
+    def opponent(self):
+        return Opponent(self.id, self.x, self.y, self.vx, self.vy, self.time)
+
+
+class OpponentTracker:
+    """
+    Updated with the points of each revolution (see update), it publishes the confirmed tracks in opponents (a tuple
+    replaced at each update, the readers take no lock). A confirmed track is published until it is dropped, its
+    position is predicted during the revolutions without cluster.
+    """
+    def __init__(self):
+        self.tracks = []  # type: list[Track]
+        self.opponents = ()  # type: tuple[Opponent]
+
+    def update(self, xs, ys, time):
+        """
+        :param xs: x of the points of a revolution on the table and out of the static obstacles, ordered by azimut.
+        :type xs: numpy.ndarray
+        :param ys: y of the points.
+        :type ys: numpy.ndarray
+        :param time: Monotonic time of the revolution.
+        :type time: float
+        """
+        centers = find_opponents(xs, ys)
+        center_list = centers.tolist()
+        for track in self.tracks:
+            track.predict(time)
+        free_centers = set(range(len(centers)))
+        missed = set(self.tracks)
+        if self.tracks and len(centers):
+            predictions = np.array([(track.x, track.y) for track in self.tracks])
+            distances = np.hypot(predictions[:, None, 0] - centers[:, 0], predictions[:, None, 1] - centers[:, 1])
+            # Nearest pairs first
+            for track_index, center_index in zip(*np.unravel_index(np.argsort(distances, axis=None), distances.shape)):
+                if distances[track_index, center_index] > TRACK_GATE:
+                    break
+                track = self.tracks[track_index]
+                if track in missed and center_index in free_centers:
+                    track.correct(*center_list[center_index])
+                    missed.remove(track)
+                    free_centers.remove(center_index)
+        for track in missed:
+            track.miss()
+        self.tracks = [track for track in self.tracks if track.misses <= TRACK_MAX_MISSES]
+        self.tracks.extend(Track(center_list[i][0], center_list[i][1], time) for i in sorted(free_centers))
+        self.opponents = tuple(track.opponent() for track in self.tracks if track.confirmed)
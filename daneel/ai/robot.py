@@ -1,10 +1,13 @@
 import sys
 import map
+import signal
 import datetime
 import argparse
+import threading
 
 import communication
 import ivy_robot
+from clock import Clock
 from io_robot import *
 from locomotion import *
 from behavior import Behaviors
@@ -18,15 +21,49 @@ IVY_ADDRESS_DEFAULT = "192.168.1.255:2010"
 LIDAR_MASK_FILE = "data/obstacles_lidar_mask_very_unsafe.yaml"
 TEENSY_SERIAL_PATH_DEFAULT = "/dev/ttyAMA0"
 
+LOOP_PERIOD = 0.01  # s
+BEHAVIOR_PERIOD = 1  # s
+
 
 class Robot(object):
     def __init__(self, behavior=BEHAVIOR_DEFAULT, ivy_address=IVY_ADDRESS_DEFAULT,
-                 lidar_mask_file=LIDAR_MASK_FILE, teensy_serial_path=TEENSY_SERIAL_PATH_DEFAULT):
+                 lidar_mask_file=LIDAR_MASK_FILE, teensy_serial_path=TEENSY_SERIAL_PATH_DEFAULT,
+                 teensy_reader_thread=False, clock=None, teensy_serial=None, lidar_serial_path=LIDAR_SERIAL_PATH,
+                 line_detector=None, teensy_trace_path=None, teensy_cumulative_acks=False, lidar_record_path=None,
+                 lidar_replay_path=None, lidar_process=False, teensy_protocol=communication.eProtocolVersion.LEGACY):
+        """
+        :param ivy_address: The ivy bus address, None to run without ivy.
+        :type ivy_address: str
+        :param clock: The time source of the robot (default : wall clock, see simulation.py for a virtual one).
+        :type clock: Clock
+        :param teensy_serial: An already opened serial to the Teensy, used instead of teensy_serial_path.
+        :param lidar_serial_path: Path of the serial plugged to the lidar, None to run without lidar.
+        :type lidar_serial_path: str
+        :param line_detector: see IO
+        :param teensy_trace_path: File recording the traffic with the Teensy (see communication.wire_trace), None to
+            not record it.
+        :type teensy_trace_path: str
+        :param teensy_cumulative_acks: see Communication
+        :type teensy_cumulative_acks: bool
+        :param lidar_record_path: see IO
+        :type lidar_record_path: str
+        :param lidar_replay_path: see IO
+        :type lidar_replay_path: str
+        :param lidar_process: see IO
+        :type lidar_process: bool
+        :param teensy_protocol: see Communication
+        :type teensy_protocol: communication.eProtocolVersion
+        """
+        self.clock = Clock() if clock is None else clock
         self.map = map.Map(self, lidar_mask_file)
-        self.communication = communication.Communication(teensy_serial_path)
-        self.io = IO(self)
+        self.communication = communication.Communication(teensy_serial_path, reader_thread=teensy_reader_thread,
+                                                         clock=self.clock, serial_port=teensy_serial,
+                                                         trace_path=teensy_trace_path, protocol=teensy_protocol,
+                                                         cumulative_acks=teensy_cumulative_acks)
+        self.io = IO(self, lidar_serial_path, line_detector, lidar_record_path, lidar_replay_path, lidar_process)
         self.locomotion = Locomotion(self)
-        self.ivy = ivy_robot.Ivy(self, ivy_address)
+        self.io.start_lidar()
+        self.ivy = ivy_robot.Ivy(self, ivy_address) if ivy_address is not None else None
         if behavior == Behaviors.FSMMatch.value:
             from behavior.fsmmatch import FSMMatch
             self.behavior = FSMMatch(self)
@@ -42,27 +79,53 @@ class Robot(object):
 def main():
     global robot
     robot = Robot(behavior=parsed_args.behavior, ivy_address=parsed_args.ivy, lidar_mask_file=parsed_args.mask,
-                  teensy_serial_path=parsed_args.teensy_serial)
+                  teensy_serial_path=parsed_args.teensy_serial, teensy_reader_thread=parsed_args.reader_thread,
+                  teensy_trace_path=parsed_args.trace, teensy_cumulative_acks=parsed_args.cumulative_acks,
+                  lidar_record_path=parsed_args.lidar_record, lidar_replay_path=parsed_args.lidar_replay,
+                  lidar_process=parsed_args.lidar_process,
+                  teensy_protocol=communication.eProtocolVersion.COBS_CRC16 if parsed_args.cobs else
+                  communication.eProtocolVersion.LEGACY)
     # Arguments parsing
     robot.communication.mock_communication = parsed_args.no_teensy
     robot.communication.register_callback(communication.eTypeUp.ODOM_REPORT,
-                                          lambda o, n, x, y, t: robot.ivy.send_robot_position())
+                                          lambda event: robot.ivy.send_robot_position(), event=True)
     robot.communication.register_callback(communication.eTypeUp.HMI_STATE,
-                                          lambda cord, b1, b2, lr, lg, lb: print("c: {}, b1: {}, b2: {}".format(
-                                            robot.io.cord_state, robot.io.button1_state, robot.io.button2_state)))
+                                          lambda event: print("c: {}, b1: {}, b2: {}".format(
+                                            robot.io.cord_state, robot.io.button1_state, robot.io.button2_state)),
+                                          event=True)
     # robot.communication.register_callback(communication.eTypeUp.HMI_STATE, new_hmi_state_callback)
     # robot.communication.register_callback(communication.eTypeUp.ODOM_REPORT,
     #                                       robot.locomotion.handle_new_odometry_report)
     # robot.communication.register_callback(communication.eTypeUp.ODOM_REPORT, lambda o, n, x, y, t: print(
     #     "X : {}, Y : {}, Theta : {}".format(robot.locomotion.x, robot.locomotion.y, robot.locomotion.theta)))
-    last_behavior_time = time.time()
-    while True:
-        time.sleep(0.01)
+    # kill -USR1 <pid> dumps the serial link metrics (from another thread, the handler may interrupt a serial read)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+        target=robot.communication.dump_metrics, args=(parsed_args.metrics,)).start())
+    try:
+        run(robot)
+    finally:
+        robot.communication.stop_trace()
+        robot.io.stop_lidar()
+
+
+def run(robot, end_time=None):
+    """
+    Main loop of the robot : reads the messages from the Teensy and runs the locomotion every LOOP_PERIOD, and the
+    behavior every BEHAVIOR_PERIOD.
+
+    :param robot: The robot to run.
+    :type robot: Robot
+    :param end_time: Time (of the robot clock) at which to return, None to run forever.
+    :type end_time: float
+    """
+    last_behavior_time = robot.clock.time()
+    while end_time is None or robot.clock.time() < end_time:
+        robot.clock.sleep(LOOP_PERIOD)
         robot.communication.check_message()
         robot.locomotion.locomotion_loop(obstacle_detection=True)
-        if time.time() - last_behavior_time >= 1:
+        if robot.clock.time() - last_behavior_time >= BEHAVIOR_PERIOD:
             robot.behavior.loop()
-            last_behavior_time = time.time()
+            last_behavior_time = robot.clock.time()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("AI option parser", formatter_class=argparse.RawTextHelpFormatter)
@@ -77,6 +140,24 @@ if __name__ == '__main__':
                         help="Path to YAML file containing obstacle detection lidar masks")
     parser.add_argument('-t', '--teensy_serial', type=str, default=TEENSY_SERIAL_PATH_DEFAULT,
                         help="Path to serial plugged to Teensy.")
+    parser.add_argument('--reader_thread', action='store_true', default=False,
+                        help="Read the Teensy serial in a dedicated thread")
+    parser.add_argument('--metrics', type=str, default=None,
+                        help="JSON file written with the serial link metrics on SIGUSR1 (default : print a summary)")
+    parser.add_argument('--trace', type=str, default=None,
+                        help="File recording the traffic with the Teensy "
+                             "(replay : python3 -m communication.wire_trace)")
+    parser.add_argument('--cumulative_acks', action='store_true', default=False,
+                        help="Acknowledge the Teensy messages received together with a single frame")
+    parser.add_argument('--cobs', action='store_true', default=False,
+                        help="Request the COBS framing to the Teensy (not supported by the current firmware)")
+    parser.add_argument('--lidar_record', type=str, default=None,
+                        help="File recording the bytes read from the lidar "
+                             "(replay : python3 -m drivers.neato_xv11_lidar)")
+    parser.add_argument('--lidar_replay', type=str, default=None,
+                        help="Lidar recording replayed instead of reading the lidar")
+    parser.add_argument('--lidar_process', action='store_true', default=False,
+                        help="Read and decode the lidar in a child process")
     parsed_args = parser.parse_args()
     # if __debug__:
     #     with open(TRACE_FILE, 'w') as sys.stdout:
@@ -0,0 +1,149 @@
+"""
+Faster than real time simulation of matches.
+
+The robot runs its real main loop (robot.run) on a SimulatedClock, talking to an in-process Teensy emulator
+(communication.teensy_emulator.EmulatedSerial) with the same clock, without lidar nor ivy. The match is started by
+a script acting on the cord and buttons, as it is done on the table. Waiting costs nothing, so a match of
+END_MATCH_TIME seconds runs in a fraction of a second, and gives the same result for the same options.
+
+Usage (from the ai directory) : python3 simulation.py -n 100 -c orange
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import time
+from collections import namedtuple
+from enum import Enum
+
+from behavior import Behaviors
+from behavior.fsmmatch import Color, END_MATCH_TIME
+from clock import SimulatedClock
+from communication.message_definition import eProtocolVersion
+from communication.teensy_emulator import EmulatedSerial
+from robot import Robot, run
+
+# (time from the start of the simulation in seconds, cord in, button 1 pressed, button 2 pressed (orange))
+MATCH_START_SCRIPT = [
+    (0., True, False, False),
+    (3., True, True, None),  # leave the pre start checks
+    (4.5, True, False, None),  # released before the shutdown delay
+    (6., False, False, None),  # cord pulled out : pre match
+    (8., True, False, False),  # cord in : go !
+]
+END_MATCH_MARGIN = 3  # s, simulated after the end of the match
+
+MatchResult = namedtuple("MatchResult", ['score', 'state', 'x', 'y', 'theta', 'duration', 'link_metrics'])
+
+
+class SimulatedLineDetector:
+    """
+    Line detector of a simulated robot: never sees a line (the repositioning states end on their timeout).
+    """
+    class State(Enum):
+        IDLE = "Idle"
+        ON_BLACK = "On Black"
+        ON_WHITE = "On White"
+
+    def __init__(self):
+        self.states = [self.State.IDLE] * 8
+
+    def sense(self):
+        pass
+
+    def reset(self):
+        self.states = [self.State.IDLE] * 8
+
+
+@contextlib.contextmanager
+def _discarded_stdout():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def simulate_match(color=Color.GREEN, loss=0., latency=0., corruption=0., seed=None, verbose=False,
+                   trace_path=None, cumulative_acks=False, protocol=eProtocolVersion.LEGACY):
+    """
+    Runs a whole FSMMatch match on a virtual time.
+
+    :param color: The side of the robot.
+    :type color: Color
+    :param loss: see teensy_emulator.TeensyEmulator
+    :param latency: see teensy_emulator.TeensyEmulator
+    :param corruption: see teensy_emulator.TeensyEmulator
+    :param seed: see teensy_emulator.TeensyEmulator
+    :param verbose: If False, the prints of the robot are discarded.
+    :type verbose: bool
+    :param trace_path: File recording the traffic with the emulated Teensy (see communication.wire_trace).
+    :type trace_path: str
+    :param cumulative_acks: see communication.Communication
+    :type cumulative_acks: bool
+    :param protocol: The protocol requested to the emulated Teensy (see communication.Communication).
+    :type protocol: eProtocolVersion
+    :return: The score and the state of the robot at the end, the wall time taken by the simulation and the metrics
+        of the serial link (see Communication.link_metrics).
+    :rtype: MatchResult
+    """
+    start_time = time.time()
+    clock = SimulatedClock()
+    teensy = EmulatedSerial(clock, loss=loss, latency=latency, corruption=corruption, seed=seed)
+    with contextlib.nullcontext() if verbose else _discarded_stdout():
+        robot = Robot(Behaviors.FSMMatch.value, ivy_address=None, clock=clock, teensy_serial=teensy,
+                      lidar_serial_path=None, line_detector=SimulatedLineDetector(), teensy_trace_path=trace_path,
+                      teensy_cumulative_acks=cumulative_acks, teensy_protocol=protocol)
+        script_start = clock.time()
+        for script_time, cord_in, button1_pressed, button2_pressed in MATCH_START_SCRIPT:
+            run(robot, script_start + script_time)
+            if button2_pressed is None:
+                button2_pressed = color == Color.ORANGE
+            teensy.emulator.set_hmi_inputs(cord_in, button1_pressed, button2_pressed)
+        while robot.behavior.start_time is None and clock.time() - script_start < 2 * END_MATCH_TIME:
+            run(robot, clock.time() + 1)
+        if robot.behavior.start_time is not None:
+            run(robot, robot.behavior.start_time + END_MATCH_TIME + END_MATCH_MARGIN)
+        robot.communication.stop_trace()
+    return MatchResult(robot.behavior.score, robot.behavior.state.__class__.__name__, robot.locomotion.x,
+                       robot.locomotion.y, robot.locomotion.theta, time.time() - start_time,
+                       robot.communication.link_metrics())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates matches faster than real time.")
+    parser.add_argument('-n', '--matches', type=int, default=1, help="Number of matches to simulate.")
+    parser.add_argument('-c', '--color', type=str, default=Color.GREEN.value,
+                        choices=[c.value for c in Color], help="Side of the robot.")
+    parser.add_argument('-l', '--loss', type=float, default=0., help="Probability for a frame to be lost.")
+    parser.add_argument('-d', '--latency', type=float, default=0., help="One way delay of the frames (s).")
+    parser.add_argument('--corruption', type=float, default=0.,
+                        help="Probability for each byte to have a bit flipped.")
+    parser.add_argument('-s', '--seed', type=int, default=0, help="Seed of the first match (+1 for each match).")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Show the prints of the robot.")
+    parser.add_argument('-m', '--metrics', type=str, default=None,
+                        help="JSON file to write the serial link metrics of each match in.")
+    parser.add_argument('-t', '--trace', type=str, default=None,
+                        help="Wire trace file of each match, {} is replaced by the match number (eg. match_{}.trace).")
+    parser.add_argument('-a', '--cumulative_acks', action='store_true', default=False,
+                        help="Acknowledge the up messages received together with a single frame.")
+    parser.add_argument('--cobs', action='store_true', default=False, help="Request the COBS framing to the Teensy.")
+    args = parser.parse_args()
+
+    results = []
+    for i in range(args.matches):
+        result = simulate_match(Color(args.color), args.loss, args.latency, args.corruption, args.seed + i,
+                                args.verbose, None if args.trace is None else args.trace.format(i),
+                                args.cumulative_acks,
+                                eProtocolVersion.COBS_CRC16 if args.cobs else eProtocolVersion.LEGACY)
+        results.append(result)
+        print("Match {} : score {}, ended in {} at ({:.0f}, {:.0f}, {:.2f}), simulated in {:.2f} s".format(
+            i, result.score, result.state, result.x, result.y, result.theta, result.duration))
+    wall_time = sum(r.duration for r in results)
+    print("{} matches simulated in {:.1f} s ({:.0f} matches / min), mean score {:.1f}".format(
+        len(results), wall_time, 60 * len(results) / wall_time, sum(r.score for r in results) / len(results)))
+    if args.metrics is not None:
+        with open(args.metrics, 'w') as f:
+            json.dump([r.link_metrics for r in results], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()